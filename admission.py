@@ -0,0 +1,250 @@
+# CellShader - Admission control for image processing
+# Limits concurrent OpenCV work, queues the overflow and sheds load when full.
+
+import math
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, highest priority first.
+LANE_PREVIEW = 'preview'
+LANE_FULL = 'full'
+LANES = (LANE_PREVIEW, LANE_FULL)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a processing request is shed instead of being run."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """One queued or running processing request."""
+
+    def __init__(self, client_id, lane, cost, pixel_count):
+        self.client_id = client_id
+        self.lane = lane
+        self.cost = cost
+        self.pixel_count = pixel_count
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+
+
+class AdmissionController:
+    """
+    Cost-weighted concurrency limiter with a bounded, fair wait queue.
+
+    Capacity is expressed in cost units. Each request costs one unit per
+    `pixels_per_unit` target pixels (at least one, at most the full capacity),
+    so a single 4K render can hold the same budget as several small previews.
+    Waiting requests are grouped into priority lanes and, inside a lane,
+    served round-robin per client so one client cannot monopolize the queue.
+    """
+
+    def __init__(self, max_concurrent=2, max_queue=8, max_queue_per_client=4,
+                 queue_timeout=30.0, pixels_per_unit=2000000, preview_max_pixels=500000):
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._lanes = {lane: OrderedDict() for lane in LANES}
+        self._queued = 0
+        self._in_use = 0
+        self._running = 0
+        # Rolling estimate of seconds one cost unit is held, used for Retry-After.
+        self._seconds_per_unit = 2.0
+        self._stats = {'admitted': 0, 'enqueued': 0, 'rejected': 0, 'timed_out': 0}
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_per_client = max_queue_per_client
+        self.queue_timeout = queue_timeout
+        self.pixels_per_unit = pixels_per_unit
+        self.preview_max_pixels = preview_max_pixels
+
+    def configure(self, config):
+        """Apply admission settings from the application config dictionary."""
+        with self._condition:
+            self.max_concurrent = max(1, int(config.get('processing_max_concurrent', self.max_concurrent)))
+            self.max_queue = max(0, int(config.get('processing_max_queue', self.max_queue)))
+            self.max_queue_per_client = max(1, int(config.get('processing_max_queue_per_client', self.max_queue_per_client)))
+            self.queue_timeout = float(config.get('processing_queue_timeout', self.queue_timeout))
+            self.pixels_per_unit = max(1, int(config.get('processing_pixels_per_unit', self.pixels_per_unit)))
+            self.preview_max_pixels = int(config.get('processing_preview_max_pixels', self.preview_max_pixels))
+            # Capacity may have grown, so waiting requests may now fit.
+            self._dispatch()
+            self._condition.notify_all()
+
+    def estimate_cost(self, pixel_count):
+        """Estimate the cost units of a render from its target pixel count."""
+        units = math.ceil(max(1, pixel_count) / self.pixels_per_unit)
+        return max(1, min(self.max_concurrent, units))
+
+    def classify(self, pixel_count, requested_lane=None):
+        """
+        Pick the priority lane. A client may ask for the full lane, but the
+        preview lane is only for renders of at most `preview_max_pixels`, so a
+        large render sent with priority=preview is downgraded.
+        """
+        if pixel_count > self.preview_max_pixels:
+            return LANE_FULL
+        if requested_lane in LANES:
+            return requested_lane
+        return LANE_PREVIEW
+
+    def check_capacity(self):
+        """Fail fast before any expensive work when the wait queue is already full."""
+        with self._condition:
+            if self._queued >= self.max_queue and self._in_use >= self.max_concurrent:
+                self._stats['rejected'] += 1
+                raise AdmissionRejected('Server is busy processing other images.', self._retry_after())
+
+    def rejection(self, message='Server is busy processing other images.'):
+        """Count a request shed before it reached the controller (e.g. by a front end) and build its error."""
+        with self._condition:
+            self._stats['rejected'] += 1
+            return AdmissionRejected(message, self._retry_after())
+
+    def acquire(self, client_id, pixel_count, lane=None):
+        """
+        Reserve processing capacity, waiting in the queue if needed.
+
+        Returns:
+            AdmissionTicket: Ticket to hand back to `release()`
+
+        Raises:
+            AdmissionRejected: When the queue is full or the wait times out
+        """
+        with self._condition:
+            ticket = AdmissionTicket(client_id, self.classify(pixel_count, lane),
+                                     self.estimate_cost(pixel_count), pixel_count)
+
+            # Fast path - nothing waiting and the request fits.
+            if self._queued == 0 and self._in_use + ticket.cost <= self.max_concurrent:
+                self._grant(ticket)
+                return ticket
+
+            # Shed load instead of growing the queue without bound.
+            if self._queued >= self.max_queue:
+                self._stats['rejected'] += 1
+                raise AdmissionRejected('Processing queue is full.', self._retry_after())
+            client_queue = self._lanes[ticket.lane].get(client_id)
+            client_queued = sum(len(lane.get(client_id, ())) for lane in self._lanes.values())
+            if client_queued >= self.max_queue_per_client:
+                self._stats['rejected'] += 1
+                raise AdmissionRejected('Too many queued requests for this client.', self._retry_after())
+
+            if client_queue is None:
+                client_queue = self._lanes[ticket.lane][client_id] = deque()
+            client_queue.append(ticket)
+            self._queued += 1
+            self._stats['enqueued'] += 1
+
+            deadline = time.monotonic() + self.queue_timeout
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._remove(ticket)
+                    self._stats['timed_out'] += 1
+                    raise AdmissionRejected('Timed out waiting for processing capacity.', self._retry_after())
+                self._condition.wait(remaining)
+            return ticket
+
+    def release(self, ticket):
+        """Return a ticket's capacity and wake the next waiting requests."""
+        with self._condition:
+            if not ticket.granted:
+                return
+            ticket.granted = False
+            self._in_use -= ticket.cost
+            self._running -= 1
+            held = time.monotonic() - ticket.started_at
+            # Exponential moving average of hold time per cost unit.
+            self._seconds_per_unit = 0.8 * self._seconds_per_unit + 0.2 * (held / ticket.cost)
+            self._dispatch()
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, client_id, pixel_count, lane=None):
+        """Context manager that holds processing capacity for the enclosed block."""
+        with profiling.span('admission_wait', 'queue'):
+            ticket = self.acquire(client_id, pixel_count, lane)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        """Return a snapshot of limiter state for monitoring."""
+        with self._condition:
+            return {
+                'capacity': self.max_concurrent,
+                'in_use': self._in_use,
+                'running': self._running,
+                'queued': self._queued,
+                'queued_by_lane': {lane: sum(len(q) for q in clients.values())
+                                   for lane, clients in self._lanes.items()},
+                'max_queue': self.max_queue,
+                'seconds_per_unit': round(self._seconds_per_unit, 3),
+                **self._stats
+            }
+
+    def _grant(self, ticket):
+        """Mark a ticket as running. Caller must hold the lock."""
+        ticket.granted = True
+        ticket.started_at = time.monotonic()
+        self._in_use += ticket.cost
+        self._running += 1
+        self._stats['admitted'] += 1
+
+    def _dispatch(self):
+        """Grant queued tickets in lane priority and client round-robin order. Caller must hold the lock."""
+        for lane in LANES:
+            clients = self._lanes[lane]
+            while clients:
+                client_id, client_queue = next(iter(clients.items()))
+                ticket = client_queue[0]
+                # Strict head-of-line order so large renders are not starved by small ones.
+                if self._in_use + ticket.cost > self.max_concurrent:
+                    return
+                client_queue.popleft()
+                self._queued -= 1
+                self._grant(ticket)
+                # Rotate the client to the back of the lane for fairness.
+                if client_queue:
+                    clients.move_to_end(client_id)
+                else:
+                    del clients[client_id]
+
+    def _remove(self, ticket):
+        """Drop a waiting ticket from its lane. Caller must hold the lock."""
+        clients = self._lanes[ticket.lane]
+        client_queue = clients.get(ticket.client_id)
+        if client_queue and ticket in client_queue:
+            client_queue.remove(ticket)
+            self._queued -= 1
+            if not client_queue:
+                del clients[ticket.client_id]
+
+    def estimated_wait(self):
+        """Estimate seconds a new request would wait for capacity, 0 when it would run at once."""
+        with self._condition:
+            if self._queued == 0 and self._in_use < self.max_concurrent:
+                return 0.0
+            return self._pending_seconds()
+
+    def _pending_seconds(self):
+        """Seconds of admitted and queued work per slot of capacity. Caller must hold the lock."""
+        pending_units = self._in_use + sum(
+            ticket.cost for clients in self._lanes.values() for q in clients.values() for ticket in q)
+        return self._seconds_per_unit * pending_units / max(1, self.max_concurrent)
+
+    def _retry_after(self):
+        """Estimate whole seconds until capacity frees up. Caller must hold the lock."""
+        return max(1, int(math.ceil(self._pending_seconds())))
@@ -1,7 +1,7 @@
 # CellShader - Flask Web Application for Image Processing
 # Phase 2: Core Image Processing
 
-from flask import Flask, render_template, request, jsonify, send_file, flash, redirect, url_for
+from flask import Flask, render_template, request, jsonify, send_file, flash, redirect, url_for, g
 import os
 import cv2
 import numpy as np
@@ -10,21 +10,49 @@ from werkzeug.utils import secure_filename
 import io
 import logging
 import json
+import time
+import hashlib
+import threading
+import atexit
+import copy
+import hmac
 from datetime import datetime
+from contextlib import contextmanager
+from admission import AdmissionController, AdmissionRejected, LANE_PREVIEW
+from blob_store import BlobStore
+from file_lock import FileLock
+from retention import RetentionManager
+from image_index import ImageIndex, InvalidQuery, DEFAULT_LIMIT
+import shading
+import sweep
+from pipeline import load_pipelines, PipelineError, DEFAULT_PIPELINE, REALTIME_PIPELINE
+import profiling
+from profiling import CaptureBusy, Profiler
+from cost_model import CostModel, MEGAPIXEL
+from frame_pool import SharedFramePool, PoolUnavailable
+from broker import create_broker, JobFailed
 
 # Initialize Flask application.
 app = Flask(__name__)
 
 # Configuration settings.
-app.config['SECRET_KEY'] = 'cellshader-dev-key-change-in-production'
+app.config['SECRET_KEY'] = os.environ.get('CELLSHADER_SECRET_KEY', 'cellshader-dev-key-change-in-production')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size.
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['METADATA_FILE'] = 'uploads/images_metadata.json'
+app.config['BLOB_FOLDER'] = 'uploads/blobs'
 app.config['CONFIG_FILE'] = 'config.json'
+app.config['TRACE_FOLDER'] = 'traces'
+app.config['COST_MODEL_FILE'] = 'uploads/.cost_model.json'
+app.config['BROKER_FILE'] = 'uploads/.broker.sqlite'
 
 # Allowed file extensions for image uploads.
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
 
+# Largest render size a request may ask for, in pixels.
+MAX_TARGET_WIDTH = 3840
+MAX_TARGET_HEIGHT = 2160
+
 # Configure logging.
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -32,6 +60,46 @@ logger = logging.getLogger(__name__)
 # Global config variable.
 app_config = {}
 
+# Admission control for processing - limits concurrent OpenCV work per process.
+admission = AdmissionController()
+
+# Content-addressed storage shared by uploaded originals and processed renders.
+blob_store = BlobStore(app.config['BLOB_FOLDER'])
+
+# Guards read-modify-write cycles on the metadata file (requests and the retention sweeper)
+# across threads and the other server and worker processes sharing uploads/.
+metadata_lock = FileLock(os.path.join(app.config['UPLOAD_FOLDER'], '.metadata.lock'))
+
+# Processing pipelines by name, built-in and from config.json.
+pipelines = load_pipelines({})
+
+# Optional shading worker processes fed through shared memory slots.
+frame_pool = SharedFramePool()
+
+# Per-stage render costs learned from measured timings, for ETAs and deadlines.
+cost_model = CostModel(app.config['COST_MODEL_FILE'])
+
+# Job broker for rendering on worker nodes, created at start-up when enabled.
+broker = None
+
+# Serializes config reloads by worker node job threads, see check_job_pipeline().
+config_reload_lock = threading.Lock()
+
+# Settings only taken from config.json, never changed through the config API.
+STARTUP_ONLY_KEYS = ('distributed_processing', 'broker_backend', 'broker_file', 'trusted_proxies')
+
+# Broker job kind of a single render, see process_render_job().
+RENDER_JOB = 'render'
+
+# On-demand profiling and sampled tracing of processing requests.
+profiler = Profiler(app.config['TRACE_FOLDER'])
+
+# Endpoints that can be profiled or sampled.
+TRACED_ENDPOINTS = {'upload_file', 'parameter_sweep'}
+
+# Processing modes - 'quality' runs the configured pipeline, 'realtime' the constant-time one.
+PROCESSING_MODES = ('quality', 'realtime')
+
 def load_app_config():
     """Load application configuration from config.json file."""
     global app_config
@@ -51,6 +119,7 @@ def load_app_config():
                 'default_colorful': 1.0
             }
             logger.warning("Config file not found, using default configuration")
+        apply_runtime_config()
         return app_config
     except Exception as e:
         logger.error(f"Error loading configuration: {str(e)}")
@@ -63,8 +132,37 @@ def load_app_config():
             'default_smoothing': 7,
             'default_colorful': 1.0
         }
+        apply_runtime_config()
         return app_config
 
+def apply_runtime_config():
+    """Push the current app_config into long-lived components (admission, retention, profiler, frame pool, pipelines, broker)."""
+    # Swap pipelines in place, so render threads never see the registry empty.
+    configured = load_pipelines(app_config)
+    for name in [name for name in pipelines if name not in configured]:
+        pipelines.pop(name, None)
+    pipelines.update(configured)
+    admission.configure(app_config)
+    retention.configure(app_config)
+    profiler.configure(app_config)
+    frame_pool.configure(app_config)
+    cost_model.configure(app_config)
+    if broker is not None:
+        broker.configure(app_config)
+
+def validate_runtime_config(config):
+    """
+    Check that the long-lived components accept a config, without applying it.
+
+    Each component is configured as a throwaway copy, so a bad value raises
+    here and leaves the running components untouched.
+    """
+    load_pipelines(config)
+    AdmissionController().configure(config)
+    for component in (retention, profiler, frame_pool, cost_model, broker):
+        if component is not None:
+            copy.copy(component).configure(config)
+
 def allowed_file(filename):
     """Check if uploaded file has allowed extension."""
     return '.' in filename and \
@@ -75,12 +173,103 @@ def create_upload_folder():
     if not os.path.exists(app.config['UPLOAD_FOLDER']):
         os.makedirs(app.config['UPLOAD_FOLDER'])
 
+def configure_thread_budget(worker_count=None):
+    """
+    Split CPU cores between server workers so OpenCV does not oversubscribe the CPU.
+    
+    Each worker process gets its own OpenCV thread pool, which by default has one
+    thread per core. With several workers that multiplies into far more threads
+    than cores, so each worker is limited to its share of the cores.
+    
+    Args:
+        worker_count (int, optional): Number of worker processes sharing the machine
+    
+    Returns:
+        int: Number of OpenCV threads configured for this process
+    """
+    if worker_count is None:
+        worker_count = os.environ.get('CELLSHADER_WORKERS') or os.environ.get('WEB_CONCURRENCY') or app_config.get('server_workers', 1)
+    worker_count = max(1, int(worker_count))
+    
+    # An explicit opencv_threads setting wins, 0 means split the cores automatically.
+    threads = int(app_config.get('opencv_threads', 0))
+    if threads <= 0:
+        threads = max(1, (os.cpu_count() or 1) // worker_count)
+    
+    cv2.setNumThreads(threads)
+    logger.info(f"OpenCV thread budget: {threads} thread(s) for {worker_count} worker(s)")
+    return threads
+
+def warm_up_processing():
+    """Run a tiny shading pass so the first real request does not pay OpenCV/NumPy start-up costs."""
+    try:
+        start = time.perf_counter()
+        sample = np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8)
+        # Non-default saturation also exercises the HSV conversion path.
+        processed = shade_image_array(sample, 5, 4, 5, 1.2)
+        cv2.imencode('.png', processed)
+        cv2.imencode('.jpg', processed)
+        logger.info(f"Processing warm-up completed in {(time.perf_counter() - start) * 1000:.0f} ms")
+    except Exception as e:
+        # Warm-up is an optimization only, never block start-up on it.
+        logger.warning(f"Processing warm-up failed: {str(e)}")
+
+def create_app(config_file=None):
+    """
+    Application factory - runs start-up work once per server worker process.
+    
+    WSGI servers import the module without running the main block, so all
+    start-up steps (config load, directory creation, thread budget, warm-up)
+    live here.
+    
+    Args:
+        config_file (str, optional): Path to an alternate config.json
+    
+    Returns:
+        Flask: The configured application
+    """
+    if config_file:
+        app.config['CONFIG_FILE'] = config_file
+    
+    # Load application configuration.
+    load_app_config()
+    
+    # Create necessary directories.
+    create_upload_folder()
+    
+    # Limit OpenCV threads to this worker's share of the CPU.
+    opencv_threads = configure_thread_budget()
+    
+    # Start shading worker processes, splitting this worker's threads between them.
+    if frame_pool.workers > 0:
+        frame_pool.start(opencv_threads=opencv_threads // frame_pool.workers)
+        atexit.register(frame_pool.stop)
+    
+    # Prime OpenCV/NumPy before the first request arrives.
+    if app_config.get('warm_up_on_start', True):
+        warm_up_processing()
+    
+    # Publish renders to worker nodes when distributed processing is enabled.
+    global broker
+    if app_config.get('distributed_processing', False):
+        broker = create_broker(app_config, app.config['BROKER_FILE'])
+    
+    # Start from the costs learned by earlier runs, and keep what this one learns.
+    cost_model.load()
+    atexit.register(cost_model.save)
+    
+    # Start the low-priority storage sweeper.
+    retention.start()
+    
+    return app
+
 def load_images_metadata():
     """Load images metadata from JSON file."""
     try:
         if os.path.exists(app.config['METADATA_FILE']):
-            with open(app.config['METADATA_FILE'], 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with profiling.span('metadata_read', 'metadata'):
+                with open(app.config['METADATA_FILE'], 'r', encoding='utf-8') as f:
+                    return json.load(f)
         return []
     except Exception as e:
         logger.error(f"Error loading images metadata: {str(e)}")
@@ -90,36 +279,58 @@ def save_images_metadata(images):
     """Save images metadata to JSON file."""
     try:
         os.makedirs(os.path.dirname(app.config['METADATA_FILE']), exist_ok=True)
-        with open(app.config['METADATA_FILE'], 'w', encoding='utf-8') as f:
-            json.dump(images, f, indent=2, ensure_ascii=False)
+        # Write to a temp file and swap it in so readers never see a half-written file.
+        temp_file = f"{app.config['METADATA_FILE']}.tmp"
+        with profiling.span('metadata_write', 'metadata', images=len(images)):
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(images, f, indent=2, ensure_ascii=False)
+            os.replace(temp_file, app.config['METADATA_FILE'])
+        image_index.invalidate()
         logger.info(f"Saved metadata for {len(images)} images")
     except Exception as e:
         logger.error(f"Error saving images metadata: {str(e)}")
         raise
 
-def add_image_metadata(filename, original_name, file_size, width, height, target_width=None, target_height=None, keep_ratio=True):
+# Disk quotas, LRU eviction and orphan cleanup for uploads and renders.
+retention = RetentionManager(
+    app.config['UPLOAD_FOLDER'],
+    app.config['METADATA_FILE'],
+    blob_store,
+    load_images_metadata,
+    save_images_metadata,
+    metadata_lock
+)
+retention.is_busy = lambda: admission.stats()['running'] > 0
+
+# Sorted views over the metadata for paginated listing.
+image_index = ImageIndex(app.config['METADATA_FILE'], load_images_metadata)
+
+def add_image_metadata(filename, original_name, file_size, width, height, target_width=None, target_height=None, keep_ratio=True, content_hash=None):
     """Add new image to metadata storage."""
     try:
-        images = load_images_metadata()
-        
-        # Create new image entry.
-        image_entry = {
-            'id': len(images) + 1,
-            'filename': filename,
-            'original_name': original_name,
-            'file_size': file_size,
-            'original_width': width,
-            'original_height': height,
-            'target_width': target_width or width,
-            'target_height': target_height or height,
-            'keep_ratio': keep_ratio,
-            'aspect_ratio': width / height,
-            'upload_time': datetime.now().isoformat(),
-            'file_path': os.path.join('uploads', filename).replace('\\', '/')
-        }
-        
-        images.append(image_entry)
-        save_images_metadata(images)
+        with metadata_lock:
+            images = load_images_metadata()
+            
+            # Create new image entry, never reusing the ID of a deleted image.
+            image_entry = {
+                'id': max((img.get('id', 0) for img in images), default=0) + 1,
+                'filename': filename,
+                'original_name': original_name,
+                'file_size': file_size,
+                'original_width': width,
+                'original_height': height,
+                'target_width': target_width or width,
+                'target_height': target_height or height,
+                'keep_ratio': keep_ratio,
+                'aspect_ratio': width / height,
+                'upload_time': datetime.now().isoformat(),
+                'file_path': os.path.join('uploads', filename).replace('\\', '/'),
+                'content_hash': content_hash,
+                'renders': []
+            }
+            
+            images.append(image_entry)
+            save_images_metadata(images)
         
         logger.info(f"Added image metadata: {original_name}")
         return image_entry
@@ -128,17 +339,112 @@ def add_image_metadata(filename, original_name, file_size, width, height, target
         logger.error(f"Error adding image metadata: {str(e)}")
         raise
 
+def add_render_metadata(image_id, render_entry):
+    """Record a processed render (filename, content hash, parameters) on its source image."""
+    try:
+        with metadata_lock:
+            images = load_images_metadata()
+            for img in images:
+                if img.get('id') == image_id:
+                    img.setdefault('renders', []).append(render_entry)
+                    save_images_metadata(images)
+                    return True
+            return False
+    except Exception as e:
+        logger.error(f"Error adding render metadata: {str(e)}")
+        raise
+
 def remove_image_metadata(image_id):
     """Remove image from metadata storage."""
     try:
-        images = load_images_metadata()
-        images = [img for img in images if img.get('id') != image_id]
-        save_images_metadata(images)
+        with metadata_lock:
+            images = load_images_metadata()
+            images = [img for img in images if img.get('id') != image_id]
+            save_images_metadata(images)
         logger.info(f"Removed image metadata for ID: {image_id}")
     except Exception as e:
         logger.error(f"Error removing image metadata: {str(e)}")
         raise
 
+def get_client_id():
+    """
+    Identify the requesting client for per-client queue fairness.
+
+    Clients are told apart by address. Only requests arriving from one of the
+    `trusted_proxies` may name the client themselves, with `X-Client-Id` or the
+    address the proxy appended to `X-Forwarded-For`; anyone else could rotate
+    those headers to get a fresh queue quota on every request.
+    """
+    remote_addr = request.remote_addr or 'unknown'
+    if remote_addr in (app_config.get('trusted_proxies') or ()):
+        forwarded = request.headers.get('X-Forwarded-For', '').split(',')[-1].strip()
+        return request.headers.get('X-Client-Id') or forwarded or remote_addr
+    return remote_addr
+
+def admission_rejected_response(error):
+    """Build a 503 JSON response with a Retry-After header for shed requests."""
+    response = jsonify({
+        'success': False,
+        'error': str(error),
+        'retry_after': error.retry_after
+    })
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
+def unique_upload_filename(filename):
+    """Build a timestamped upload filename that does not collide with an existing file."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    unique_filename = f"{timestamp}_{filename}"
+    counter = 1
+    while os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)):
+        name, ext = os.path.splitext(filename)
+        unique_filename = f"{timestamp}_{name}_{counter}{ext}"
+        counter += 1
+    return unique_filename
+
+def store_uploaded_file(file):
+    """
+    Save an uploaded file through the blob store under a unique upload name.
+    
+    Returns:
+        tuple: (unique filename, file path, content hash, file size, whether the content is new)
+    """
+    filename = secure_filename(file.filename)
+    with profiling.span('store_upload', 'io'):
+        content_hash, file_size, is_new_content = blob_store.store_stream(file.stream, os.path.splitext(filename)[1])
+        while True:
+            unique_filename = unique_upload_filename(filename)
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+            try:
+                blob_store.link(content_hash, file_path)
+                break
+            except FileExistsError:
+                # Another upload took the name since it was checked - pick the next one.
+                continue
+    
+    if is_new_content:
+        logger.info(f"File uploaded: {file_path}")
+    else:
+        logger.info(f"File uploaded: {file_path} (duplicate content {content_hash[:12]}, stored once)")
+    return unique_filename, file_path, content_hash, file_size, is_new_content
+
+def discard_uploaded_file(unique_filename, content_hash):
+    """Remove an upload that could not be used, releasing its blob reference."""
+    retention.remove_image_files({'filename': unique_filename, 'content_hash': content_hash})
+    logger.info(f"Discarded unreadable upload {unique_filename}")
+
+def render_cache_key(content_hash, parameters, output_ext):
+    """Key identifying a render of given source content with given processing parameters."""
+    payload = json.dumps({'source': content_hash, 'ext': output_ext.lower(), **parameters}, sort_keys=True)
+    return 'render:' + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def render_cache_parameters(render_parameters):
+    """Parameters a render is cached under - renders of a named pipeline are also keyed by its steps, which config can change."""
+    pipeline_name = render_parameters.get('pipeline')
+    if pipeline_name in pipelines:
+        return dict(render_parameters, pipeline_steps=pipelines[pipeline_name].specs)
+    return render_parameters
+
 def create_cell_shaded_folder(original_path):
     """Create cell-shaded subfolder in the same directory as the original image."""
     try:
@@ -155,7 +461,7 @@ def create_cell_shaded_folder(original_path):
         logger.error(f"Error creating cell-shaded folder: {str(e)}")
         raise
 
-def apply_cell_shading(image_path, edge_thickness=None, color_levels=None, smoothing_amount=None, saturation_amount=None, target_width=None, target_height=None, keep_ratio=True):
+def apply_cell_shading(image_path, edge_thickness=None, color_levels=None, smoothing_amount=None, saturation_amount=None, target_width=None, target_height=None, keep_ratio=True, pipeline_name=None, report=None, edge_method=None, overrides=None):
     """
     Apply cell-shading effect to an image using OpenCV.
     
@@ -168,6 +474,10 @@ def apply_cell_shading(image_path, edge_thickness=None, color_levels=None, smoot
         target_width (int, optional): Target width for resizing
         target_height (int, optional): Target height for resizing
         keep_ratio (bool): Whether to maintain aspect ratio when resizing
+        pipeline_name (str, optional): Pipeline to run, defaults to `default_pipeline`
+        report (dict, optional): Filled with the stages run, skipped and their timings
+        edge_method (str, optional): Edge backend, defaults to `default_edge_method`
+        overrides (dict, optional): Extra pipeline parameters, such as `kmeans_attempts` or `processing_scale`
     
     Returns:
         numpy.ndarray: Processed image as numpy array
@@ -184,88 +494,198 @@ def apply_cell_shading(image_path, edge_thickness=None, color_levels=None, smoot
             saturation_amount = app_config.get('default_colorful', 1.0)
         
         # Read the image.
-        img = cv2.imread(image_path)
+        with profiling.span('decode', 'io'):
+            img = cv2.imread(image_path)
         if img is None:
             raise ValueError(f"Could not read image from {image_path}")
         
         logger.info(f"Processing image: {image_path}")
         logger.info(f"Parameters - Edge thickness: {edge_thickness}, Color levels: {color_levels}, Smoothing: {smoothing_amount}, Saturation: {saturation_amount}")
         
-        # Apply custom resizing if target dimensions are provided.
-        height, width = img.shape[:2]
-        if target_width is not None or target_height is not None:
-            # Compute final dimensions with keep_ratio logic.
-            if keep_ratio:
-                aspect_ratio = width / height
-                if target_width is not None and target_height is not None:
-                    # Prefer width when both provided.
-                    new_width = target_width
-                    new_height = int(target_width / aspect_ratio)
-                elif target_width is not None:
-                    new_width = target_width
-                    new_height = int(target_width / aspect_ratio)
-                elif target_height is not None:
-                    new_height = target_height
-                    new_width = int(target_height * aspect_ratio)
-            else:
-                new_width = target_width if target_width is not None else width
-                new_height = target_height if target_height is not None else height
-            
-            # Choose interpolation method based on scaling direction.
-            if new_width * new_height < width * height:
-                # Downscaling - use INTER_AREA for better quality.
-                interpolation = cv2.INTER_AREA
-            else:
-                # Upscaling - use INTER_LANCZOS4 for better quality.
-                interpolation = cv2.INTER_LANCZOS4
-            
-            img = cv2.resize(img, (new_width, new_height), interpolation=interpolation)
-            logger.info(f"Resized image to {new_width}x{new_height}")
-        
-        # Apply bilateral filter for smoothing while preserving edges.
-        smooth = cv2.bilateralFilter(img, smoothing_amount, 80, 80)
+        return shade_image_array(img, edge_thickness, color_levels, smoothing_amount, saturation_amount, target_width, target_height, keep_ratio, pipeline_name, report, edge_method, overrides)
         
-        # Apply saturation adjustment if needed.
-        if saturation_amount != 1.0:
-            # Convert to HSV color space for saturation adjustment.
-            hsv = cv2.cvtColor(smooth, cv2.COLOR_BGR2HSV)
-            hsv = hsv.astype(np.float32)
-            
-            # Adjust saturation channel (index 1 in HSV).
-            hsv[:, :, 1] = hsv[:, :, 1] * saturation_amount
-            
-            # Clamp values to valid range and convert back to uint8.
-            hsv[:, :, 1] = np.clip(hsv[:, :, 1], 0, 255)
-            hsv = hsv.astype(np.uint8)
-            
-            # Convert back to BGR color space.
-            smooth = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-            logger.info(f"Applied saturation adjustment: {saturation_amount}")
-        
-        # Create edge mask using adaptive threshold.
-        gray = cv2.cvtColor(smooth, cv2.COLOR_BGR2GRAY)
-        gray_blur = cv2.medianBlur(gray, 5)
-        # Ensure blockSize is odd and greater than 1 for adaptiveThreshold
-        block_size = edge_thickness if edge_thickness % 2 == 1 else edge_thickness + 1
-        edges = cv2.adaptiveThreshold(gray_blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size, edge_thickness)
-        
-        # Convert edges to 3-channel.
-        edges = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
-        
-        # Reduce colors using K-means clustering.
-        data = smooth.reshape((-1, 3))
-        data = np.float32(data)
-        
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1.0)
-        _, labels, centers = cv2.kmeans(data, color_levels, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
-        
-        # Convert back to uint8 and reshape.
-        centers = np.uint8(centers)
-        segmented_data = centers[labels.flatten()]
-        segmented_image = segmented_data.reshape(smooth.shape)
-        
-        # Combine the segmented image with edges.
-        cartoon = cv2.bitwise_and(segmented_image, edges)
+    except Exception as e:
+        logger.error(f"Error applying cell-shading: {str(e)}")
+        raise
+
+def render_job(image_path, output_filename, output_folder, render_key=None, **shading_args):
+    """
+    Build the payload of a render job for worker nodes.
+    
+    Paths are relative to the application folder, which every node shares.
+    `shading_args` are the keyword arguments of apply_cell_shading(). The
+    pipeline is resolved here and sent with the digest of its steps, so a
+    worker node running a different definition of it refuses the job.
+    """
+    shading_pipeline = get_pipeline(shading_args.get('pipeline_name'))
+    return {
+        'image_path': image_path.replace('\\', '/'),
+        'output_filename': output_filename,
+        'output_folder': output_folder.replace('\\', '/'),
+        'render_key': render_key,
+        'pipeline_digest': shading_pipeline.digest,
+        'shading': dict(shading_args, pipeline_name=shading_pipeline.name)
+    }
+
+def check_job_pipeline(payload):
+    """
+    Make sure this node runs a render job's pipeline exactly as the web node defined it.
+    
+    A mismatch usually means config.json changed after this node loaded it, so
+    the config is reloaded once before the job is refused.
+    
+    Raises:
+        PipelineError: The pipeline is unknown here or its steps still differ
+    """
+    name, digest = payload['shading'].get('pipeline_name'), payload.get('pipeline_digest')
+    if digest is None:
+        return
+    for attempt in range(2):
+        shading_pipeline = pipelines.get(name)
+        if shading_pipeline is not None and shading_pipeline.digest == digest:
+            return
+        if attempt == 0:
+            with config_reload_lock:
+                logger.info(f"Pipeline {name} differs from the web node's, reloading configuration")
+                load_app_config()
+    raise PipelineError(f"Pipeline {name} on this node does not match the one the job was published with")
+
+def process_render_job(payload):
+    """
+    Run a render job on a worker node and write the result back to shared storage.
+    
+    Args:
+        payload (dict): Job payload from render_job()
+    
+    Returns:
+        dict: Output path, content hash, pipeline report and encode time of the render
+    """
+    check_job_pipeline(payload)
+    report = {}
+    processed_img = apply_cell_shading(payload['image_path'], report=report, **payload['shading'])
+    encode_started = time.perf_counter()
+    # A retried job may find the output of an earlier attempt, which it owns.
+    output_path, render_hash = save_processed_image(processed_img, payload['output_filename'], payload['output_folder'], payload.get('render_key'), replace=True)
+    return {
+        'output_path': output_path.replace('\\', '/'),
+        'content_hash': render_hash,
+        'pipeline': report,
+        'encode_ms': round((time.perf_counter() - encode_started) * 1000, 1)
+    }
+
+def render_on_workers(jobs):
+    """
+    Publish render jobs to the broker and wait for worker nodes to finish them.
+    
+    Jobs still queued or running when one fails or the wait times out are
+    cancelled, so no worker spends time on a request that already gave up.
+    When `broker_max_queued` jobs are already waiting or running on the
+    workers, the request is shed with AdmissionRejected instead.
+    
+    Args:
+        jobs (list): Job payloads from render_job()
+    
+    Returns:
+        list: Job results from process_render_job(), in the order of `jobs`
+    """
+    max_queued = int(app_config.get('broker_max_queued', 0))
+    if max_queued and broker.depth() >= max_queued:
+        raise admission.rejection('Worker nodes are busy processing other images.')
+    job_ids = [broker.publish(RENDER_JOB, job) for job in jobs]
+    try:
+        with profiling.span('broker_wait', 'io', jobs=len(job_ids)):
+            return broker.wait_all(job_ids, float(app_config.get('broker_wait_timeout', 120)))
+    except (JobFailed, TimeoutError):
+        for job_id in job_ids:
+            broker.cancel(job_id)
+        raise
+
+def get_pipeline(name=None):
+    """Look up a processing pipeline, defaulting to `default_pipeline` in the config."""
+    name = name or app_config.get('default_pipeline', DEFAULT_PIPELINE)
+    if name not in pipelines:
+        raise PipelineError(f"Unknown pipeline: {name}")
+    return pipelines[name]
+
+def processing_mode(requested=None, priority=None):
+    """
+    Resolve the processing mode of a request.
+
+    An explicit mode wins. Otherwise requests that explicitly ask for
+    `priority=preview` use `preview_mode` from the config, and everything else
+    (including small images that only fall in the preview lane by size) runs
+    in 'quality' mode.
+    """
+    if requested:
+        if requested not in PROCESSING_MODES:
+            raise ValueError(f"Mode must be one of: {', '.join(PROCESSING_MODES)}.")
+        return requested
+    if priority == LANE_PREVIEW and app_config.get('preview_mode') in PROCESSING_MODES:
+        return app_config['preview_mode']
+    return 'quality'
+
+def parse_target_size(target_width, target_height):
+    """
+    Validate optional target dimensions from a request against the render limits.
+
+    Returns:
+        tuple: (width or None, height or None)
+
+    Raises:
+        ValueError: A dimension is not a whole number or is outside its range
+    """
+    size = []
+    for value, label, limit in ((target_width, 'width', MAX_TARGET_WIDTH), (target_height, 'height', MAX_TARGET_HEIGHT)):
+        if value in (None, ''):
+            size.append(None)
+            continue
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Target {label} must be a whole number of pixels.")
+        if value <= 0 or value > limit:
+            raise ValueError(f"Target {label} must be between 1 and {limit} pixels.")
+        size.append(value)
+    return tuple(size)
+
+def shading_params(edge_thickness, color_levels, smoothing_amount, saturation_amount, target_width=None, target_height=None, keep_ratio=True, edge_method=None, overrides=None):
+    """Bundle processing parameters the way pipeline stages take them, plus any overrides (e.g. deadline degradations)."""
+    return dict({
+        'edge_thickness': edge_thickness,
+        'edge_method': edge_method or app_config.get('default_edge_method', 'adaptive'),
+        'color_levels': color_levels,
+        'smoothing_amount': smoothing_amount,
+        'saturation_amount': saturation_amount,
+        'target_width': target_width,
+        'target_height': target_height,
+        'keep_ratio': keep_ratio
+    }, **(overrides or {}))
+
+def shade_image_array(img, edge_thickness, color_levels, smoothing_amount, saturation_amount, target_width=None, target_height=None, keep_ratio=True, pipeline_name=None, report=None, edge_method=None, overrides=None):
+    """
+    Apply the cell-shading effect to an already decoded BGR image.
+    
+    Args:
+        img (numpy.ndarray): Decoded BGR image
+        edge_thickness (int): Thickness of edges (1-10)
+        color_levels (int): Number of color levels (2-20)
+        smoothing_amount (int): Amount of smoothing (1-15)
+        saturation_amount (float): Saturation multiplier (0.0-2.0, 1.0 = original)
+        target_width (int, optional): Target width for resizing
+        target_height (int, optional): Target height for resizing
+        keep_ratio (bool): Whether to maintain aspect ratio when resizing
+        pipeline_name (str, optional): Pipeline to run, defaults to `default_pipeline`
+        report (dict, optional): Filled with the stages run, skipped and their timings
+        edge_method (str, optional): Edge backend, defaults to `default_edge_method`
+        overrides (dict, optional): Extra pipeline parameters, such as `kmeans_attempts` or `processing_scale`
+    
+    Returns:
+        numpy.ndarray: Processed image as numpy array
+    """
+    try:
+        # Run the pipeline stages - by default resize, smooth, saturation, edges, quantize and combine.
+        params = shading_params(edge_thickness, color_levels, smoothing_amount, saturation_amount, target_width, target_height, keep_ratio, edge_method, overrides)
+        cartoon = get_pipeline(pipeline_name).run(img, params, report=report)
         
         logger.info("Cell-shading effect applied successfully")
         return cartoon
@@ -274,35 +694,107 @@ def apply_cell_shading(image_path, edge_thickness=None, color_levels=None, smoot
         logger.error(f"Error applying cell-shading: {str(e)}")
         raise
 
-def save_processed_image(processed_img, original_filename, output_folder):
+def estimate_render(source_shape, pipeline_name, params, output_pixels, deadline_ms=None, elapsed_ms=0.0, allow_fallback=True):
+    """
+    Predict when a render will be done and, with a deadline, pick degradations to meet it.
+    
+    The ETA adds the time already spent, the expected admission queue wait,
+    the pipeline's critical path and the encode time from the cost model.
+    
+    Args:
+        source_shape (tuple): Shape of the decoded source image
+        pipeline_name (str): Pipeline the request asked for
+        params (dict): Pipeline parameters from shading_params()
+        output_pixels (int): Pixel count of the final image
+        deadline_ms (int, optional): Latency budget of the whole request
+        elapsed_ms (float): Time already spent on the request
+        allow_fallback (bool): Whether the realtime pipeline may be substituted
+    
+    Returns:
+        tuple: (pipeline name, parameter overrides, estimate dict)
+    """
+    queue_ms = admission.estimated_wait() * 1000
+    encode_ms = cost_model.predict('encode', output_pixels / MEGAPIXEL)
+    estimate = {'queue_ms': round(queue_ms, 1), 'encode_ms': round(encode_ms, 1)}
+    shading_pipeline = pipelines[pipeline_name]
+    overrides = {}
+    if deadline_ms is None:
+        estimate.update(cost_model.estimate(shading_pipeline, params, source_shape))
+    else:
+        budget_ms = deadline_ms - elapsed_ms - queue_ms - encode_ms
+        fallback = pipelines.get(REALTIME_PIPELINE) if allow_fallback else None
+        choice = cost_model.fit_budget(shading_pipeline, params, source_shape, budget_ms, fallback)
+        pipeline_name = choice['pipeline'].name
+        overrides = {key: value for key, value in choice['params'].items() if params.get(key) != value}
+        estimate.update(choice['estimate'], budget_ms=round(budget_ms, 1),
+                        degradations=choice['degradations'], fits=choice['fits'])
+    estimate['eta_ms'] = round(elapsed_ms + queue_ms + estimate['processing_ms'] + encode_ms, 1)
+    return pipeline_name, overrides, estimate
+
+@contextmanager
+def shaded_frame(img, edge_thickness, color_levels, smoothing_amount, saturation_amount, target_width=None, target_height=None, keep_ratio=True, pipeline_name=None, report=None, edge_method=None, overrides=None):
+    """
+    Shade a decoded image, in a worker process when the frame pool is running.
+    
+    Yields the processed image. With the frame pool it is a view into shared
+    memory that is only valid inside the with block, so encode it there.
+    """
+    if frame_pool.running:
+        try:
+            params = shading_params(edge_thickness, color_levels, smoothing_amount, saturation_amount, target_width, target_height, keep_ratio, edge_method, overrides)
+            with frame_pool.render(img, get_pipeline(pipeline_name), params, report) as processed_img:
+                logger.info("Cell-shading effect applied in worker process")
+                yield processed_img
+            return
+        except PoolUnavailable as e:
+            logger.info(f"Rendering in-process: {str(e)}")
+    yield shade_image_array(img, edge_thickness, color_levels, smoothing_amount, saturation_amount, target_width, target_height, keep_ratio, pipeline_name, report, edge_method, overrides)
+
+def build_output_path(original_filename, output_folder):
+    """Build the processed image path, adding the configured prefix if specified."""
+    prefix = app_config.get('default_prefix', '')
+    if prefix:
+        output_filename = f"{prefix}{original_filename}"
+    else:
+        output_filename = original_filename
+    return os.path.join(output_folder, output_filename)
+
+def save_processed_image(processed_img, original_filename, output_folder, render_key=None, replace=False):
     """
     Save the processed image to the output folder.
     
+    The encoded bytes go into the blob store and the output path is linked to
+    them, so identical renders are stored once.
+    
     Args:
         processed_img (numpy.ndarray): Processed image array
         original_filename (str): Original filename of the image
         output_folder (str): Output folder path
+        render_key (str, optional): Render cache key to register for reuse
+        replace (bool): Replace an existing output file instead of failing
     
     Returns:
-        str: Path to saved processed image
+        tuple: (path to saved processed image, content hash of the render)
     """
     try:
-        # Create output filename with prefix if specified.
-        prefix = app_config.get('default_prefix', '')
-        if prefix:
-            output_filename = f"{prefix}{original_filename}"
-        else:
-            output_filename = original_filename
-        
-        output_path = os.path.join(output_folder, output_filename)
+        output_path = build_output_path(original_filename, output_folder)
         
-        # Save the processed image.
-        success = cv2.imwrite(output_path, processed_img)
+        # Encode the processed image in the format of its extension.
+        output_ext = os.path.splitext(output_path)[1] or '.png'
+        with profiling.span('encode', 'io', format=output_ext):
+            success, buffer = cv2.imencode(output_ext, processed_img)
         if not success:
             raise ValueError(f"Failed to save image to {output_path}")
         
+        # Store once by content, then link the output path to it.
+        with profiling.span('store_render', 'io', bytes=len(buffer)):
+            content_hash, _, _ = blob_store.store_bytes(buffer.tobytes(), output_ext)
+            if render_key:
+                blob_store.add_alias(render_key, content_hash)
+            blob_store.link(content_hash, output_path, replace=replace)
+        
         logger.info(f"Processed image saved to: {output_path}")
-        return output_path
+        return output_path, content_hash
         
     except Exception as e:
         logger.error(f"Error saving processed image: {str(e)}")
@@ -315,13 +807,65 @@ def index():
 
 @app.route('/api/images', methods=['GET'])
 def get_images():
-    """Get all stored images metadata."""
+    """
+    Get stored images metadata, optionally paginated, filtered and projected.
+    
+    Query parameters (all optional, without `limit` or `cursor` every match is returned):
+        limit: Page size (1-500)
+        cursor: `next_cursor` from the previous page
+        sort: upload_time, name or size
+        order: asc or desc
+        q: Case-insensitive substring of the original name
+        min_size, max_size: File size bounds in bytes
+        uploaded_after, uploaded_before: ISO timestamp bounds
+        fields: Comma-separated list of fields to return per image
+    """
     try:
-        images = load_images_metadata()
-        return jsonify({
+        args = request.args
+        
+        # The ETag covers the metadata version and the exact query.
+        etag = hashlib.sha1(f"{image_index.version()}?{request.query_string.decode('utf-8')}".encode('utf-8')).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        
+        limit = args.get('limit', type=int)
+        cursor = args.get('cursor')
+        if cursor and limit is None:
+            limit = DEFAULT_LIMIT
+        
+        page = image_index.query(
+            sort=args.get('sort', 'upload_time'),
+            order=args.get('order', 'asc'),
+            limit=limit,
+            cursor=cursor,
+            name=args.get('q'),
+            min_size=args.get('min_size', type=int),
+            max_size=args.get('max_size', type=int),
+            uploaded_after=args.get('uploaded_after'),
+            uploaded_before=args.get('uploaded_before')
+        )
+        
+        # Field projection keeps list payloads small.
+        images = page['images']
+        fields = [field.strip() for field in args.get('fields', '').split(',') if field.strip()]
+        if fields:
+            images = [{field: img.get(field) for field in fields} for img in images]
+        
+        response = jsonify({
             'success': True,
-            'images': images
+            'images': images,
+            'next_cursor': page['next_cursor'],
+            'total': page['total']
         })
+        response.set_etag(etag)
+        return response
+    except InvalidQuery as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
     except Exception as e:
         logger.error(f"Error getting images: {str(e)}")
         return jsonify({
@@ -332,19 +876,41 @@ def get_images():
 @app.route('/api/config', methods=['GET'])
 def get_config():
     """Get application configuration."""
-    return jsonify(app_config)
+    # Never hand out the profiling admin token.
+    return jsonify({key: value for key, value in app_config.items() if key != 'profiling_admin_token'})
 
 @app.route('/api/config', methods=['PUT'])
 def update_config():
     """Update application configuration."""
     try:
         data = request.get_json()
-        if not data:
+        if not data or not isinstance(data, dict):
             return jsonify({'success': False, 'error': 'No data provided'}), 400
+        
+        # The broker backend and file decide what gets opened and the proxy list who is trusted, so they only come from config.json.
+        startup_only = sorted(key for key in data if key in STARTUP_ONLY_KEYS and data[key] != app_config.get(key))
+        if startup_only:
+            return jsonify({
+                'success': False,
+                'error': f"{', '.join(startup_only)} can only be changed in config.json and take effect on restart."
+            }), 400
+
+        # Profiling settings (and its admin token) are only read from config.json and the environment.
+        ignored = sorted(key for key in data if key.startswith('profiling_'))
+        if ignored:
+            logger.warning(f"Ignoring profiling settings in config update: {', '.join(ignored)}")
+            data = {key: value for key, value in data.items() if key not in ignored}
+
+        # Validate the merged settings first, so a bad value changes nothing.
+        candidate = dict(app_config, **data)
+        try:
+            validate_runtime_config(candidate)
+        except (TypeError, ValueError, AttributeError) as e:
+            return jsonify({'success': False, 'error': f"Invalid configuration: {str(e)}"}), 400
 
         # Update app_config with new data.
-        for key, value in data.items():
-            app_config[key] = value
+        app_config.update(data)
+        apply_runtime_config()
         
         # Save updated config to file.
         with open(app.config['CONFIG_FILE'], 'w', encoding='utf-8') as f:
@@ -358,30 +924,30 @@ def update_config():
 
 @app.route('/api/images/<int:image_id>', methods=['DELETE'])
 def delete_image(image_id):
-    """Delete image and its metadata."""
+    """Delete image, its processed renders and its metadata."""
     try:
-        images = load_images_metadata()
-        image_to_delete = None
-        
-        # Find the image to delete.
-        for img in images:
-            if img.get('id') == image_id:
-                image_to_delete = img
-                break
-        
-        if not image_to_delete:
-            return jsonify({
-                'success': False,
-                'error': 'Image not found'
-            }), 404
-        
-        # Delete the physical file.
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], image_to_delete['filename'])
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        with metadata_lock:
+            images = load_images_metadata()
+            image_to_delete = None
+            
+            # Find the image to delete.
+            for img in images:
+                if img.get('id') == image_id:
+                    image_to_delete = img
+                    break
+            
+            if not image_to_delete:
+                return jsonify({
+                    'success': False,
+                    'error': 'Image not found'
+                }), 404
+            
+            # Remove from metadata.
+            remove_image_metadata(image_id)
         
-        # Remove from metadata.
-        remove_image_metadata(image_id)
+        # Delete the original and its renders, releasing their content references.
+        # Bytes are only removed from the blob store with the last reference.
+        retention.remove_image_files(image_to_delete)
         
         return jsonify({
             'success': True,
@@ -406,28 +972,29 @@ def update_image(image_id):
                 'error': 'No data provided'
             }), 400
         
-        images = load_images_metadata()
-        image_updated = False
-        
-        # Find and update the image.
-        for img in images:
-            if img.get('id') == image_id:
-                if 'target_width' in data:
-                    img['target_width'] = int(data['target_width'])
-                if 'target_height' in data:
-                    img['target_height'] = int(data['target_height'])
-                if 'keep_ratio' in data:
-                    img['keep_ratio'] = bool(data['keep_ratio'])
-                image_updated = True
-                break
-        
-        if not image_updated:
-            return jsonify({
-                'success': False,
-                'error': 'Image not found'
-            }), 404
-        
-        save_images_metadata(images)
+        with metadata_lock:
+            images = load_images_metadata()
+            image_updated = False
+            
+            # Find and update the image.
+            for img in images:
+                if img.get('id') == image_id:
+                    if 'target_width' in data:
+                        img['target_width'] = int(data['target_width'])
+                    if 'target_height' in data:
+                        img['target_height'] = int(data['target_height'])
+                    if 'keep_ratio' in data:
+                        img['keep_ratio'] = bool(data['keep_ratio'])
+                    image_updated = True
+                    break
+            
+            if not image_updated:
+                return jsonify({
+                    'success': False,
+                    'error': 'Image not found'
+                }), 404
+            
+            save_images_metadata(images)
         
         return jsonify({
             'success': True,
@@ -443,7 +1010,15 @@ def update_image(image_id):
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    """Handle file upload and process image with cell-shading effect."""
+    """
+    Handle file upload and process image with cell-shading effect.
+    
+    The response includes an `estimate` of the render time from the learned
+    cost model. With a `deadline_ms` form field, cheaper variants of the render
+    are picked to meet it and listed under `degradations`.
+    With `distributed_processing` the render runs on a worker node.
+    """
+    started = time.perf_counter()
     try:
         # Check if file was uploaded.
         if 'file' not in request.files:
@@ -465,6 +1040,12 @@ def upload_file():
         color_levels = int(request.form.get('color_levels', app_config.get('default_color_levels', 8)))
         smoothing_amount = int(request.form.get('smoothing_amount', app_config.get('default_smoothing', 7)))
         saturation_amount = float(request.form.get('saturation_amount', app_config.get('default_colorful', 1.0)))
+        edge_method = request.form.get('edge_method') or app_config.get('default_edge_method', 'adaptive')
+        if edge_method not in shading.EDGE_METHODS:
+            return jsonify({
+                'success': False,
+                'error': f"Edge method must be one of: {', '.join(shading.EDGE_METHODS)}."
+            }), 400
         
         # Get sizing parameters from form.
         target_width = request.form.get('target_width')
@@ -472,25 +1053,13 @@ def upload_file():
         keep_ratio = request.form.get('keep_ratio', '1') == '1'
         
         # Convert and validate sizing parameters.
-        if target_width:
-            target_width = int(target_width)
-            if target_width <= 0 or target_width > 3840:
-                return jsonify({
-                    'success': False,
-                    'error': 'Target width must be between 1 and 3840 pixels.'
-                }), 400
-        else:
-            target_width = None
-            
-        if target_height:
-            target_height = int(target_height)
-            if target_height <= 0 or target_height > 2160:
-                return jsonify({
-                    'success': False,
-                    'error': 'Target height must be between 1 and 2160 pixels.'
-                }), 400
-        else:
-            target_height = None
+        try:
+            target_width, target_height = parse_target_size(target_width, target_height)
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
         
         # Validate processing parameters.
         edge_thickness = max(1, min(10, edge_thickness))
@@ -498,18 +1067,50 @@ def upload_file():
         smoothing_amount = max(1, min(15, smoothing_amount))
         saturation_amount = max(0.0, min(2.0, saturation_amount))
         
-        # Save uploaded file.
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        unique_filename = f"{timestamp}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(file_path)
+        # Optional latency budget for the whole request.
+        deadline_ms = request.form.get('deadline_ms')
+        if deadline_ms:
+            deadline_ms = int(deadline_ms)
+            if deadline_ms <= 0:
+                return jsonify({
+                    'success': False,
+                    'error': 'Deadline must be a positive number of milliseconds.'
+                }), 400
+        else:
+            deadline_ms = None
         
-        logger.info(f"File uploaded: {file_path}")
+        # Resolve the processing pipeline, from the form or the config default.
+        requested_pipeline = request.form.get('pipeline') or None
+        requested_mode = request.form.get('mode') or None
+        try:
+            pipeline_name = get_pipeline(requested_pipeline).name
+            if requested_mode:
+                processing_mode(requested_mode)
+        except (PipelineError, ValueError) as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+        if requested_pipeline and requested_mode:
+            return jsonify({
+                'success': False,
+                'error': 'Give either a pipeline or a mode, not both.'
+            }), 400
+        
+        # Shed load before touching the disk when the local processing queue is full.
+        # Brokered renders are bounded by the broker queue depth in render_on_workers().
+        if broker is None:
+            admission.check_capacity()
+        
+        # Save uploaded file - hashed while streaming and stored once per distinct content.
+        filename = secure_filename(file.filename)
+        unique_filename, file_path, content_hash, file_size, is_new_content = store_uploaded_file(file)
         
         # Get original image dimensions.
-        original_img = cv2.imread(file_path)
+        with profiling.span('decode', 'io'):
+            original_img = cv2.imread(file_path)
         if original_img is None:
+            discard_uploaded_file(unique_filename, content_hash)
             return jsonify({
                 'success': False,
                 'error': 'Could not read uploaded image.'
@@ -518,16 +1119,18 @@ def upload_file():
         original_dims = {'width': original_width, 'height': original_height}
         
         # Save image metadata for persistence.
+        image_entry = None
         try:
-            add_image_metadata(
+            image_entry = add_image_metadata(
                 filename=unique_filename,
                 original_name=file.filename,
-                file_size=file.content_length or os.path.getsize(file_path),
+                file_size=file_size,
                 width=original_width,
                 height=original_height,
                 target_width=target_width,
                 target_height=target_height,
-                keep_ratio=keep_ratio
+                keep_ratio=keep_ratio,
+                content_hash=content_hash
             )
         except Exception as e:
             logger.warning(f"Could not save image metadata: {str(e)}")
@@ -563,23 +1166,119 @@ def upload_file():
             final_width = original_width
             final_height = original_height
         
+        # Without an explicit pipeline the mode decides, explicit previews default to `preview_mode`.
+        mode = 'quality'
+        if not requested_pipeline:
+            mode = processing_mode(requested_mode, request.form.get('priority'))
+            if mode == 'realtime':
+                # The realtime pipeline always draws Sobel edges.
+                pipeline_name = REALTIME_PIPELINE
+                edge_method = 'sobel'
+        
         # Create cell-shaded output folder.
         output_folder = create_cell_shaded_folder(file_path)
         
-        # Apply cell-shading effect with sizing parameters.
-        processed_img = apply_cell_shading(
-            file_path,
-            edge_thickness,
-            color_levels,
-            smoothing_amount,
-            saturation_amount,
-            final_width if final_width != original_width else None,
-            final_height if final_height != original_height else None,
-            keep_ratio
-        )
+        # Reuse an identical earlier render of the same content when one exists.
+        render_parameters = {
+            'edge_thickness': edge_thickness,
+            'color_levels': color_levels,
+            'smoothing_amount': smoothing_amount,
+            'saturation_amount': saturation_amount,
+            'width': final_width,
+            'height': final_height
+        }
+        if edge_method != 'adaptive':
+            render_parameters['edge_method'] = edge_method
+        if pipeline_name != DEFAULT_PIPELINE:
+            render_parameters['pipeline'] = pipeline_name
+        output_ext = os.path.splitext(filename)[1]
+        render_key = render_cache_key(content_hash, render_cache_parameters(render_parameters), output_ext)
+        render_hash = blob_store.find_alias(render_key)
+        
+        # Predict the render time and, with a deadline, pick cheaper variants that meet it.
+        render_width = final_width if final_width != original_width else None
+        render_height = final_height if final_height != original_height else None
+        overrides = {}
+        estimate = None
+        if render_hash is None:
+            params = shading_params(edge_thickness, color_levels, smoothing_amount, saturation_amount, render_width, render_height, keep_ratio, edge_method)
+            chosen_pipeline, overrides, estimate = estimate_render(
+                original_img.shape, pipeline_name, params, final_width * final_height,
+                deadline_ms, (time.perf_counter() - started) * 1000, allow_fallback=not requested_pipeline
+            )
+            if chosen_pipeline != pipeline_name or overrides:
+                if chosen_pipeline != pipeline_name:
+                    # The realtime pipeline always draws Sobel edges.
+                    pipeline_name, mode, edge_method = chosen_pipeline, 'realtime', 'sobel'
+                    render_parameters.update(pipeline=pipeline_name, edge_method=edge_method)
+                # Degraded renders are cached under their own parameters.
+                render_parameters.update(overrides)
+                render_key = render_cache_key(content_hash, render_cache_parameters(render_parameters), output_ext)
+                render_hash = blob_store.find_alias(render_key)
+        cached_render = render_hash is not None
+        
+        if cached_render:
+            output_path = build_output_path(unique_filename, output_folder)
+            try:
+                blob_store.link(render_hash, output_path)
+                logger.info(f"Reused cached render {render_hash[:12]} for {output_path}")
+            except KeyError:
+                # The cached render was evicted in the meantime - render it again.
+                cached_render = False
+        
+        pipeline_report = {}
+        if not cached_render and broker is not None:
+            # A worker node renders and stores the image, this node only waits for the result,
+            # so the job is bounded by the broker queue depth rather than a local slot.
+            result = render_on_workers([render_job(
+                file_path, unique_filename, output_folder, render_key,
+                edge_thickness=edge_thickness, color_levels=color_levels, smoothing_amount=smoothing_amount,
+                saturation_amount=saturation_amount, target_width=render_width, target_height=render_height,
+                keep_ratio=keep_ratio, pipeline_name=pipeline_name, edge_method=edge_method, overrides=overrides
+            )])[0]
+            output_path, render_hash, pipeline_report, encode_ms = result['output_path'], result['content_hash'], result['pipeline'], result['encode_ms']
+        elif not cached_render:
+            # Wait for processing capacity, cheap previews ahead of full renders.
+            with admission.slot(get_client_id(), final_width * final_height, request.form.get('priority')):
+                logger.info(f"Processing image: {file_path}")
+                logger.info(f"Parameters - Edge thickness: {edge_thickness}, Color levels: {color_levels}, Smoothing: {smoothing_amount}, Saturation: {saturation_amount}")
+                
+                # Apply cell-shading effect with sizing parameters to the already decoded upload.
+                with shaded_frame(
+                    original_img,
+                    edge_thickness,
+                    color_levels,
+                    smoothing_amount,
+                    saturation_amount,
+                    render_width,
+                    render_height,
+                    keep_ratio,
+                    pipeline_name,
+                    pipeline_report,
+                    edge_method,
+                    overrides
+                ) as processed_img:
+                    # Save processed image, encoding straight from the worker's output.
+                    encode_started = time.perf_counter()
+                    output_path, render_hash = save_processed_image(processed_img, unique_filename, output_folder, render_key)
+                    encode_ms = (time.perf_counter() - encode_started) * 1000
+        
+        if not cached_render:
+            # Learn from the measured stage and encode times.
+            if pipeline_report.get('timings_ms'):
+                params = shading_params(edge_thickness, color_levels, smoothing_amount, saturation_amount, render_width, render_height, keep_ratio, edge_method, overrides)
+                cost_model.learn(pipelines[pipeline_name], params, original_img.shape, pipeline_report['timings_ms'])
+            cost_model.observe('encode', final_width * final_height / MEGAPIXEL, encode_ms)
         
-        # Save processed image.
-        output_path = save_processed_image(processed_img, file.filename, output_folder)
+        # Track the render on its source image so its blob reference can be released later.
+        if image_entry:
+            add_render_metadata(image_entry['id'], {
+                'filename': os.path.basename(output_path),
+                'file_path': output_path.replace('\\', '/'),
+                'content_hash': render_hash,
+                'parameters': render_parameters,
+                'created': datetime.now().isoformat()
+            })
         
         # Return success response with dimension information.
         return jsonify({
@@ -589,17 +1288,36 @@ def upload_file():
             'processed_path': output_path,
             'original_dims': original_dims,
             'final_dims': final_dims,
+            'content_hash': content_hash,
+            'deduplicated': not is_new_content,
+            'cached_render': cached_render,
+            'pipeline': pipeline_report or {'name': pipeline_name},
+            'estimate': estimate,
+            'degradations': (estimate or {}).get('degradations', []),
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
             'parameters': {
                 'edge_thickness': edge_thickness,
                 'color_levels': color_levels,
                 'smoothing_amount': smoothing_amount,
                 'saturation_amount': saturation_amount,
+                'edge_method': edge_method,
+                'mode': mode,
+                'deadline_ms': deadline_ms,
                 'target_width': target_width,
                 'target_height': target_height,
                 'keep_ratio': keep_ratio
             }
         })
         
+    except AdmissionRejected as e:
+        logger.warning(f"Upload rejected by admission control: {str(e)}")
+        return admission_rejected_response(e)
+    except TimeoutError as e:
+        logger.warning(f"Upload render timed out on worker nodes: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 504
     except Exception as e:
         logger.error(f"Error processing upload: {str(e)}")
         return jsonify({
@@ -607,20 +1325,350 @@ def upload_file():
             'error': str(e)
         }), 500
 
+@app.route('/api/sweep', methods=['POST'])
+def parameter_sweep():
+    """
+    Render one image over ranges of processing parameters and build a labeled contact sheet.
+    
+    The source is either `image_id` of a stored image or an uploaded `file`.
+    Each of `edge_thickness`, `color_levels`, `smoothing_amount` and
+    `saturation_amount` takes a single value, a comma list ('3,5,7'), an
+    inclusive range ('3:9:2') or a JSON list, defaulting to the config value.
+    `edge_method` picks one edge backend for all variants, and `pipeline` a
+    registered pipeline (defaulting to `default_pipeline`) or `mode` the
+    processing mode ('realtime' always uses Sobel edges).
+    Without `target_width`/`target_height` the image is downscaled so its
+    longest side is at most `sweep_preview_max_side`.
+    With `distributed_processing` each variant is a separate render job for
+    the worker nodes instead of a shared-stage sweep on this node.
+    """
+    try:
+        data = request.get_json(silent=True) or request.form.to_dict()
+        
+        # Parse parameter ranges with the same limits as /upload, never expanding more values than a sweep may have.
+        max_variants = int(app_config.get('sweep_max_variants', 36))
+        try:
+            edge_values = sweep.parse_values(data.get('edge_thickness'), int, 1, 10, app_config.get('default_edge_thickness', 7), max_variants)
+            color_values = sweep.parse_values(data.get('color_levels'), int, 2, 20, app_config.get('default_color_levels', 8), max_variants)
+            smoothing_values = sweep.parse_values(data.get('smoothing_amount'), int, 1, 15, app_config.get('default_smoothing', 7), max_variants)
+            saturation_values = sweep.parse_values(data.get('saturation_amount'), float, 0.0, 2.0, app_config.get('default_colorful', 1.0), max_variants)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': f"Invalid sweep range: {str(e)}"}), 400
+        edge_method = data.get('edge_method') or app_config.get('default_edge_method', 'adaptive')
+        if edge_method not in shading.EDGE_METHODS:
+            return jsonify({'success': False, 'error': f"Edge method must be one of: {', '.join(shading.EDGE_METHODS)}."}), 400
+        requested_pipeline = data.get('pipeline') or None
+        if requested_pipeline and data.get('mode'):
+            return jsonify({'success': False, 'error': 'Give either a pipeline or a mode, not both.'}), 400
+        try:
+            pipeline_name = get_pipeline(requested_pipeline).name
+            requested_mode = processing_mode(data['mode']) if data.get('mode') else None
+            # Same size limits as /upload, checked before anything is stored or decoded.
+            target_width, target_height = parse_target_size(data.get('target_width'), data.get('target_height'))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        variant_count = len(edge_values) * len(color_values) * len(smoothing_values) * len(saturation_values)
+        if variant_count > max_variants:
+            return jsonify({
+                'success': False,
+                'error': f"Sweep has {variant_count} variants, the maximum is {max_variants}."
+            }), 400
+        
+        # Shed load before touching the disk when the local processing queue is full.
+        # Brokered renders are bounded by the broker queue depth in render_on_workers().
+        if broker is None:
+            admission.check_capacity()
+        
+        # Resolve the source image - a stored image or a new upload.
+        file = request.files.get('file')
+        if file and file.filename:
+            if not allowed_file(file.filename):
+                return jsonify({'success': False, 'error': 'Invalid file type.'}), 400
+            unique_filename, file_path, content_hash, file_size, _ = store_uploaded_file(file)
+            image_entry = None
+        elif data.get('image_id'):
+            image_id = int(data.get('image_id'))
+            image_entry = next((img for img in load_images_metadata() if img.get('id') == image_id), None)
+            if not image_entry:
+                return jsonify({'success': False, 'error': 'Image not found'}), 404
+            unique_filename = image_entry['filename']
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+            content_hash = image_entry.get('content_hash')
+        else:
+            return jsonify({'success': False, 'error': 'Provide an image_id or a file.'}), 400
+        
+        with profiling.span('decode', 'io'):
+            img = cv2.imread(file_path)
+        if img is None:
+            if image_entry is None:
+                discard_uploaded_file(unique_filename, content_hash)
+            return jsonify({'success': False, 'error': 'Could not read source image.'}), 400
+        original_height, original_width = img.shape[:2]
+        
+        if image_entry is None:
+            try:
+                image_entry = add_image_metadata(unique_filename, file.filename, file_size, original_width, original_height, content_hash=content_hash)
+            except Exception as e:
+                logger.warning(f"Could not save image metadata: {str(e)}")
+        
+        # Sweeps are for comparing settings, so default to a preview-sized render.
+        if target_width is None and target_height is None:
+            max_side = int(app_config.get('sweep_preview_max_side', 800))
+            if max(original_width, original_height) > max_side:
+                if original_width >= original_height:
+                    target_width = max_side
+                else:
+                    target_height = max_side
+        keep_ratio = str(data.get('keep_ratio', '1')).lower() in ('1', 'true')
+        
+        output_folder = create_cell_shaded_folder(file_path)
+        base_name, source_ext = os.path.splitext(unique_filename)
+        output_ext = source_ext.lower() if source_ext.lower() in ('.png', '.jpg', '.jpeg', '.bmp', '.tiff') else '.png'
+        sweep_id = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        started = time.perf_counter()
+        
+        # Cost scales with the number of variants at the render size.
+        render_size = shading.compute_target_size(original_width, original_height, target_width, target_height, keep_ratio) or (original_width, original_height)
+        
+        # Sweeps tune the look of the full render, so they only use `preview_mode` when asked to.
+        mode = 'quality'
+        if not requested_pipeline:
+            mode = processing_mode(requested_mode, data.get('priority'))
+            if mode == 'realtime':
+                pipeline_name, edge_method = REALTIME_PIPELINE, 'sobel'
+        
+        if broker is not None:
+            # One render job per variant, so the batch spreads over the worker nodes.
+            final_width, final_height = render_size
+            jobs, renders = [], []
+            for params in sweep.plan_sweep(edge_values, color_values, smoothing_values, saturation_values):
+                render_parameters = dict(params, width=final_width, height=final_height)
+                if edge_method != 'adaptive':
+                    render_parameters['edge_method'] = edge_method
+                if pipeline_name != DEFAULT_PIPELINE:
+                    render_parameters['pipeline'] = pipeline_name
+                render_key = render_cache_key(content_hash, render_cache_parameters(render_parameters), output_ext) if content_hash else None
+                label = f"e{params['edge_thickness']}_c{params['color_levels']}_s{params['smoothing_amount']}_sat{params['saturation_amount']:.2f}"
+                jobs.append(render_job(
+                    file_path, f"{base_name}_sweep_{sweep_id}_{label}{output_ext}", output_folder, render_key,
+                    target_width=target_width, target_height=target_height, keep_ratio=keep_ratio,
+                    pipeline_name=pipeline_name,
+                    edge_method=edge_method, **params
+                ))
+                renders.append({'parameters': params, 'render_parameters': render_parameters})
+            results = render_on_workers(jobs)
+            for render, result in zip(renders, results):
+                render.update(processed_path=result['output_path'], content_hash=result['content_hash'])
+            stages = {'render_jobs': len(jobs)}
+            timings = {'workers': round((time.perf_counter() - started) * 1000, 1)}
+            
+            # The contact sheet is built here from the renders the workers stored.
+            with profiling.span('contact_sheet'):
+                sheet = sweep.build_contact_sheet([(render['parameters'], cv2.imread(render['processed_path'])) for render in renders])
+            sheet_path, sheet_hash = save_processed_image(sheet, f"{base_name}_sweep_{sweep_id}_contact.jpg", output_folder)
+        else:
+            with admission.slot(get_client_id(), render_size[0] * render_size[1] * variant_count, 'full'):
+                # Shared first stage - resize once for every variant.
+                with profiling.span('resize'):
+                    img = shading.resize_image(img, target_width, target_height, keep_ratio)
+                final_height, final_width = img.shape[:2]
+            
+                # The same registry pipeline as a single render, its resize step is a no-op here.
+                results, stages, timings = sweep.run_sweep(
+                    img, get_pipeline(pipeline_name), edge_values, color_values, smoothing_values, saturation_values,
+                    params=shading_params(None, None, None, None, edge_method=edge_method),
+                    max_workers=int(app_config.get('sweep_max_workers', 4))
+                )
+                with profiling.span('contact_sheet'):
+                    sheet = sweep.build_contact_sheet(results)
+            
+                # Save each variant, registering it in the render cache for later uploads.
+                renders = []
+                for params, rendered in results:
+                    render_parameters = dict(params, width=final_width, height=final_height)
+                    if edge_method != 'adaptive':
+                        render_parameters['edge_method'] = edge_method
+                    if pipeline_name != DEFAULT_PIPELINE:
+                        # Same keys as an /upload render with this pipeline, so either can reuse the other.
+                        render_parameters['pipeline'] = pipeline_name
+                    render_key = render_cache_key(content_hash, render_cache_parameters(render_parameters), output_ext) if content_hash else None
+                    label = f"e{params['edge_thickness']}_c{params['color_levels']}_s{params['smoothing_amount']}_sat{params['saturation_amount']:.2f}"
+                    output_path, render_hash = save_processed_image(rendered, f"{base_name}_sweep_{sweep_id}_{label}{output_ext}", output_folder, render_key)
+                    renders.append({'parameters': params, 'render_parameters': render_parameters, 'processed_path': output_path, 'content_hash': render_hash})
+            
+                sheet_path, sheet_hash = save_processed_image(sheet, f"{base_name}_sweep_{sweep_id}_contact.jpg", output_folder)
+        
+        # Track sweep outputs on the source image so retention can manage them.
+        if image_entry:
+            for render in renders:
+                add_render_metadata(image_entry['id'], {
+                    'filename': os.path.basename(render['processed_path']),
+                    'file_path': render['processed_path'].replace('\\', '/'),
+                    'content_hash': render['content_hash'],
+                    'parameters': render['render_parameters'],
+                    'sweep_id': sweep_id,
+                    'created': datetime.now().isoformat()
+                })
+            add_render_metadata(image_entry['id'], {
+                'filename': os.path.basename(sheet_path),
+                'file_path': sheet_path.replace('\\', '/'),
+                'content_hash': sheet_hash,
+                'parameters': {'contact_sheet': True},
+                'sweep_id': sweep_id,
+                'created': datetime.now().isoformat()
+            })
+        
+        return jsonify({
+            'success': True,
+            'message': f"Rendered {len(renders)} variant(s)",
+            'sweep_id': sweep_id,
+            'image_id': image_entry['id'] if image_entry else None,
+            'contact_sheet_path': sheet_path,
+            'final_dims': {'width': final_width, 'height': final_height},
+            'mode': mode,
+            'pipeline': pipeline_name,
+            'renders': [{'parameters': r['parameters'], 'processed_path': r['processed_path']} for r in renders],
+            'stage_runs': stages,
+            'timings_ms': dict(timings, total=round((time.perf_counter() - started) * 1000, 1))
+        })
+        
+    except AdmissionRejected as e:
+        logger.warning(f"Sweep rejected by admission control: {str(e)}")
+        return admission_rejected_response(e)
+    except TimeoutError as e:
+        logger.warning(f"Sweep renders timed out on worker nodes: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 504
+    except Exception as e:
+        logger.error(f"Error running parameter sweep: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.before_request
+def start_request_trace():
+    """Tag processing requests with a request id and trace them when profiled or sampled."""
+    if request.endpoint not in TRACED_ENDPOINTS:
+        return
+    g.request_id = profiler.new_request_id()
+    g.client_request_id = profiler.client_request_id(request.headers.get('X-Request-Id'))
+    capture = (request.headers.get('X-Profile') == '1' or request.args.get('profile') == '1') and \
+              profiler.authorized(request.headers.get('X-Profile-Token'))
+    try:
+        g.trace, g.trace_token = profiler.begin(g.request_id, request.endpoint, capture, g.client_request_id)
+    except CaptureBusy as e:
+        # One cProfile capture at a time per process - ask the client to retry instead of rendering unprofiled.
+        logger.warning(f"Profile capture refused: {str(e)}")
+        response = jsonify({'success': False, 'error': f"{str(e)} Try again shortly."})
+        response.status_code = 409
+        response.headers['Retry-After'] = '1'
+        return response
+
+@app.after_request
+def tag_request_trace(response):
+    """Return the request id, and where to fetch the trace when one is being captured."""
+    if g.get('request_id'):
+        response.headers['X-Request-Id'] = g.request_id
+        if g.get('client_request_id'):
+            response.headers['X-Client-Request-Id'] = g.client_request_id
+        trace = g.get('trace')
+        if trace is not None:
+            trace.status = response.status_code
+            if trace.profiler:
+                response.headers['X-Trace-Url'] = url_for('get_trace', request_id=g.request_id)
+    return response
+
+@app.teardown_request
+def finish_request_trace(error):
+    """Stop profiling and save the trace after the response is built."""
+    if g.get('trace') is not None:
+        profiler.finish(g.trace, g.trace_token)
+        g.trace = None
+
+def profiling_forbidden():
+    """403 response unless profiling is enabled and the admin token matches."""
+    token = request.headers.get('X-Profile-Token') or request.args.get('token')
+    if profiler.authorized(token):
+        return None
+    return jsonify({'success': False, 'error': 'Profiling is disabled or the admin token is invalid.'}), 403
+
+@app.route('/api/traces', methods=['GET'])
+def list_traces():
+    """List captured traces and recent sampled traces."""
+    forbidden = profiling_forbidden()
+    if forbidden:
+        return forbidden
+    try:
+        return jsonify({'success': True, **profiler.list_traces(request.args.get('limit', 50, type=int))})
+    except Exception as e:
+        logger.error(f"Error listing traces: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/traces/<request_id>', methods=['GET'])
+def get_trace(request_id):
+    """Chrome trace-event JSON for a request, for chrome://tracing or ui.perfetto.dev."""
+    forbidden = profiling_forbidden()
+    if forbidden:
+        return forbidden
+    try:
+        trace = profiler.get_trace(request_id)
+        if trace is None:
+            return jsonify({'success': False, 'error': 'Trace not found'}), 404
+        return jsonify(trace)
+    except Exception as e:
+        logger.error(f"Error getting trace {request_id}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/traces/<request_id>/profile', methods=['GET'])
+def get_trace_profile(request_id):
+    """cProfile report of a captured request - text by default, raw pstats with ?format=prof."""
+    forbidden = profiling_forbidden()
+    if forbidden:
+        return forbidden
+    try:
+        if request.args.get('format') == 'prof':
+            path = profiler.profile_path(request_id)
+            if not path:
+                return jsonify({'success': False, 'error': 'Profile not found'}), 404
+            return send_file(os.path.abspath(path), as_attachment=True, download_name=f"{request_id}.prof")
+        
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in ('cumulative', 'tottime', 'calls'):
+            return jsonify({'success': False, 'error': 'Sort must be cumulative, tottime or calls.'}), 400
+        report = profiler.profile_report(request_id, sort, request.args.get('limit', 40, type=int))
+        if report is None:
+            return jsonify({'success': False, 'error': 'Profile not found'}), 404
+        return app.response_class(report, mimetype='text/plain')
+    except Exception as e:
+        logger.error(f"Error getting profile {request_id}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def resolve_upload_path(filename):
+    """
+    Absolute path of an uploaded file or processed image to serve, or None.
+    
+    Looks in the uploads folder, then its cell-shaded subfolder, and records
+    the access for retention.
+    """
+    for folder in (app.config['UPLOAD_FOLDER'], os.path.join(app.config['UPLOAD_FOLDER'], 'cell-shaded')):
+        file_path = os.path.join(folder, filename)
+        if os.path.isfile(file_path):
+            retention.touch(filename)
+            return os.path.abspath(file_path)
+    return None
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """Serve uploaded files and processed images."""
     try:
-        # Check if file exists in uploads folder
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        if os.path.exists(file_path):
+        file_path = resolve_upload_path(filename)
+        if file_path:
             return send_file(file_path)
         
-        # Check if file exists in cell-shaded subfolder
-        cell_shaded_path = os.path.join(app.config['UPLOAD_FOLDER'], 'cell-shaded', filename)
-        if os.path.exists(cell_shaded_path):
-            return send_file(cell_shaded_path)
-        
         # File not found
         return jsonify({'error': 'File not found'}), 404
         
@@ -628,14 +1676,91 @@ def uploaded_file(filename):
         logger.error(f"Error serving file {filename}: {str(e)}")
         return jsonify({'error': 'Error serving file'}), 500
 
-@app.route('/health')
-def health_check():
-    """Health check endpoint for monitoring."""
+@app.route('/api/cost-model', methods=['GET'])
+def get_cost_model():
+    """Get the learned per-stage cost coefficients."""
     return jsonify({
+        'success': True,
+        'cost_model': cost_model.stats()
+    })
+
+@app.route('/api/broker', methods=['GET'])
+def get_broker_stats():
+    """Get job counts and busy worker nodes of the render job broker."""
+    try:
+        if broker is None:
+            return jsonify({
+                'success': False,
+                'error': 'Distributed processing is not enabled.'
+            }), 404
+        return jsonify({
+            'success': True,
+            'broker': broker.stats()
+        })
+    except Exception as e:
+        logger.error(f"Error getting broker stats: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/storage', methods=['GET'])
+def get_storage_stats():
+    """Get storage usage, quotas and the last retention sweep report."""
+    try:
+        return jsonify({
+            'success': True,
+            'storage': retention.stats()
+        })
+    except Exception as e:
+        logger.error(f"Error getting storage stats: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def admin_forbidden():
+    """403 response unless the request carries the CELLSHADER_ADMIN_TOKEN set on the server."""
+    expected = os.environ.get('CELLSHADER_ADMIN_TOKEN', '')
+    token = request.headers.get('X-Admin-Token', '')
+    if expected and token and hmac.compare_digest(token, expected):
+        return None
+    return jsonify({'success': False, 'error': 'Admin token missing or invalid.'}), 403
+
+@app.route('/api/storage/sweep', methods=['POST'])
+def run_storage_sweep():
+    """Run a retention sweep now. Pass {"dry_run": true} to only report. Needs the admin token."""
+    forbidden = admin_forbidden()
+    if forbidden:
+        return forbidden
+    try:
+        data = request.get_json(silent=True) or {}
+        report = retention.sweep(dry_run=bool(data.get('dry_run', False)))
+        return jsonify({
+            'success': True,
+            'report': report
+        })
+    except Exception as e:
+        logger.error(f"Error running storage sweep: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def health_status():
+    """Health report shared by the Flask route and the async front end."""
+    return {
         'status': 'healthy',
         'message': 'CellShader application is running',
-        'version': '2.0.0'
-    })
+        'version': '2.0.0',
+        'processing': admission.stats(),
+        'frame_pool': frame_pool.stats()
+    }
+
+@app.route('/health')
+def health_check():
+    """Health check endpoint for monitoring."""
+    return jsonify(health_status())
 
 @app.errorhandler(404)
 def not_found_error(error):
@@ -656,11 +1781,8 @@ def file_too_large(error):
     }), 413
 
 if __name__ == '__main__':
-    # Load application configuration.
-    load_app_config()
-    
-    # Create necessary directories.
-    create_upload_folder()
+    # Run start-up work through the application factory.
+    create_app()
     
     # Run the Flask application in debug mode.
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,305 @@
+# CellShader - ASGI entry point with an asyncio front end
+# Serves files and health checks on the event loop and runs Flask views on thread
+# pools, with renders on their own pool so light endpoints never wait behind them.
+#
+# uvicorn: uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+import asyncio
+import email.utils
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.security import safe_join
+
+import app as cellshader
+
+logger = logging.getLogger(__name__)
+
+# Flask endpoints that shade images - they run on the render threads.
+RENDER_ENDPOINTS = {'upload_file', 'parameter_sweep'}
+
+# Bytes read per step when streaming files and request bodies.
+CHUNK_SIZE = 256 * 1024
+
+# Request bodies up to this size stay in memory, larger ones are spooled to a temporary file.
+SPOOL_MAX_BYTES = 1024 * 1024
+
+
+class AsyncFrontEnd:
+    """
+    ASGI application in front of the Flask app.
+
+    Health checks and file downloads (`/uploads/<filename>` and `/static/...`)
+    are answered on the event loop, with file chunks read on the I/O threads.
+    Every other request goes to the Flask app through a WSGI bridge: rendering
+    endpoints on the render threads and the rest on the I/O threads, so a batch
+    of uploads cannot occupy the threads the gallery and health checks need.
+    Renders arriving while every render thread is busy are shed with a 503
+    right away, since admission control only sees them once a thread runs them.
+
+    The Flask app is created on ASGI lifespan startup, or on the first request
+    for servers without lifespan support, so importing this module has no side
+    effects (spawned shading workers import it again).
+    """
+
+    def __init__(self, factory=cellshader.create_app):
+        self.factory = factory
+        self.flask_app = None
+        self.render_executor = None
+        self.io_executor = None
+        self.render_threads = 0
+        self.renders_in_flight = 0
+        self._startup_lock = asyncio.Lock()
+
+    async def startup(self):
+        """Run the application factory and start the thread pools (once)."""
+        async with self._startup_lock:
+            if self.flask_app is not None:
+                return
+            flask_app = await asyncio.get_running_loop().run_in_executor(None, self.factory)
+            config = cellshader.app_config
+            # Enough render threads for every admitted and queued render, so admission control still decides.
+            render_threads = int(config.get('async_render_threads', 0)) or (
+                int(config.get('processing_max_concurrent', 2)) + int(config.get('processing_max_queue', 8)))
+            io_threads = max(1, int(config.get('async_io_threads', 8)))
+            self.render_threads = render_threads
+            self.render_executor = ThreadPoolExecutor(max_workers=render_threads, thread_name_prefix='render')
+            self.io_executor = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix='io')
+            self.flask_app = flask_app
+            logger.info(f"Async front end started with {render_threads} render and {io_threads} I/O thread(s)")
+
+    def shutdown(self):
+        """Let running requests finish and stop the thread pools."""
+        for executor in (self.render_executor, self.io_executor):
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        await self.startup()
+
+        endpoint, args = self.match(scope)
+        if scope['method'] in ('GET', 'HEAD'):
+            if endpoint == 'health_check':
+                await self.send_json(send, 200, self.health())
+                return
+            if endpoint == 'uploaded_file':
+                path = await self.run_io(cellshader.resolve_upload_path, args['filename'])
+                if path:
+                    await self.send_file(scope, send, path)
+                    return
+            elif endpoint == 'static':
+                path = safe_join(self.flask_app.static_folder, args['filename'])
+                if path and await self.run_io(os.path.isfile, path):
+                    await self.send_file(scope, send, path)
+                    return
+
+        if endpoint in RENDER_ENDPOINTS:
+            if self.renders_in_flight >= self.render_threads:
+                # It would wait in the executor queue, where admission control cannot see it.
+                rejected = cellshader.admission.rejection()
+                logger.warning(f"Render shed by async front end: {str(rejected)}")
+                await self.send_json(send, 503, {'success': False, 'error': str(rejected), 'retry_after': rejected.retry_after},
+                                     [(b'retry-after', str(rejected.retry_after).encode('latin-1'))])
+                return
+            self.renders_in_flight += 1
+            try:
+                await self.call_wsgi(scope, receive, send, self.render_executor)
+            finally:
+                self.renders_in_flight -= 1
+        else:
+            await self.call_wsgi(scope, receive, send, self.io_executor)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    logger.error(f"Error starting async front end: {str(e)}")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(None, self.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def match(self, scope):
+        """Flask endpoint and view arguments for a request, or (None, {})."""
+        try:
+            return self.flask_app.url_map.bind('localhost').match(scope['path'], scope['method'])
+        except HTTPException:
+            return None, {}
+
+    def run_io(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.io_executor, func, *args)
+
+    def health(self):
+        return dict(cellshader.health_status(), front_end={
+            'render_threads': self.render_threads,
+            'io_threads': self.io_executor._max_workers,
+            'renders_in_flight': self.renders_in_flight
+        })
+
+    async def send_json(self, send, status, payload, headers=()):
+        body = json.dumps(payload).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('latin-1'))] + list(headers)
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def send_file(self, scope, send, path):
+        """Stream a file in chunks read on the I/O threads, answering If-None-Match with 304."""
+        stat = await self.run_io(os.stat, path)
+        etag = '"' + hashlib.md5(f"{path}-{stat.st_mtime_ns}-{stat.st_size}".encode('utf-8')).hexdigest() + '"'
+        headers = [
+            (b'etag', etag.encode('latin-1')),
+            (b'last-modified', email.utils.formatdate(stat.st_mtime, usegmt=True).encode('latin-1')),
+            (b'cache-control', b'no-cache')
+        ]
+        request_headers = dict(scope['headers'])
+        if request_headers.get(b'if-none-match', b'').decode('latin-1') == etag:
+            await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        headers += [(b'content-type', content_type.encode('latin-1')), (b'content-length', str(stat.st_size).encode('latin-1'))]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        if scope['method'] == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        f = await self.run_io(open, path, 'rb')
+        try:
+            while True:
+                chunk = await self.run_io(f.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            await self.run_io(f.close)
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def call_wsgi(self, scope, receive, send, executor):
+        """Run the Flask app for one request on an executor and stream its response back."""
+        body, body_length = await self.read_body(receive)
+        environ = build_environ(scope, body, body_length)
+        loop = asyncio.get_running_loop()
+        try:
+            status, headers, iterable, iterator, chunk = await loop.run_in_executor(executor, self.run_wsgi, environ)
+        finally:
+            body.close()
+
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            })
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.io_executor, next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.io_executor, iterable.close)
+
+    async def read_body(self, receive):
+        """
+        Collect the request body, spooling large ones to disk.
+
+        Bodies over Flask's MAX_CONTENT_LENGTH are drained but not kept - the
+        Content-Length header alone makes Flask answer 413.
+        """
+        limit = self.flask_app.config.get('MAX_CONTENT_LENGTH')
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if limit is None or size <= limit:
+                body.write(chunk)
+            more_body = message.get('more_body', False)
+        body.seek(0)
+        return body, size
+
+    def run_wsgi(self, environ):
+        """Call the Flask app, returning the status, headers, body iterable, its iterator and the first chunk."""
+        response = {}
+
+        def write(data):
+            raise NotImplementedError('WSGI write() is not supported')
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+            return write
+
+        iterable = self.flask_app(environ, start_response)
+        iterator = iter(iterable)
+        # Fetch the first chunk here - a generator response may only call start_response once iterated.
+        chunk = next(iterator, None)
+        return response['status'], response['headers'], iterable, iterator, chunk
+
+
+def build_environ(scope, body, body_length):
+    """WSGI environ for an ASGI HTTP scope."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    if 'CONTENT_LENGTH' not in environ and body_length:
+        environ['CONTENT_LENGTH'] = str(body_length)
+    return environ
+
+
+# The application for ASGI servers, e.g. `uvicorn asgi:app`.
+app = AsyncFrontEnd()
@@ -0,0 +1,89 @@
+# CellShader - Edge backend benchmark
+# Times every edge detection backend and the edge/color combine step at 1080p and 4K.
+#
+# Examples:
+#   python bench_edges.py
+#   python bench_edges.py --threads 4 --repeat 20 --output loadtest_results/edges.json
+
+import argparse
+import json
+import statistics
+import time
+
+import cv2
+import numpy as np
+
+import shading
+from synthetic_images import make_images
+
+SIZES = '1920x1080,3840x2160'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the edge detection backends.')
+    parser.add_argument('--sizes', default=SIZES, help='Image sizes, WIDTHxHEIGHT list')
+    parser.add_argument('--thickness', default='1,5,9', help='Edge thickness values to time')
+    parser.add_argument('--threads', type=int, default=1, help='OpenCV threads (1 = single core)')
+    parser.add_argument('--repeat', type=int, default=10, help='Timed runs per case, the median is reported')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    return parser.parse_args()
+
+
+def median_ms(func, repeat):
+    """Median wall time of func() in milliseconds, after one untimed warm-up run."""
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(times), 2)
+
+
+def combine_expanded(segmented_image, edges):
+    """The previous combine - expand the mask to 3 channels, then AND."""
+    return cv2.bitwise_and(segmented_image, cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR))
+
+
+def main():
+    args = parse_args()
+    cv2.setNumThreads(args.threads)
+    thicknesses = [int(value) for value in args.thickness.split(',')]
+    results = {'threads': args.threads, 'repeat': args.repeat, 'sizes': {}}
+
+    for image in make_images(args.sizes, seed=7):
+        img = cv2.imdecode(np.frombuffer(image['data'], np.uint8), cv2.IMREAD_COLOR)
+        smooth = shading.smooth_image(img, 7)
+        gray_blur = shading.edge_source(smooth)
+        # Cheap stand-in for quantized colors, the combine cost does not depend on them.
+        segmented = (smooth // 32) * 32
+
+        size_results = {'edge_source_ms': median_ms(lambda: shading.edge_source(smooth), args.repeat), 'edges_ms': {}}
+        for method in shading.EDGE_METHODS:
+            size_results['edges_ms'][method] = {
+                str(thickness): median_ms(lambda: shading.detect_edges(gray_blur, thickness, method), args.repeat)
+                for thickness in thicknesses
+            }
+        edges = shading.detect_edges(gray_blur, 5)
+        size_results['combine_ms'] = {
+            'expanded_3_channel': median_ms(lambda: combine_expanded(segmented, edges), args.repeat),
+            'single_channel_mask': median_ms(lambda: shading.combine_edges(segmented, edges), args.repeat)
+        }
+        results['sizes'][image['size']] = size_results
+
+        print(f"\n{image['size']} ({args.threads} OpenCV thread(s), median of {args.repeat})")
+        print(f"  edge_source: {size_results['edge_source_ms']} ms")
+        print(f"  {'backend':<10}" + ''.join(f"{'t=' + str(t):>10}" for t in thicknesses))
+        for method, timings in size_results['edges_ms'].items():
+            print(f"  {method:<10}" + ''.join(f"{timings[str(t)]:>10}" for t in thicknesses))
+        combine = size_results['combine_ms']
+        print(f"  combine: 3-channel {combine['expanded_3_channel']} ms, mask {combine['single_channel_mask']} ms")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
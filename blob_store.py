@@ -0,0 +1,343 @@
+# CellShader - Content-addressed blob store
+# Stores each distinct file once under its SHA-256 and hands out hardlinks (or copies) to it.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+from file_lock import FileLock
+
+logger = logging.getLogger(__name__)
+
+# Read size used while hashing uploads.
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobIndexError(Exception):
+    """Raised when the blob index exists but cannot be read, so it is never overwritten with an empty one."""
+
+
+class BlobStore:
+    """
+    Reference-counted, content-addressed file storage.
+
+    Blobs live at `<root>/<first two hex chars>/<sha256><ext>`. Every file handed
+    out through `link()` holds one reference, and `release()` deletes the blob once
+    the last reference is gone. Derived files (renders) can also be registered under
+    an alias key, such as a hash of source content plus processing parameters, so
+    repeated work can be looked up with `find_alias()`.
+
+    The index is shared by every process using the store (server workers and
+    worker nodes), so each read-modify-write holds a thread lock plus an
+    exclusive lock on `index.lock` next to the index. The parsed index is
+    kept between operations and only read again when the file's signature
+    (inode, size, modification time) shows another process replaced it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.index_file = os.path.join(root, 'index.json')
+        self.lock_file = os.path.join(root, 'index.lock')
+        self._lock = FileLock(self.lock_file)
+        self._index = None
+        self._index_signature = None
+
+    @contextmanager
+    def _locked(self):
+        """Hold the index lock across threads and processes."""
+        os.makedirs(self.root, exist_ok=True)
+        with self._lock:
+            try:
+                yield
+            except BaseException:
+                # A failed update may have changed the cached index without saving it.
+                self._index = None
+                raise
+
+    def store_stream(self, stream, ext=''):
+        """
+        Stream data into the store, hashing it on the way to disk.
+
+        Args:
+            stream: Readable binary file object
+            ext (str): File extension to keep on the blob, such as '.jpg'
+
+        Returns:
+            tuple: (digest, size, is_new)
+        """
+        os.makedirs(self.root, exist_ok=True)
+        hasher = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    temp_file.write(chunk)
+                    size += len(chunk)
+            return self._commit(temp_path, hasher.hexdigest(), size, ext)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def store_bytes(self, data, ext=''):
+        """Store an in-memory buffer. Returns (digest, size, is_new)."""
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256(data).hexdigest()
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(data)
+            return self._commit(temp_path, digest, len(data), ext)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def blob_path(self, digest):
+        """Return the on-disk path of a blob, or None if it is not stored."""
+        with self._locked():
+            entry = self._load_index()['blobs'].get(digest)
+        if not entry:
+            return None
+        return self._path_for(digest, entry['ext'])
+
+    def link(self, digest, dest_path, replace=False):
+        """
+        Make `dest_path` refer to a blob and take one reference on it.
+
+        A hardlink is used when the filesystem allows it, otherwise the bytes are copied.
+        The destination is created exclusively, so two callers can never end up
+        sharing one path; pass `replace=True` to atomically swap out a file the
+        caller owns. A replaced file that was itself linked to a stored blob gives
+        up its reference on that blob.
+
+        Raises:
+            KeyError: The blob is not stored
+            FileExistsError: `dest_path` exists and `replace` is False
+        """
+        with self._locked():
+            index = self._load_index()
+            entry = index['blobs'].get(digest)
+            if not entry:
+                raise KeyError(f"Blob not found: {digest}")
+            source = self._path_for(digest, entry['ext'])
+            previous = self._file_digest(dest_path) if replace and os.path.isfile(dest_path) else None
+            os.makedirs(os.path.dirname(dest_path) or '.', exist_ok=True)
+            target = f"{dest_path}.{uuid.uuid4().hex[:8]}.part" if replace else dest_path
+            try:
+                os.link(source, target)
+            except FileExistsError:
+                raise
+            except OSError:
+                # Different volume or no hardlink support - fall back to a private copy.
+                with open(source, 'rb') as src, open(target, 'xb') as dst:
+                    shutil.copyfileobj(src, dst)
+                logger.info(f"Hardlink unavailable, copied blob {digest[:12]} to {dest_path}")
+            if replace:
+                os.replace(target, dest_path)
+            entry['refs'] += 1
+            self._save_index(index)
+            if previous in index['blobs']:
+                # The replaced file held a reference of its own, such as an earlier attempt of a retried job.
+                self.release(previous)
+
+    def release(self, digest):
+        """
+        Drop one reference on a blob, deleting its bytes when none remain.
+
+        Returns:
+            bool: True if the blob itself was removed
+        """
+        with self._locked():
+            index = self._load_index()
+            entry = index['blobs'].get(digest)
+            if not entry:
+                return False
+            entry['refs'] = max(0, entry['refs'] - 1)
+            removed = False
+            if entry['refs'] == 0:
+                path = self._path_for(digest, entry['ext'])
+                if os.path.exists(path):
+                    os.remove(path)
+                del index['blobs'][digest]
+                # Forget any alias that pointed at the removed blob.
+                index['aliases'] = {key: value for key, value in index['aliases'].items() if value != digest}
+                removed = True
+                logger.info(f"Removed blob {digest[:12]} after last reference was released")
+            self._save_index(index)
+            return removed
+
+    def add_alias(self, key, digest):
+        """Register `key` (for example a render cache key) as another name for a blob."""
+        with self._locked():
+            index = self._load_index()
+            if digest in index['blobs'] and index['aliases'].get(key) != digest:
+                index['aliases'][key] = digest
+                self._save_index(index)
+
+    def find_alias(self, key):
+        """Return the blob digest registered under `key`, or None."""
+        with self._locked():
+            index = self._load_index()
+            digest = index['aliases'].get(key)
+            if digest and digest in index['blobs']:
+                return digest
+            return None
+
+    def get(self, digest):
+        """Return a copy of a blob's index entry (size, ext, refs, created), or None."""
+        with self._locked():
+            entry = self._load_index()['blobs'].get(digest)
+            return dict(entry) if entry else None
+
+    def entries(self):
+        """Return a snapshot of all blob index entries keyed by digest."""
+        with self._locked():
+            return {digest: dict(entry) for digest, entry in self._load_index()['blobs'].items()}
+
+    def collect_garbage(self, grace_seconds=3600):
+        """
+        Remove blobs nobody references and stray files the index does not know about.
+
+        Only items older than `grace_seconds` are touched, so uploads still being
+        written or linked are left alone.
+
+        Returns:
+            dict: Counts and bytes of removed blobs and stray files
+        """
+        removed = {'blobs': 0, 'stray_files': 0, 'bytes': 0}
+        if not os.path.isdir(self.root):
+            return removed
+        cutoff = datetime.now().timestamp() - grace_seconds
+        with self._locked():
+            index = self._load_index()
+            known = set()
+            for digest, entry in list(index['blobs'].items()):
+                path = self._path_for(digest, entry['ext'])
+                known.add(os.path.normpath(path))
+                if entry['refs'] > 0:
+                    continue
+                if datetime.fromisoformat(entry['created']).timestamp() > cutoff:
+                    continue
+                if os.path.exists(path):
+                    os.remove(path)
+                del index['blobs'][digest]
+                removed['blobs'] += 1
+                removed['bytes'] += entry['size']
+            index['aliases'] = {key: value for key, value in index['aliases'].items() if value in index['blobs']}
+            self._save_index(index)
+
+            # Files under the store that are not indexed blobs (interrupted writes and the like).
+            for directory, _, files in os.walk(self.root):
+                for name in files:
+                    path = os.path.normpath(os.path.join(directory, name))
+                    if path in known or path in (os.path.normpath(self.index_file), os.path.normpath(self.lock_file)):
+                        continue
+                    if os.path.getmtime(path) > cutoff:
+                        continue
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    removed['stray_files'] += 1
+                    removed['bytes'] += size
+        if removed['blobs'] or removed['stray_files']:
+            logger.info(f"Blob garbage collection removed {removed['blobs']} blob(s) and {removed['stray_files']} stray file(s)")
+        return removed
+
+    def stats(self):
+        """Return blob count, stored bytes and bytes saved by deduplication."""
+        with self._locked():
+            blobs = self._load_index()['blobs']
+            count = len(blobs)
+            stored = sum(entry['size'] for entry in blobs.values())
+            referenced = sum(entry['size'] * entry['refs'] for entry in blobs.values())
+        return {
+            'blobs': count,
+            'stored_bytes': stored,
+            'saved_bytes': max(0, referenced - stored)
+        }
+
+    def _commit(self, temp_path, digest, size, ext):
+        """Move a fully written temp file into place unless the content is already stored."""
+        with self._locked():
+            index = self._load_index()
+            entry = index['blobs'].get(digest)
+            if entry and os.path.exists(self._path_for(digest, entry['ext'])):
+                return digest, entry['size'], False
+            path = self._path_for(digest, ext.lower())
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+            # A blob whose file went missing is restored under its existing references.
+            index['blobs'][digest] = {
+                'size': size,
+                'ext': ext.lower(),
+                'refs': entry['refs'] if entry else 0,
+                'created': datetime.now().isoformat()
+            }
+            self._save_index(index)
+            return digest, size, True
+
+    def path_for(self, digest, ext):
+        """Return where a blob with this digest and extension is stored."""
+        return self._path_for(digest, ext)
+
+    def _file_digest(self, path):
+        """Return the SHA-256 of a file on disk."""
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def _path_for(self, digest, ext):
+        return os.path.join(self.root, digest[:2], f"{digest}{ext}")
+
+    def _signature(self):
+        """Identify the current index file - every save replaces it with a new inode."""
+        try:
+            stat = os.stat(self.index_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _load_index(self):
+        """Load the blob index, reusing the parsed copy while the file is unchanged. Caller must hold the lock."""
+        signature = self._signature()
+        if self._index is not None and signature == self._index_signature:
+            return self._index
+        if signature is None:
+            index = {'blobs': {}, 'aliases': {}}
+        else:
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    index = json.load(f)
+            except ValueError as e:
+                # Starting over would orphan every stored blob, so refuse instead.
+                logger.error(f"Error loading blob index: {str(e)}")
+                raise BlobIndexError(f"Blob index {self.index_file} is unreadable: {str(e)}")
+            index.setdefault('blobs', {})
+            index.setdefault('aliases', {})
+        self._index, self._index_signature = index, signature
+        return index
+
+    def _save_index(self, index):
+        """Atomically write the blob index. Caller must hold the lock."""
+        os.makedirs(self.root, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                # Compact, since the whole index is written on every change.
+                json.dump(index, f, separators=(',', ':'))
+            os.replace(temp_path, self.index_file)
+            self._index, self._index_signature = index, self._signature()
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
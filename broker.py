@@ -0,0 +1,339 @@
+# CellShader - Job broker for distributing renders to worker nodes
+# Queues processing jobs with leases, heartbeats and retries. The default backend is a
+# SQLite file on storage every node shares, so no external service is needed.
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+# Job states.
+JOB_QUEUED = 'queued'
+JOB_LEASED = 'leased'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+FINISHED_STATES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+# Longest pause between polls while waiting for a job.
+MAX_POLL_INTERVAL = 1.0
+
+
+class JobFailed(Exception):
+    """Raised while waiting for a job that failed on every attempt or was cancelled."""
+
+
+def new_worker_id():
+    """Identify a worker by host, process and a random suffix, so restarts never share an id."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class Broker(ABC):
+    """
+    Interface of a job broker.
+
+    A job is published with a kind and a JSON-serializable payload. Workers
+    claim queued jobs under a lease, renew it with heartbeats while they work,
+    and complete or fail the job. A job whose lease runs out (its worker
+    crashed or hung) is handed to the next worker until `max_attempts` is used
+    up, after which it fails.
+    """
+
+    def __init__(self):
+        self.lease_seconds = 30
+        self.max_attempts = 3
+        self.job_retention = 3600
+        self.poll_interval = 0.1
+
+    def configure(self, config):
+        """Apply broker settings from app_config."""
+        self.lease_seconds = max(1.0, float(config.get('broker_lease_seconds', 30)))
+        self.max_attempts = max(1, int(config.get('broker_max_attempts', 3)))
+        self.job_retention = max(0, float(config.get('broker_job_retention', 3600)))
+        self.poll_interval = max(0.01, float(config.get('broker_poll_interval', 0.1)))
+
+    @abstractmethod
+    def publish(self, kind, payload):
+        """Queue a job and return its id."""
+
+    @abstractmethod
+    def claim(self, worker_id, kinds=None):
+        """Lease the oldest claimable job (optionally of the given kinds), or return None."""
+
+    @abstractmethod
+    def heartbeat(self, job_id, worker_id):
+        """Extend a lease. Returns False when the worker no longer holds it."""
+
+    @abstractmethod
+    def complete(self, job_id, worker_id, result):
+        """Record a job's result. Returns False when the worker no longer holds the lease."""
+
+    @abstractmethod
+    def fail(self, job_id, worker_id, error):
+        """Record a failed attempt, queueing the job again while attempts remain."""
+
+    @abstractmethod
+    def cancel(self, job_id):
+        """Drop a job nobody waits for anymore, unless it already finished."""
+
+    @abstractmethod
+    def get(self, job_id):
+        """Return a job as a dict, or None."""
+
+    @abstractmethod
+    def prune(self):
+        """Delete finished jobs older than `job_retention` seconds. Returns the number removed."""
+
+    @abstractmethod
+    def depth(self):
+        """Number of jobs queued or running, for back-pressure."""
+
+    @abstractmethod
+    def stats(self):
+        """Job counts per state and recently active workers, for monitoring."""
+
+    def wait(self, job_id, timeout):
+        """
+        Poll until a job finishes and return its result.
+
+        Polling starts at `poll_interval` and backs off to MAX_POLL_INTERVAL,
+        so long renders do not keep the broker busy.
+
+        Raises:
+            JobFailed: The job failed or was cancelled
+            TimeoutError: The job did not finish within `timeout` seconds
+        """
+        deadline = time.monotonic() + timeout
+        interval = self.poll_interval
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                raise JobFailed(f"Job {job_id} no longer exists")
+            if job['status'] == JOB_DONE:
+                return job['result']
+            if job['status'] in FINISHED_STATES:
+                raise JobFailed(job['error'] or f"Job {job_id} was {job['status']}")
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Job {job_id} did not finish within {timeout:.0f} seconds")
+            time.sleep(min(interval, max(0.0, deadline - time.monotonic())))
+            interval = min(MAX_POLL_INTERVAL, interval * 1.5)
+
+    def wait_all(self, job_ids, timeout):
+        """Wait for several jobs under one shared timeout. Returns their results in order."""
+        deadline = time.monotonic() + timeout
+        return [self.wait(job_id, max(0.0, deadline - time.monotonic())) for job_id in job_ids]
+
+
+class SQLiteBroker(Broker):
+    """
+    Broker backed by one SQLite database file.
+
+    Every node opens the same file (for example on the NFS or SMB share that
+    already holds uploads/). Each operation uses its own short transaction,
+    and claims take the write lock up front (BEGIN IMMEDIATE) so two workers
+    never lease the same job. The default rollback journal is kept, since WAL
+    mode does not work across hosts on network filesystems.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _connect(self):
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                    with self._open() as conn:
+                        conn.execute(
+                            "CREATE TABLE IF NOT EXISTS jobs ("
+                            " id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL,"
+                            " status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+                            " worker TEXT, lease_expires REAL, result TEXT, error TEXT,"
+                            " created REAL NOT NULL, updated REAL NOT NULL)"
+                        )
+                        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+                    self._initialized = True
+        return self._open()
+
+    def _open(self):
+        # Autocommit mode, transactions are opened explicitly where they are needed.
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return _Connection(conn)
+
+    def publish(self, kind, payload):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, payload, status, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), JOB_QUEUED, now, now)
+            )
+        return job_id
+
+    def claim(self, worker_id, kinds=None):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Jobs whose lease ran out on their last attempt have failed for good.
+                conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, worker = NULL, updated = ?"
+                    " WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                    (JOB_FAILED, 'Worker lease expired', now, JOB_LEASED, now, self.max_attempts)
+                )
+                query = "SELECT * FROM jobs WHERE (status = ? OR (status = ? AND lease_expires < ?))"
+                args = [JOB_QUEUED, JOB_LEASED, now]
+                if kinds:
+                    query += f" AND kind IN ({', '.join('?' for _ in kinds)})"
+                    args.extend(kinds)
+                row = conn.execute(query + " ORDER BY created LIMIT 1", args).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                if row['status'] == JOB_LEASED:
+                    logger.warning(f"Reclaiming job {row['id']} from unresponsive worker {row['worker']}")
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ?"
+                    " WHERE id = ?",
+                    (JOB_LEASED, worker_id, now + self.lease_seconds, now, row['id'])
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        job = self._row_to_job(row)
+        job.update(status=JOB_LEASED, worker=worker_id, attempts=job['attempts'] + 1)
+        return job
+
+    def heartbeat(self, job_id, worker_id):
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? AND worker = ? AND status = ?",
+                (now + self.lease_seconds, now, job_id, worker_id, JOB_LEASED)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker_id, result):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = NULL, lease_expires = NULL, updated = ?"
+                " WHERE id = ? AND worker = ? AND status = ?",
+                (JOB_DONE, json.dumps(result), time.time(), job_id, worker_id, JOB_LEASED)
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, job_id, worker_id, error):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END,"
+                " worker = NULL, lease_expires = NULL, error = ?, updated = ?"
+                " WHERE id = ? AND worker = ? AND status = ?",
+                (self.max_attempts, JOB_FAILED, JOB_QUEUED, str(error), time.time(), job_id, worker_id, JOB_LEASED)
+            )
+
+    def cancel(self, job_id):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, updated = ?"
+                " WHERE id = ? AND status IN (?, ?)",
+                (JOB_CANCELLED, time.time(), job_id, JOB_QUEUED, JOB_LEASED)
+            )
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def prune(self):
+        cutoff = time.time() - self.job_retention
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"DELETE FROM jobs WHERE status IN ({', '.join('?' for _ in FINISHED_STATES)}) AND updated < ?",
+                (*FINISHED_STATES, cutoff)
+            )
+            return cursor.rowcount
+
+    def depth(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (JOB_QUEUED, JOB_LEASED)).fetchone()[0]
+
+    def stats(self):
+        now = time.time()
+        with self._connect() as conn:
+            counts = {row['status']: row['count'] for row in
+                      conn.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status")}
+            workers = [row['worker'] for row in conn.execute(
+                "SELECT DISTINCT worker FROM jobs WHERE status = ? AND lease_expires >= ?", (JOB_LEASED, now)
+            )]
+            oldest = conn.execute("SELECT MIN(created) AS created FROM jobs WHERE status = ?", (JOB_QUEUED,)).fetchone()
+        return {
+            'backend': 'sqlite',
+            'path': self.path,
+            'jobs': {state: counts.get(state, 0) for state in (JOB_QUEUED, JOB_LEASED) + FINISHED_STATES},
+            'busy_workers': workers,
+            'oldest_queued_seconds': round(now - oldest['created'], 1) if oldest['created'] else 0.0,
+            'lease_seconds': self.lease_seconds,
+            'max_attempts': self.max_attempts
+        }
+
+    @staticmethod
+    def _row_to_job(row):
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'payload': json.loads(row['payload']),
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'worker': row['worker'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'created': row['created'],
+            'updated': row['updated']
+        }
+
+
+class _Connection:
+    """sqlite3 connection that is closed, not just committed, when its with block ends."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self._conn.close()
+        return False
+
+
+# Broker backends by `broker_backend` name. Only names listed here can be configured.
+BROKERS = {
+    'sqlite': SQLiteBroker
+}
+
+
+def create_broker(config, default_path):
+    """
+    Build the broker named by `broker_backend` in the config (default 'sqlite').
+
+    Only called at start-up by the web app and worker.py, never from a
+    runtime config change, since the backend and file decide what gets opened.
+    """
+    backend = config.get('broker_backend', 'sqlite')
+    if backend not in BROKERS:
+        raise ValueError(f"Unknown broker backend: {backend}. Available: {', '.join(BROKERS)}")
+    broker = BROKERS[backend](config.get('broker_file') or default_path)
+    broker.configure(config)
+    return broker
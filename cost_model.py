@@ -0,0 +1,300 @@
+# CellShader - Learned render cost model
+# Predicts per-stage render times from the service's own timings, for ETAs and
+# for picking cheaper variants of a render that has to meet a deadline.
+
+import json
+import os
+import tempfile
+import threading
+import time
+import logging
+
+import shading
+
+logger = logging.getLogger(__name__)
+
+MEGAPIXEL = 1000000.0
+
+# Milliseconds per work unit (see stage_units) before anything has been measured,
+# from single-threaded runs at 1080p.
+PRIOR_MS_PER_UNIT = {
+    'resize': 1.5,
+    'smooth': 2.0,
+    'saturation': 10.0,
+    'edge_source': 10.0,
+    'edges': 3.0,
+    'quantize': 70.0,
+    'combine': 1.5,
+    'smooth_fast': 7.0,
+    'saturation_fast': 1.5,
+    'edge_source_fast': 0.5,
+    'posterize': 1.5,
+    'downscale': 1.5,
+    'upscale': 2.0,
+    'encode': 30.0
+}
+DEFAULT_MS_PER_UNIT = 10.0
+
+# Weight of the prior, in observations, so the first real timings dominate quickly.
+PRIOR_WEIGHT = 2.0
+
+# Nearest-center assignment after sampled k-means, in k-means units per megapixel.
+ASSIGN_UNITS_PER_MEGAPIXEL = 0.15
+
+# Pixels k-means is fitted on when sampling is picked to meet a deadline.
+DEADLINE_KMEANS_SAMPLE = 100000
+
+# Cheaper variants tried in order until a render fits its budget. Each entry
+# adds its parameters to those of the entries before it.
+DEGRADATIONS = [
+    ('kmeans_attempts', {'kmeans_attempts': 3}),
+    ('kmeans_sample', {'kmeans_sample': DEADLINE_KMEANS_SAMPLE}),
+    ('kmeans_attempts', {'kmeans_attempts': 1}),
+    ('processing_scale', {'processing_scale': 0.75}),
+    ('processing_scale', {'processing_scale': 0.5})
+]
+
+# Processing scales tried with the fallback (realtime) pipeline once the rest is exhausted.
+FALLBACK_SCALES = (1.0, 0.5)
+
+
+def stage_units(stage_name, params, pixels, input_pixels):
+    """
+    Work units of one stage run - the quantity its time is assumed to grow with.
+
+    Most stages are linear in output megapixels. Resizing also reads its input,
+    the bilateral filter grows with the square of its diameter, and k-means
+    with clusters times attempts (on the sampled pixels, plus an assignment pass).
+    """
+    megapixels = pixels / MEGAPIXEL
+    if stage_name in ('resize', 'downscale'):
+        return (pixels + input_pixels) / MEGAPIXEL
+    if stage_name == 'smooth':
+        return megapixels * params.get('smoothing_amount', 7) ** 2
+    if stage_name == 'quantize':
+        clusters = params.get('color_levels', 8) * (params.get('kmeans_attempts') or shading.KMEANS_ATTEMPTS)
+        sample = params.get('kmeans_sample')
+        if sample and sample < pixels:
+            return clusters * sample / MEGAPIXEL + params.get('color_levels', 8) * megapixels * ASSIGN_UNITS_PER_MEGAPIXEL
+        return clusters * megapixels
+    return megapixels
+
+
+class StageCost:
+    """
+    Fit of time_ms = base_ms + ms_per_unit * units for one stage.
+
+    Keeps exponentially decayed least-squares sums so recent timings count
+    most, starting from a prior point at one unit. Falls back to a line through
+    the origin while the observed units are too similar to fit a slope.
+    """
+
+    def __init__(self, ms_per_unit, sums=None, observations=0):
+        # Weight, sum of units, sum of ms, sum of units^2, sum of units*ms.
+        self.sums = list(sums) if sums else [PRIOR_WEIGHT, PRIOR_WEIGHT, PRIOR_WEIGHT * ms_per_unit,
+                                             PRIOR_WEIGHT, PRIOR_WEIGHT * ms_per_unit]
+        self.observations = observations
+
+    def coefficients(self):
+        """Return (base_ms, ms_per_unit)."""
+        weight, units, ms, units_sq, units_ms = self.sums
+        mean_units, mean_ms = units / weight, ms / weight
+        variance = units_sq / weight - mean_units * mean_units
+        if variance > (0.05 * mean_units) ** 2:
+            slope = (units_ms / weight - mean_units * mean_ms) / variance
+            base = mean_ms - slope * mean_units
+            if slope > 0 and base >= 0:
+                return base, slope
+        return 0.0, units_ms / units_sq if units_sq else 0.0
+
+    def predict(self, units):
+        base, slope = self.coefficients()
+        return base + slope * units
+
+    def observe(self, units, ms, decay):
+        self.sums = [value * decay for value in self.sums]
+        for index, value in enumerate((1.0, units, ms, units * units, units * ms)):
+            self.sums[index] += value
+        self.observations += 1
+
+
+class CostModel:
+    """
+    Learned per-stage costs, shared by every request of a server process.
+
+    Pipelines are estimated step by step with the critical path through their
+    branches, since independent branches run concurrently. The model is saved
+    to disk now and then, so restarts keep what was learned.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.decay = 0.97
+        self.save_interval = 60
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._last_save = time.monotonic()
+
+    def configure(self, config):
+        """Apply cost model settings from app_config."""
+        self.decay = max(0.5, min(1.0, float(config.get('cost_model_decay', 0.97))))
+        self.save_interval = max(0, float(config.get('cost_model_save_interval', 60)))
+
+    def load(self):
+        """Load learned costs saved by an earlier run, if any."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            with self._lock:
+                for name, state in data.get('stages', {}).items():
+                    self._stages[name] = StageCost(self._prior(name), state['sums'], state.get('observations', 0))
+            logger.info(f"Loaded cost model with {len(self._stages)} stage(s)")
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not load cost model: {str(e)}")
+
+    def save(self):
+        """Write the learned costs atomically."""
+        with self._lock:
+            data = {'stages': {name: {'sums': stage.sums, 'observations': stage.observations}
+                               for name, stage in self._stages.items()}}
+            self._last_save = time.monotonic()
+        folder = os.path.dirname(self.path) or '.'
+        os.makedirs(folder, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=folder, suffix='.part')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def _prior(name):
+        return PRIOR_MS_PER_UNIT.get(name, DEFAULT_MS_PER_UNIT)
+
+    def _stage(self, name):
+        """Cost of a stage, created from its prior. Caller must hold the lock."""
+        if name not in self._stages:
+            self._stages[name] = StageCost(self._prior(name))
+        return self._stages[name]
+
+    def predict(self, name, units):
+        with self._lock:
+            return self._stage(name).predict(units)
+
+    def observe(self, name, units, ms):
+        """Learn from one measured run, saving the model when it is due."""
+        if units <= 0 or ms < 0:
+            return
+        with self._lock:
+            self._stage(name).observe(units, ms, self.decay)
+            due = self.save_interval and time.monotonic() - self._last_save >= self.save_interval
+        if due:
+            try:
+                self.save()
+            except OSError as e:
+                logger.warning(f"Could not save cost model: {str(e)}")
+
+    def _runs(self, shading_pipeline, params, source_shape):
+        """
+        Stage runs of a render as (stage, units, output key, input keys), plus the final key.
+
+        A processing scale below 1.0 adds a downscale before and an upscale after
+        the pipeline, which then runs on the smaller image.
+        """
+        runs = []
+        source_pixels = source_shape[0] * source_shape[1]
+        scale = params.get('processing_scale') or 1.0
+        if scale < 1.0:
+            height, width = shading_pipeline.plan(params, source_shape).output_shape[:2]
+            final_pixels = width * height
+            source_shape = (max(1, round(height * scale)), max(1, round(width * scale)), 3)
+            params = dict(params, target_width=None, target_height=None, processing_scale=1.0)
+            runs.append(('downscale', stage_units('downscale', params, source_shape[0] * source_shape[1], source_pixels),
+                         'downscale', ('image',)))
+            source_pixels = source_shape[0] * source_shape[1]
+
+        plan = shading_pipeline.plan(params, source_shape)
+        previous = source_pixels
+        for index, step in enumerate(plan.steps):
+            units = stage_units(step.stage.name, step.params_for(params), plan.pixels[index], previous)
+            inputs = tuple('downscale' if key == 'image' and scale < 1.0 else key for key in plan.inputs[index])
+            runs.append((step.stage.name, units, plan.outputs[index], inputs))
+            previous = plan.pixels[index]
+        output = 'downscale' if plan.output == 'image' and scale < 1.0 else plan.output
+
+        if scale < 1.0:
+            runs.append(('upscale', final_pixels / MEGAPIXEL, 'upscale', (output,)))
+            output = 'upscale'
+        return runs, output
+
+    def estimate(self, shading_pipeline, params, source_shape):
+        """
+        Predict a render's processing time.
+
+        Returns:
+            dict: 'processing_ms' along the critical path and 'stages_ms' per stage
+        """
+        runs, output = self._runs(shading_pipeline, params, source_shape)
+        finish = {'image': 0.0}
+        stages = {}
+        for name, units, key, inputs in runs:
+            ms = self.predict(name, units)
+            stages[name] = round(stages.get(name, 0) + ms, 1)
+            finish[key] = max(finish.get(input_key, 0.0) for input_key in inputs) + ms
+        return {'processing_ms': round(finish.get(output, 0.0), 1), 'stages_ms': stages}
+
+    def learn(self, shading_pipeline, params, source_shape, timings_ms):
+        """Learn from the per-stage timings a pipeline run reported."""
+        runs, _ = self._runs(shading_pipeline, params, source_shape)
+        units = {}
+        for name, stage_units_, _, _ in runs:
+            units[name] = units.get(name, 0) + stage_units_
+        for name, ms in timings_ms.items():
+            if name in units:
+                self.observe(name, units[name], ms)
+
+    def fit_budget(self, shading_pipeline, params, source_shape, budget_ms, fallback_pipeline=None):
+        """
+        Pick the least degraded variant of a render predicted to finish within budget_ms.
+
+        Degradations are applied cumulatively in DEGRADATIONS order (k-means
+        ones only when the pipeline runs k-means), then the fallback pipeline is
+        tried at FALLBACK_SCALES. When nothing fits, the cheapest variant is returned.
+
+        Returns:
+            dict: 'pipeline', 'params', 'degradations' (list of 'name=value'),
+            'estimate' and 'fits'
+        """
+        uses_kmeans = any(step.stage.name == 'quantize' for step in shading_pipeline.steps)
+        candidates = [(shading_pipeline, params, [])]
+        current, applied = params, []
+        for name, overrides in DEGRADATIONS:
+            if name.startswith('kmeans') and not uses_kmeans:
+                continue
+            current = dict(current, **overrides)
+            applied = applied + [f"{key}={value}" for key, value in overrides.items()]
+            candidates.append((shading_pipeline, current, applied))
+        if fallback_pipeline is not None and fallback_pipeline is not shading_pipeline:
+            for scale in FALLBACK_SCALES:
+                degradations = [f"pipeline={fallback_pipeline.name}"] + ([f"processing_scale={scale}"] if scale < 1.0 else [])
+                candidates.append((fallback_pipeline, dict(params, processing_scale=scale) if scale < 1.0 else params, degradations))
+
+        cheapest = None
+        for candidate_pipeline, candidate_params, degradations in candidates:
+            estimate = self.estimate(candidate_pipeline, candidate_params, source_shape)
+            choice = {'pipeline': candidate_pipeline, 'params': candidate_params,
+                      'degradations': degradations, 'estimate': estimate, 'fits': estimate['processing_ms'] <= budget_ms}
+            if choice['fits']:
+                return choice
+            if cheapest is None or estimate['processing_ms'] < cheapest['estimate']['processing_ms']:
+                cheapest = choice
+        return cheapest
+
+    def stats(self):
+        """Learned coefficients per stage, for monitoring."""
+        with self._lock:
+            stages = {}
+            for name, stage in sorted(self._stages.items()):
+                base, slope = stage.coefficients()
+                stages[name] = {'base_ms': round(base, 2), 'ms_per_unit': round(slope, 3), 'observations': stage.observations}
+            return {'decay': self.decay, 'stages': stages}
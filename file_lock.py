@@ -0,0 +1,81 @@
+# CellShader - Inter-process file lock
+# Reentrant lock held across threads and processes through an exclusive lock on a file.
+
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows - lock files through msvcrt instead.
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """
+    Reentrant lock shared by every thread and process that opens the same lock file.
+
+    Threads of one process serialize on an RLock, and only the outermost
+    acquire takes the exclusive file lock, since a second lock on the same
+    file from the same process would wait for itself.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                self._file = self._lock_file()
+            except BaseException:
+                self._lock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        try:
+            if self._depth == 0:
+                lock_file, self._file = self._file, None
+                try:
+                    if fcntl:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                    else:
+                        lock_file.seek(0)
+                        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+                finally:
+                    lock_file.close()
+        finally:
+            self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def _lock_file(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        lock_file = open(self.path, 'a+b')
+        try:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                # LK_LOCK gives up after about 10 seconds, keep waiting.
+                while True:
+                    try:
+                        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        continue
+        except BaseException:
+            lock_file.close()
+            raise
+        return lock_file
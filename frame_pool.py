@@ -0,0 +1,267 @@
+# CellShader - Shared-memory frame transport for shading worker processes
+# A ring of reusable shared-memory slots, so a render hands worker processes
+# a slot number and shapes instead of pickling whole decoded frames.
+
+import multiprocessing
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+import pipeline
+import profiling
+import shading
+
+logger = logging.getLogger(__name__)
+
+# Shared memory segments attached by this worker process, indexed by slot.
+_worker_segments = []
+
+# Pipelines built by this worker process, by name.
+_worker_pipelines = {}
+
+
+class PoolUnavailable(Exception):
+    """Raised when a frame cannot go through the pool, so the caller should render in-process."""
+
+
+def _attach_worker(segment_names, opencv_threads):
+    """Worker process initializer - attach to every slot once and size the OpenCV thread pool."""
+    for name in segment_names:
+        # Spawned workers share the web process's resource tracker, which unlinks the segments if it dies.
+        _worker_segments.append(shared_memory.SharedMemory(name=name))
+    cv2.setNumThreads(opencv_threads)
+
+
+def _frame_view(segment, offset, shape):
+    """Numpy view of a BGR frame stored in a shared memory segment."""
+    return np.ndarray(shape, dtype=np.uint8, buffer=segment.buf, offset=offset)
+
+
+def _shade_slot(slot, region_bytes, input_shape, output_shape, pipeline_name, pipeline_specs, params):
+    """Worker task - run a pipeline on the frame in a slot's input region into its output region."""
+    cached = _worker_pipelines.get(pipeline_name)
+    if cached is None or cached.specs != pipeline_specs:
+        cached = _worker_pipelines[pipeline_name] = pipeline.Pipeline(pipeline_name, pipeline_specs)
+    segment = _worker_segments[slot]
+    source = _frame_view(segment, 0, input_shape)
+    output = _frame_view(segment, region_bytes, output_shape)
+    report = {}
+    start = time.perf_counter()
+    cached.run(source, params, out=output, report=report)
+    report['worker_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return report
+
+
+class _Ring:
+    """One generation of worker processes and the shared memory slots they attached to."""
+
+    def __init__(self, executor, segments):
+        self.executor = executor
+        self.segments = segments
+        self.free = queue.Queue()
+        for slot in range(len(segments)):
+            self.free.put(slot)
+        # Set once the ring is replaced or stopped, its slots are freed when the last one comes back.
+        self.retired = False
+
+
+class SharedFramePool:
+    """
+    Process pool for shading with frames passed through shared memory.
+
+    Each slot is one shared memory segment with an input region and an output
+    region, each large enough for `slot_pixels` BGR pixels. A render copies the
+    decoded frame into a free slot, the worker reads it in place and writes the
+    final image straight into the output region, and the caller encodes from
+    that region before the slot goes back to the ring. Only the slot number,
+    shapes and parameters cross the process boundary.
+
+    When a worker dies the ring is retired: renders holding its slots finish
+    with them, the segments are unlinked once the last slot is back, and the
+    next render starts a new ring.
+    """
+
+    def __init__(self):
+        self.workers = 0
+        self.slot_count = 0
+        self.slot_pixels = 3840 * 2160
+        self.slot_timeout = 30
+        self._ring = None
+        self._started = False
+        self._opencv_threads = 1
+        self._lock = threading.Lock()
+        self._stats = {'renders': 0, 'fallbacks': 0, 'rebuilds': 0, 'worker_ms': 0.0}
+
+    @property
+    def region_bytes(self):
+        return self.slot_pixels * 3
+
+    @property
+    def running(self):
+        return self._started
+
+    def configure(self, config):
+        """Read pool settings from app_config. They take effect on the next start()."""
+        self.workers = max(0, int(config.get('processing_workers', 0)))
+        self.slot_count = max(self.workers, int(config.get('processing_slots', 0)) or self.workers * 2)
+        self.slot_pixels = max(1, int(config.get('processing_slot_pixels', 3840 * 2160)))
+        self.slot_timeout = float(config.get('processing_slot_timeout', 30))
+
+    def start(self, opencv_threads=1):
+        """Allocate the slot ring and start the worker processes (no-op when workers is 0)."""
+        with self._lock:
+            if self._started or self.workers <= 0:
+                return
+            self._started = True
+            self._opencv_threads = max(1, opencv_threads)
+            self._start_ring()
+
+    def stop(self):
+        """Stop the workers and free the shared memory once no render holds a slot."""
+        with self._lock:
+            self._started = False
+            ring, self._ring = self._ring, None
+            if ring is None:
+                return
+            self._retire(ring)
+            logger.info("Stopped shading workers")
+
+    def _start_ring(self):
+        """Allocate slots and start worker processes for them. Caller must hold the lock."""
+        size = self.region_bytes * 2
+        segments = [shared_memory.SharedMemory(create=True, size=size) for _ in range(self.slot_count)]
+        # Spawn rather than fork - the web process has threads and OpenCV state that must not be copied.
+        executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_attach_worker,
+            initargs=([segment.name for segment in segments], self._opencv_threads)
+        )
+        self._ring = _Ring(executor, segments)
+        logger.info(f"Started {self.workers} shading worker(s) with {self.slot_count} shared slot(s) "
+                    f"of {size / 1048576:.0f} MB")
+
+    def _current_ring(self):
+        """Return the ring renders should use, starting a new one after a broken one was retired."""
+        ring = self._ring
+        if ring is not None or not self._started:
+            return ring
+        with self._lock:
+            if self._ring is None and self._started and self.workers > 0:
+                self._start_ring()
+                self._stats['rebuilds'] += 1
+            return self._ring
+
+    def _retire(self, ring):
+        """Shut down a ring's workers and free its slots if none is in use. Caller must hold the lock."""
+        ring.retired = True
+        ring.executor.shutdown(wait=True)
+        self._release_if_drained(ring)
+
+    def _return_slot(self, ring, slot):
+        ring.free.put(slot)
+        if ring.retired:
+            with self._lock:
+                self._release_if_drained(ring)
+
+    def _release_if_drained(self, ring):
+        """Unlink a retired ring's segments once every slot is back. Caller must hold the lock."""
+        if not ring.segments or ring.free.qsize() < len(ring.segments):
+            return
+        segments, ring.segments = ring.segments, []
+        for segment in segments:
+            # Unlink first - it only needs the name, so the segment is freed even if a view is still alive.
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+            try:
+                segment.close()
+            except BufferError as e:
+                logger.warning(f"Shared slot {segment.name} is still mapped, it is freed with its last view: {str(e)}")
+        logger.info(f"Released {len(segments)} shared slot(s)")
+
+    @contextmanager
+    def render(self, img, shading_pipeline, params, report=None):
+        """
+        Run a pipeline on a decoded frame in a worker process.
+
+        Yields a read-only view of the result in shared memory, valid until the
+        block exits, so the caller can encode it without another copy.
+        Raises PoolUnavailable when the frame cannot go through the pool.
+        """
+        ring = self._current_ring()
+        if ring is None:
+            raise PoolUnavailable('Shading workers are not running')
+
+        output_shape = shading_pipeline.plan(params, img.shape).output_shape
+        if output_shape[0] * output_shape[1] > self.slot_pixels:
+            self._stats['fallbacks'] += 1
+            raise PoolUnavailable(f"Output of {output_shape[1]}x{output_shape[0]} does not fit a slot")
+        if img.shape[0] * img.shape[1] > self.slot_pixels:
+            if not shading_pipeline.steps[0].stage.resizes:
+                self._stats['fallbacks'] += 1
+                raise PoolUnavailable(f"Input of {img.shape[1]}x{img.shape[0]} does not fit a slot")
+            # Downscale oversized inputs here so only the final size is shipped.
+            img = shading.resize_image(img, params.get('target_width'), params.get('target_height'), params.get('keep_ratio', True))
+            params = dict(params, target_width=None, target_height=None)
+
+        try:
+            slot = ring.free.get(timeout=self.slot_timeout)
+        except queue.Empty:
+            self._stats['fallbacks'] += 1
+            raise PoolUnavailable('No free shared slot')
+        try:
+            if ring.retired:
+                raise PoolUnavailable('Shading worker pool is being replaced')
+            segment = ring.segments[slot]
+            with profiling.span('copy_to_slot', 'pool', slot=slot):
+                np.copyto(_frame_view(segment, 0, img.shape), img)
+            try:
+                with profiling.span('worker_render', 'pool', slot=slot):
+                    worker_report = ring.executor.submit(
+                        _shade_slot, slot, self.region_bytes, img.shape, output_shape,
+                        shading_pipeline.name, shading_pipeline.specs, params
+                    ).result()
+            except (BrokenProcessPool, RuntimeError) as e:
+                if not isinstance(e, BrokenProcessPool) and not ring.retired:
+                    raise
+                # A worker died (e.g. out of memory) - retire the ring, the next render starts a new one.
+                with self._lock:
+                    if self._ring is ring:
+                        logger.error("Shading worker pool is broken, rendering in-process until it is rebuilt")
+                        self._ring = None
+                        self._retire(ring)
+                raise PoolUnavailable('Shading worker pool is broken')
+            self._stats['renders'] += 1
+            self._stats['worker_ms'] += worker_report['worker_ms']
+            if report is not None:
+                report.update(worker_report)
+
+            output = _frame_view(segment, self.region_bytes, output_shape)
+            output.flags.writeable = False
+            yield output
+        finally:
+            self._return_slot(ring, slot)
+
+    def stats(self):
+        """Return a snapshot of pool state for monitoring."""
+        ring = self._ring
+        return {
+            'workers': self.workers if ring is not None else 0,
+            'slots': len(ring.segments) if ring is not None else 0,
+            'free_slots': ring.free.qsize() if ring is not None else 0,
+            'slot_megabytes': round(self.region_bytes * 2 / 1048576, 1),
+            'renders': self._stats['renders'],
+            'fallbacks': self._stats['fallbacks'],
+            'rebuilds': self._stats['rebuilds'],
+            'worker_ms': round(self._stats['worker_ms'], 1)
+        }
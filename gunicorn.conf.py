@@ -0,0 +1,31 @@
+# CellShader - gunicorn configuration
+# Usage: gunicorn -c gunicorn.conf.py wsgi:app
+
+import os
+
+# Worker processes - each one decodes and shades images with its own OpenCV thread pool.
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+# Tell the app how many workers share the CPU so configure_thread_budget() can split the cores.
+os.environ['CELLSHADER_WORKERS'] = str(workers)
+
+# Sync workers with a few threads so light endpoints are not stuck behind one render.
+worker_class = 'gthread'
+threads = int(os.environ.get('CELLSHADER_THREADS', 4))
+
+bind = os.environ.get('CELLSHADER_BIND', '0.0.0.0:8000')
+
+# Large renders can take a while, allow for them before the worker is killed.
+timeout = 120
+graceful_timeout = 30
+
+# Load the app in each worker, not the master, so OpenCV thread pools and warm-up are per process.
+preload_app = False
+
+# Recycle workers now and then to return memory fragmented by large images.
+max_requests = 500
+max_requests_jitter = 50
+
+accesslog = '-'
+errorlog = '-'
+loglevel = 'info'
@@ -0,0 +1,202 @@
+# CellShader - In-memory index over images metadata
+# Sorted views for cursor pagination, rebuilt only when the metadata file changes.
+
+import base64
+import bisect
+import hashlib
+import json
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Sortable fields and how to build their sort key from a metadata entry.
+SORT_KEYS = {
+    'upload_time': lambda img: img.get('upload_time') or '',
+    'name': lambda img: (img.get('original_name') or '').lower(),
+    'size': lambda img: img.get('file_size') or 0
+}
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+class InvalidQuery(ValueError):
+    """Raised for malformed listing parameters (bad sort, cursor or filter)."""
+
+
+class ImageIndex:
+    """
+    Sorted indexes over the metadata file for paginated listing.
+
+    For each sortable field the index keeps a list of `(sort key, id)` tuples in
+    ascending order. A cursor encodes the last `(sort key, id)` returned, so the
+    next page starts with a binary search instead of a scan of the whole list.
+    The index is rebuilt lazily when the metadata file's size or mtime changes.
+    """
+
+    def __init__(self, metadata_file, load_metadata):
+        self.metadata_file = metadata_file
+        self.load_metadata = load_metadata
+        self._lock = threading.Lock()
+        self._signature = None
+        self._by_id = {}
+        self._sorted = {}
+
+    def invalidate(self):
+        """Force a rebuild on the next query, for writes within the file timestamp resolution."""
+        with self._lock:
+            self._signature = None
+
+    def version(self):
+        """Return a short token that changes whenever the metadata changes."""
+        with self._lock:
+            self._refresh()
+            return self._signature_token()
+
+    def query(self, sort='upload_time', order='asc', limit=None, cursor=None, name=None,
+              min_size=None, max_size=None, uploaded_after=None, uploaded_before=None):
+        """
+        Return one page of metadata entries.
+
+        Args:
+            sort (str): 'upload_time', 'name' or 'size'
+            order (str): 'asc' or 'desc'
+            limit (int, optional): Page size; None returns everything that matches
+            cursor (str, optional): Opaque cursor from a previous page
+            name (str, optional): Case-insensitive substring of the original name
+            min_size, max_size (int, optional): File size bounds in bytes
+            uploaded_after, uploaded_before (str, optional): ISO timestamp bounds
+
+        Returns:
+            dict: {'images': [...], 'next_cursor': str or None, 'total': int, 'version': str}
+        """
+        if sort not in SORT_KEYS:
+            raise InvalidQuery(f"Unsupported sort field: {sort}")
+        if order not in ('asc', 'desc'):
+            raise InvalidQuery(f"Unsupported sort order: {order}")
+        if limit is not None:
+            limit = max(1, min(MAX_LIMIT, int(limit)))
+
+        with self._lock:
+            self._refresh()
+            entries = self._sorted[sort]
+            by_id = self._by_id
+            version = self._signature_token()
+
+        # Starting position - after the cursor, else at the range bound of the sort field.
+        if cursor:
+            position = self._decode_cursor(cursor, sort, order)
+            if order == 'asc':
+                start = bisect.bisect_right(entries, position)
+            else:
+                start = bisect.bisect_left(entries, position) - 1
+        else:
+            start = 0 if order == 'asc' else len(entries) - 1
+            # Size and time bounds on the sort field itself become a binary search.
+            lower, upper = self._range_for(sort, min_size, max_size, uploaded_after, uploaded_before)
+            if order == 'asc' and lower is not None:
+                start = bisect.bisect_left(entries, (lower,))
+            if order == 'desc' and upper is not None:
+                start = bisect.bisect_right(entries, (upper, float('inf'))) - 1
+
+        step = 1 if order == 'asc' else -1
+        name_filter = name.lower() if name else None
+        page = []
+        last = None
+        has_more = False
+        index = start
+        while 0 <= index < len(entries):
+            key, image_id = entries[index]
+            index += step
+            image = by_id[image_id]
+            if not self._matches(image, name_filter, min_size, max_size, uploaded_after, uploaded_before):
+                # Past the range bound of the sort field nothing further can match.
+                if self._beyond_range(sort, order, image, min_size, max_size, uploaded_after, uploaded_before):
+                    break
+                continue
+            if limit is not None and len(page) >= limit:
+                # Another match exists, so the page gets a cursor.
+                has_more = True
+                break
+            page.append(image)
+            last = (key, image_id)
+
+        next_cursor = self._encode_cursor(sort, order, last) if has_more else None
+        return {
+            'images': page,
+            'next_cursor': next_cursor,
+            'total': len(by_id),
+            'version': version
+        }
+
+    def _refresh(self):
+        """Rebuild the sorted views when the metadata file changed. Caller must hold the lock."""
+        try:
+            stat = os.stat(self.metadata_file)
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = (0, 0)
+        if signature == self._signature:
+            return
+        images = self.load_metadata()
+        self._by_id = {img.get('id'): img for img in images}
+        self._sorted = {
+            field: sorted((key_func(img), img.get('id')) for img in images)
+            for field, key_func in SORT_KEYS.items()
+        }
+        self._signature = signature
+        logger.info(f"Rebuilt image index with {len(images)} entries")
+
+    def _signature_token(self):
+        raw = f"{self._signature[0]}-{self._signature[1]}"
+        return hashlib.sha1(raw.encode('ascii')).hexdigest()[:16]
+
+    @staticmethod
+    def _matches(image, name_filter, min_size, max_size, uploaded_after, uploaded_before):
+        size = image.get('file_size') or 0
+        uploaded = image.get('upload_time') or ''
+        if name_filter and name_filter not in (image.get('original_name') or '').lower():
+            return False
+        if min_size is not None and size < min_size:
+            return False
+        if max_size is not None and size > max_size:
+            return False
+        if uploaded_after and uploaded < uploaded_after:
+            return False
+        if uploaded_before and uploaded > uploaded_before:
+            return False
+        return True
+
+    @staticmethod
+    def _range_for(sort, min_size, max_size, uploaded_after, uploaded_before):
+        if sort == 'size':
+            return min_size, max_size
+        if sort == 'upload_time':
+            return uploaded_after, uploaded_before
+        return None, None
+
+    @classmethod
+    def _beyond_range(cls, sort, order, image, min_size, max_size, uploaded_after, uploaded_before):
+        """True once iteration has passed the far bound of a range filter on the sort field."""
+        lower, upper = cls._range_for(sort, min_size, max_size, uploaded_after, uploaded_before)
+        key = SORT_KEYS[sort](image)
+        if order == 'asc':
+            return upper is not None and key > upper
+        return lower is not None and key < lower
+
+    @staticmethod
+    def _encode_cursor(sort, order, position):
+        payload = json.dumps({'s': sort, 'o': order, 'k': position[0], 'i': position[1]})
+        return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(cursor, sort, order):
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except Exception:
+            raise InvalidQuery('Malformed cursor')
+        if payload.get('s') != sort or payload.get('o') != order:
+            raise InvalidQuery('Cursor does not match the requested sort')
+        return (payload['k'], payload['i'])
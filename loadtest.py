@@ -0,0 +1,385 @@
+# CellShader - HTTP load-testing harness
+# Starts the app locally (or targets a running server), replays a mix of uploads,
+# gallery listings and file fetches, and reports throughput, latency percentiles,
+# error rates and server memory.
+#
+# Examples:
+#   python loadtest.py --concurrency 8 --duration 60
+#   python loadtest.py --rate 5 --duration 120 --mix upload=1,list=4,fetch=5 --label v2
+#   python loadtest.py --url http://localhost:8000 --compare loadtest_results/old.json
+
+import argparse
+import json
+import math
+import os
+import queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from datetime import datetime
+
+from synthetic_images import make_images
+
+# psutil is optional - without it RSS is read from /proc on Linux only.
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(REPO_DIR, 'loadtest_results')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test the CellShader HTTP endpoints.')
+    parser.add_argument('--url', help='Target a running server instead of starting one locally')
+    parser.add_argument('--port', type=int, default=5055, help='Port for the locally started server')
+    parser.add_argument('--server-cmd', help='Custom command to start the server, e.g. "gunicorn -c gunicorn.conf.py wsgi:app"')
+    parser.add_argument('--concurrency', type=int, default=4, help='Closed loop: number of clients issuing requests back to back')
+    parser.add_argument('--rate', type=float, help='Open loop: mean arrivals per second (Poisson), overrides --concurrency')
+    parser.add_argument('--max-in-flight', type=int, default=64, help='Open loop: cap on outstanding requests')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to run')
+    parser.add_argument('--warmup', type=float, default=3, help='Seconds of traffic excluded from the results')
+    parser.add_argument('--mix', default='upload=1,list=3,fetch=4', help='Request weights: upload, list, fetch')
+    parser.add_argument('--sizes', default='640x480,1280x720,1920x1080', help='Upload image sizes, WIDTHxHEIGHT list')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for images and request mix')
+    parser.add_argument('--label', default='run', help='Label stored with the saved results')
+    parser.add_argument('--no-save', action='store_true', help='Do not write results to loadtest_results/')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    return parser.parse_args()
+
+
+def parse_mix(spec):
+    """Parse 'upload=1,list=3,fetch=4' into a weights dictionary."""
+    weights = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ('upload', 'list', 'fetch'):
+            raise ValueError(f"Unknown request type in mix: {name}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def encode_multipart(fields, file_field, filename, data):
+    """Build a multipart/form-data body."""
+    boundary = uuid.uuid4().hex
+    lines = []
+    for key, value in fields.items():
+        lines.append(f"--{boundary}\r\nContent-Disposition: form-data; name=\"{key}\"\r\n\r\n{value}\r\n".encode('utf-8'))
+    lines.append((f"--{boundary}\r\nContent-Disposition: form-data; name=\"{file_field}\"; filename=\"{filename}\"\r\n"
+                  f"Content-Type: image/jpeg\r\n\r\n").encode('utf-8'))
+    lines.append(data)
+    lines.append(f"\r\n--{boundary}--\r\n".encode('utf-8'))
+    return b''.join(lines), f"multipart/form-data; boundary={boundary}"
+
+
+class LoadTest:
+    """Request generator, result collector and server memory sampler."""
+
+    def __init__(self, args, base_url, server_pid=None):
+        self.args = args
+        self.base_url = base_url.rstrip('/')
+        self.server_pid = server_pid
+        self.mix = parse_mix(args.mix)
+        self.images = make_images(args.sizes, args.seed)
+        self.random = random.Random(args.seed)
+        self.random_lock = threading.Lock()
+        self.samples = []
+        self.samples_lock = threading.Lock()
+        self.rss_samples = []
+        self.known_files = []
+        self.stop_event = threading.Event()
+        self.measure_from = None
+
+    def pick(self):
+        """Choose the next request type and its parameters."""
+        with self.random_lock:
+            kinds = list(self.mix)
+            kind = self.random.choices(kinds, weights=[self.mix[k] for k in kinds])[0]
+            if kind == 'fetch' and not self.known_files:
+                kind = 'list'
+            if kind == 'upload':
+                image = self.random.choice(self.images)
+                fields = {
+                    'edge_thickness': self.random.randint(1, 10),
+                    'color_levels': self.random.randint(2, 20),
+                    'smoothing_amount': self.random.randint(1, 15),
+                    'saturation_amount': round(self.random.uniform(0.5, 1.8), 2)
+                }
+                return kind, {'image': image, 'fields': fields}
+            if kind == 'fetch':
+                return kind, {'filename': self.random.choice(self.known_files)}
+            return kind, {}
+
+    def issue(self, kind, params):
+        """Send one request and record its latency and outcome."""
+        label = kind
+        if kind == 'upload':
+            body, content_type = encode_multipart(params['fields'], 'file', params['image']['name'], params['image']['data'])
+            request = urllib.request.Request(f"{self.base_url}/upload", data=body, method='POST',
+                                             headers={'Content-Type': content_type, 'X-Client-Id': f"load-{threading.get_ident()}"})
+            label = f"upload {params['image']['size']}"
+        elif kind == 'fetch':
+            request = urllib.request.Request(f"{self.base_url}/uploads/{params['filename']}")
+        else:
+            request = urllib.request.Request(f"{self.base_url}/api/images?limit=20&fields=id,filename,original_name")
+
+        start = time.perf_counter()
+        status = 0
+        payload = b''
+        try:
+            with urllib.request.urlopen(request, timeout=300) as response:
+                status = response.status
+                payload = response.read()
+        except urllib.error.HTTPError as e:
+            status = e.code
+            e.read()
+        except Exception:
+            status = -1
+        latency = time.perf_counter() - start
+
+        # Remember files the server produced so fetches hit real content.
+        if kind == 'upload' and status == 200:
+            try:
+                result = json.loads(payload)
+                for key in ('original_path', 'processed_path'):
+                    if result.get(key):
+                        self.known_files.append(os.path.basename(result[key]))
+            except ValueError:
+                pass
+
+        if self.measure_from is not None and start >= self.measure_from:
+            with self.samples_lock:
+                self.samples.append((label, status, latency))
+
+    def run_closed_loop(self, end_time):
+        def client():
+            while time.perf_counter() < end_time and not self.stop_event.is_set():
+                self.issue(*self.pick())
+        threads = [threading.Thread(target=client, daemon=True) for _ in range(self.args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_open_loop(self, end_time):
+        """Poisson arrivals at a fixed mean rate, independent of response times."""
+        pending = queue.Queue(maxsize=self.args.max_in_flight)
+        dropped = 0
+
+        def worker():
+            while True:
+                item = pending.get()
+                if item is None:
+                    return
+                self.issue(*item)
+
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(self.args.max_in_flight)]
+        for thread in workers:
+            thread.start()
+        next_arrival = time.perf_counter()
+        while next_arrival < end_time:
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                pending.put_nowait(self.pick())
+            except queue.Full:
+                dropped += 1
+            next_arrival += self.random.expovariate(self.args.rate)
+        for _ in workers:
+            pending.put(None)
+        for thread in workers:
+            thread.join()
+        self.client_dropped = dropped
+
+    def sample_rss(self):
+        """Sample server resident memory (including worker children) twice a second."""
+        while not self.stop_event.wait(0.5):
+            rss = server_rss(self.server_pid)
+            if rss is not None:
+                self.rss_samples.append(rss)
+
+    def run(self):
+        sampler = threading.Thread(target=self.sample_rss, daemon=True)
+        sampler.start()
+        started = time.perf_counter()
+        self.measure_from = started + self.args.warmup
+        end_time = started + self.args.warmup + self.args.duration
+        self.client_dropped = 0
+        if self.args.rate:
+            self.run_open_loop(end_time)
+        else:
+            self.run_closed_loop(end_time)
+        self.stop_event.set()
+        sampler.join()
+        return summarize(self.samples, self.args.duration, self.rss_samples, self.client_dropped)
+
+
+def server_rss(pid):
+    """Resident set size in bytes of a process and its children, or None if unknown."""
+    if pid is None:
+        return None
+    if psutil:
+        try:
+            process = psutil.Process(pid)
+            return sum(p.memory_info().rss for p in [process] + process.children(recursive=True))
+        except psutil.Error:
+            return None
+    try:
+        with open(f"/proc/{pid}/status", 'r', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(fraction * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples, duration, rss_samples, client_dropped):
+    """Aggregate raw samples into per-endpoint and overall statistics."""
+    def stats(rows):
+        latencies = sorted(latency for _, _, latency in rows)
+        ok = sum(1 for _, status, _ in rows if 200 <= status < 400)
+        shed = sum(1 for _, status, _ in rows if status == 503)
+        return {
+            'requests': len(rows),
+            'throughput_rps': round(len(rows) / duration, 2),
+            'ok': ok,
+            'shed_503': shed,
+            'errors': len(rows) - ok - shed,
+            'error_rate': round((len(rows) - ok) / len(rows), 4) if rows else 0.0,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if rows else None,
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 1) if rows else None,
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if rows else None,
+            'max_ms': round(latencies[-1] * 1000, 1) if rows else None
+        }
+
+    by_label = {}
+    for row in samples:
+        by_label.setdefault(row[0], []).append(row)
+    return {
+        'overall': stats(samples),
+        'endpoints': {label: stats(rows) for label, rows in sorted(by_label.items())},
+        'server_rss_mb': {
+            'peak': round(max(rss_samples) / 1048576, 1) if rss_samples else None,
+            'mean': round(sum(rss_samples) / len(rss_samples) / 1048576, 1) if rss_samples else None
+        },
+        'client_dropped': client_dropped
+    }
+
+
+def start_server(args):
+    """Start the app in a scratch working directory so test uploads stay out of the repo."""
+    workdir = tempfile.mkdtemp(prefix='cellshader_load_')
+    with open(os.path.join(REPO_DIR, 'config.json'), 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    # Every simulated client connects from 127.0.0.1, so trust their X-Client-Id as if it came through a proxy.
+    config['trusted_proxies'] = ['127.0.0.1']
+    with open(os.path.join(workdir, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=4)
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    if args.server_cmd:
+        command = args.server_cmd.split()
+        env['CELLSHADER_BIND'] = f"127.0.0.1:{args.port}"
+    else:
+        command = [sys.executable, '-c',
+                   f"from app import create_app; create_app().run(host='127.0.0.1', port={args.port}, threaded=True)"]
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # Wait for the health check to answer.
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('Server exited during start-up')
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{args.port}/health", timeout=2):
+                return process, workdir
+        except Exception:
+            time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError('Server did not become healthy within 60 seconds')
+
+
+def print_report(results, previous=None):
+    """Print a table of results, with deltas against a previous run if given."""
+    header = f"{'endpoint':<22}{'reqs':>7}{'rps':>8}{'err%':>7}{'503':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(header)
+    print('-' * len(header))
+    rows = list(results['endpoints'].items()) + [('overall', results['overall'])]
+    for label, row in rows:
+        line = (f"{label:<22}{row['requests']:>7}{row['throughput_rps']:>8}{row['error_rate'] * 100:>7.1f}"
+                f"{row['shed_503']:>6}{row['p50_ms'] or 0:>10}{row['p95_ms'] or 0:>10}{row['p99_ms'] or 0:>10}")
+        print(line)
+        if previous:
+            old = previous['endpoints'].get(label) if label != 'overall' else previous['overall']
+            if old and old.get('p95_ms') and row.get('p95_ms'):
+                change = (row['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100
+                rps_change = (row['throughput_rps'] - old['throughput_rps']) / max(old['throughput_rps'], 1e-9) * 100
+                print(f"{'':<22}vs {previous.get('label', 'previous')}: p95 {change:+.1f}%, throughput {rps_change:+.1f}%")
+    rss = results['server_rss_mb']
+    print(f"server RSS: peak {rss['peak']} MB, mean {rss['mean']} MB")
+    if results.get('client_dropped'):
+        print(f"client dropped {results['client_dropped']} arrival(s) at the in-flight cap")
+
+
+def main():
+    args = parse_args()
+    process = workdir = None
+    try:
+        if args.url:
+            base_url, pid = args.url, None
+        else:
+            process, workdir = start_server(args)
+            base_url, pid = f"http://127.0.0.1:{args.port}", process.pid
+
+        mode = f"rate {args.rate}/s" if args.rate else f"concurrency {args.concurrency}"
+        print(f"Load testing {base_url} for {args.duration:.0f}s ({mode}, mix {args.mix})")
+        results = LoadTest(args, base_url, pid).run()
+        results.update({
+            'label': args.label,
+            'timestamp': datetime.now().isoformat(),
+            'settings': {key: value for key, value in vars(args).items() if key not in ('compare',)}
+        })
+
+        previous = None
+        if args.compare:
+            with open(args.compare, 'r', encoding='utf-8') as f:
+                previous = json.load(f)
+        print_report(results, previous)
+
+        if not args.no_save:
+            os.makedirs(RESULTS_DIR, exist_ok=True)
+            path = os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{args.label}.json")
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+            print(f"Results saved to {path}")
+    finally:
+        if process:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,415 @@
+# CellShader - Composable processing pipelines
+# Registered stages with declared inputs, output and parameters, assembled into
+# pipelines (built in or from config.json) that are planned and then executed.
+
+import hashlib
+import json
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import cv2
+import numpy as np
+
+import profiling
+import shading
+
+logger = logging.getLogger(__name__)
+
+# Name of the buffer holding the decoded source image.
+SOURCE = 'image'
+
+# When a stage's default input is not produced by a pipeline, it reads the
+# previous buffer of the color chain instead, so steps can simply be left out.
+INPUT_FALLBACKS = {'colored': 'smoothed', 'smoothed': 'resized', 'resized': SOURCE}
+
+# Pipeline used when a request or the config does not name one.
+DEFAULT_PIPELINE = 'cell_shade'
+
+# Constant-time pipeline behind the 'realtime' processing mode.
+REALTIME_PIPELINE = 'realtime'
+
+# Registered stages by name.
+STAGES = {}
+
+# Threads for running independent branches of a pipeline side by side. The
+# calling thread always runs a step itself, so this only bounds the extra parallelism.
+BRANCH_WORKERS = 4
+_branch_pool = None
+_branch_pool_lock = threading.Lock()
+
+
+class PipelineError(ValueError):
+    """Raised for unknown stages or pipelines and for steps whose inputs are not available."""
+
+
+class Stage:
+    """A processing unit: reads input buffers, takes named parameters, produces one output buffer."""
+
+    def __init__(self, name, func, inputs, output, params=(), noop=None, channels=3, resizes=False, accepts_out=False):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.output = output
+        self.params = tuple(params)
+        self.noop = noop
+        self.channels = channels
+        self.resizes = resizes
+        self.accepts_out = accepts_out
+
+
+def register_stage(name, inputs, output, params=(), noop=None, channels=3, resizes=False, accepts_out=False):
+    """
+    Decorator registering a stage function.
+
+    Args:
+        inputs (tuple): Default input buffer names, passed positionally
+        output (str): Default output buffer name
+        params (tuple): Request parameters the stage takes as keyword arguments
+        noop (callable, optional): noop(params, source_shape) -> True when the stage would not change its input
+        channels (int): Channels of the output buffer
+        resizes (bool): Whether the stage changes the image size (resize parameters)
+        accepts_out (bool): Whether the stage can write into a preallocated `out` array
+    """
+    def decorator(func):
+        STAGES[name] = Stage(name, func, inputs, output, params, noop, channels, resizes, accepts_out)
+        return func
+    return decorator
+
+
+def _resize_is_noop(params, shape):
+    size = shading.compute_target_size(shape[1], shape[0], params.get('target_width'), params.get('target_height'),
+                                       params.get('keep_ratio', True))
+    return size is None or size == (shape[1], shape[0])
+
+
+@register_stage('resize', (SOURCE,), 'resized', ('target_width', 'target_height', 'keep_ratio'),
+                noop=_resize_is_noop, resizes=True)
+def resize_stage(img, target_width=None, target_height=None, keep_ratio=True):
+    return shading.resize_image(img, target_width, target_height, keep_ratio)
+
+
+@register_stage('smooth', ('resized',), 'smoothed', ('smoothing_amount',))
+def smooth_stage(img, smoothing_amount=7):
+    return shading.smooth_image(img, smoothing_amount)
+
+
+@register_stage('saturation', ('smoothed',), 'colored', ('saturation_amount',),
+                noop=lambda params, shape: params.get('saturation_amount', 1.0) == 1.0)
+def saturation_stage(img, saturation_amount=1.0):
+    return shading.adjust_saturation(img, saturation_amount)
+
+
+@register_stage('edge_source', ('colored',), 'gray_blur', channels=1)
+def edge_source_stage(img):
+    return shading.edge_source(img)
+
+
+@register_stage('edges', ('gray_blur',), 'edge_mask', ('edge_thickness', 'edge_method'), channels=1)
+def edges_stage(gray_blur, edge_thickness=7, edge_method='adaptive'):
+    return shading.detect_edges(gray_blur, edge_thickness, edge_method)
+
+
+@register_stage('quantize', ('colored',), 'quantized', ('color_levels', 'kmeans_attempts', 'kmeans_sample'))
+def quantize_stage(img, color_levels=8, kmeans_attempts=shading.KMEANS_ATTEMPTS, kmeans_sample=None):
+    return shading.quantize_colors(img, color_levels, kmeans_attempts, kmeans_sample)
+
+
+@register_stage('combine', ('quantized', 'edge_mask'), 'result', accepts_out=True)
+def combine_stage(segmented_image, edges, out=None):
+    return shading.combine_edges(segmented_image, edges, out)
+
+
+@register_stage('smooth_fast', ('resized',), 'smoothed', ('smoothing_amount',))
+def smooth_fast_stage(img, smoothing_amount=7):
+    return shading.smooth_fast(img, smoothing_amount)
+
+
+@register_stage('saturation_fast', ('smoothed',), 'colored', ('saturation_amount',),
+                noop=lambda params, shape: params.get('saturation_amount', 1.0) == 1.0)
+def saturation_fast_stage(img, saturation_amount=1.0):
+    return shading.adjust_saturation_fast(img, saturation_amount)
+
+
+@register_stage('edge_source_fast', ('colored',), 'gray_blur', channels=1)
+def edge_source_fast_stage(img):
+    return shading.edge_source_fast(img)
+
+
+@register_stage('posterize', ('colored',), 'quantized', ('color_levels', 'posterize_space'))
+def posterize_stage(img, color_levels=8, posterize_space='bgr'):
+    return shading.posterize(img, color_levels, posterize_space)
+
+
+# Built-in pipelines. Each step is a stage name or a dict with 'stage' and
+# optional 'params' (fixed values overriding the request), 'inputs' and 'output'.
+BUILTIN_PIPELINES = {
+    'cell_shade': ['resize', 'smooth', 'saturation', 'edge_source', 'edges', 'quantize', 'combine'],
+    'flat_colors': ['resize', 'smooth', 'saturation', {'stage': 'quantize', 'inputs': ['colored'], 'output': 'result'}],
+    # Lookup-table posterization, subsampled guided filter and Sobel edges, for interactive previews and video.
+    REALTIME_PIPELINE: ['resize', 'smooth_fast', 'saturation_fast', 'edge_source_fast',
+                        {'stage': 'edges', 'params': {'edge_method': 'sobel'}}, 'posterize', 'combine']
+}
+
+
+class Step:
+    """One use of a stage in a pipeline, with its buffer names and fixed parameters."""
+
+    def __init__(self, spec):
+        if isinstance(spec, str):
+            spec = {'stage': spec}
+        if not isinstance(spec, dict) or not isinstance(spec.get('stage'), str) or spec['stage'] not in STAGES:
+            raise PipelineError(f"Unknown stage: {spec.get('stage') if isinstance(spec, dict) else spec}")
+        self.spec = spec
+        self.stage = STAGES[spec['stage']]
+        # Malformed specs from config.json are reported as PipelineError like any other invalid step.
+        inputs, output, params = spec.get('inputs') or self.stage.inputs, spec.get('output') or self.stage.output, spec.get('params') or {}
+        if not isinstance(inputs, (list, tuple)) or not all(isinstance(name, str) for name in inputs):
+            raise PipelineError(f"Stage {self.stage.name} inputs must be a list of buffer names")
+        if not isinstance(output, str):
+            raise PipelineError(f"Stage {self.stage.name} output must be a buffer name")
+        if not isinstance(params, dict):
+            raise PipelineError(f"Stage {self.stage.name} params must be a mapping of names to values")
+        self.explicit_inputs = bool(spec.get('inputs'))
+        self.inputs = tuple(inputs)
+        self.output = output
+        self.fixed_params = dict(params)
+        if len(self.inputs) != len(self.stage.inputs):
+            raise PipelineError(f"Stage {self.stage.name} takes {len(self.stage.inputs)} input(s)")
+
+    def params_for(self, params):
+        merged = dict(params, **self.fixed_params)
+        return {name: merged[name] for name in self.stage.params if name in merged}
+
+
+class Plan:
+    """
+    The steps that will actually run for one request.
+
+    Every buffer a step reads is resolved to the key of the step output (or
+    the source) it refers to at that point in the pipeline. No-op steps are
+    dropped and their output name refers to their input, so later steps read
+    the unchanged buffer directly. `pixels` holds the pixel count of each
+    step's output, for cost estimates.
+    """
+
+    def __init__(self, pipeline, steps, inputs, outputs, skipped, output, output_shape, pixels):
+        self.pipeline = pipeline
+        self.steps = steps
+        self.inputs = inputs
+        self.outputs = outputs
+        self.skipped = skipped
+        self.output = output
+        self.output_shape = output_shape
+        self.pixels = pixels
+
+    def has_branches(self):
+        """True when some buffer feeds more than one step, so branches can run concurrently."""
+        consumers = {}
+        for keys in self.inputs:
+            for key in keys:
+                consumers[key] = consumers.get(key, 0) + 1
+        return any(count > 1 for count in consumers.values())
+
+    def describe(self):
+        return {
+            'name': self.pipeline.name,
+            'stages': [step.stage.name for step in self.steps],
+            'skipped': self.skipped
+        }
+
+
+class Pipeline:
+    """An ordered list of steps, validated so every input is produced before it is read."""
+
+    def __init__(self, name, specs):
+        self.name = name
+        if not isinstance(specs, (list, tuple)):
+            raise PipelineError(f"Pipeline {name} must be a list of steps")
+        self.specs = list(specs)
+        self.steps = [Step(spec) for spec in self.specs]
+        # Identifies the step list, so nodes with different configs can tell their pipelines apart.
+        self.digest = hashlib.sha256(json.dumps(self.specs, sort_keys=True).encode('utf-8')).hexdigest()
+        if not self.steps:
+            raise PipelineError(f"Pipeline {name} has no steps")
+
+        channels = {SOURCE: 3}
+        for step in self.steps:
+            if not step.explicit_inputs:
+                step.inputs = tuple(self._fallback(name, channels) for name in step.inputs)
+            missing = [input_name for input_name in step.inputs if input_name not in channels]
+            if missing:
+                raise PipelineError(f"Pipeline {name}: stage {step.stage.name} reads {', '.join(missing)} before it is produced")
+            channels[step.output] = step.stage.channels
+        if channels[self.steps[-1].output] != 3:
+            raise PipelineError(f"Pipeline {name} must end with a color image")
+
+    @staticmethod
+    def _fallback(name, available):
+        while name not in available and name in INPUT_FALLBACKS:
+            name = INPUT_FALLBACKS[name]
+        return name
+
+    def plan(self, params, source_shape):
+        """
+        Drop no-op steps for these parameters and work out the output shape.
+
+        Args:
+            params (dict): Request parameters (edge_thickness, color_levels, ...)
+            source_shape (tuple): Shape of the decoded source image
+        """
+        height, width = source_shape[:2]
+        steps, inputs, outputs, skipped, pixels = [], [], [], [], []
+        # Buffer name -> key of the output it currently refers to.
+        current = {SOURCE: SOURCE}
+        for index, step in enumerate(self.steps):
+            step_params = step.params_for(params)
+            if step.stage.noop and step.stage.noop(step_params, source_shape):
+                skipped.append(step.stage.name)
+                current[step.output] = current[step.inputs[0]]
+                continue
+            if step.stage.resizes:
+                size = shading.compute_target_size(width, height, step_params.get('target_width'),
+                                                   step_params.get('target_height'), step_params.get('keep_ratio', True))
+                if size:
+                    width, height = size
+            steps.append(step)
+            inputs.append(tuple(current[name] for name in step.inputs))
+            current[step.output] = f"{step.output}#{index}"
+            outputs.append(current[step.output])
+            pixels.append(width * height)
+        return Plan(self, steps, inputs, outputs, skipped, current[self.steps[-1].output], (height, width, 3), pixels)
+
+    def scaled_source(self, img, params):
+        """
+        Source image and parameters for rendering at `processing_scale` of the output size.
+
+        Returns:
+            tuple: (image, params, output size) - the output size is None at full scale
+        """
+        scale = params.get('processing_scale') or 1.0
+        if scale >= 1.0:
+            return img, params, None
+        height, width = self.plan(params, img.shape).output_shape[:2]
+        small = shading.resize_image(img, max(1, round(width * scale)), max(1, round(height * scale)), keep_ratio=False)
+        return small, dict(params, target_width=None, target_height=None, processing_scale=1.0), (width, height)
+
+    def run(self, img, params, out=None, report=None):
+        """
+        Run the pipeline on a decoded BGR image.
+
+        Args:
+            img (numpy.ndarray): Decoded BGR source image
+            params (dict): Request parameters. `processing_scale` below 1.0
+                renders at that fraction of the output size and upscales the result.
+            out (numpy.ndarray, optional): Preallocated array of the output shape to write into
+            report (dict, optional): Filled with the plan and per-stage timings in ms
+
+        Returns:
+            numpy.ndarray: The final image (`out` when given)
+        """
+        if (params.get('processing_scale') or 1.0) < 1.0:
+            start = time.perf_counter()
+            with profiling.span('downscale'):
+                small, small_params, size = self.scaled_source(img, params)
+            downscale_ms = (time.perf_counter() - start) * 1000
+            result = self.run(small, small_params, report=report)
+            start = time.perf_counter()
+            with profiling.span('upscale'):
+                result = cv2.resize(result, size, dst=out, interpolation=cv2.INTER_LINEAR)
+            if report is not None:
+                report['timings_ms'].update(downscale=round(downscale_ms, 2),
+                                            upscale=round((time.perf_counter() - start) * 1000, 2))
+                report['processing_scale'] = params['processing_scale']
+            return result
+
+        plan = self.plan(params, img.shape)
+        last = len(plan.steps) - 1
+        timings = {}
+
+        def run_step(index, inputs):
+            step = plan.steps[index]
+            kwargs = step.params_for(params)
+            if index == last and out is not None and step.stage.accepts_out:
+                kwargs['out'] = out
+            start = time.perf_counter()
+            with profiling.span(step.stage.name, **{k: v for k, v in kwargs.items() if k != 'out'}):
+                result = step.stage.func(*inputs, **kwargs)
+            timings[step.stage.name] = round(timings.get(step.stage.name, 0) + (time.perf_counter() - start) * 1000, 2)
+            return result
+
+        # Run steps as their inputs become available. The calling thread runs one
+        # ready step itself and only extra ready branches go to the shared pool, so a
+        # linear chain never leaves this thread and concurrent renders do not queue
+        # behind each other on the pool. A branch the pool has not started yet is
+        # taken back and run here instead of waiting for a pool thread.
+        pool = _get_branch_pool() if plan.has_branches() else None
+        buffers = {SOURCE: img}
+        pending = list(range(len(plan.steps)))
+        running = {}
+
+        def collect(futures):
+            for future in futures:
+                index = running.pop(future)[0]
+                buffers[plan.outputs[index]] = future.result()
+
+        while pending or running:
+            collect([future for future in running if future.done()])
+            ready = [index for index in pending if all(key in buffers for key in plan.inputs[index])]
+            if ready:
+                pending = [index for index in pending if index not in ready]
+                if pool is not None:
+                    for index in ready[1:]:
+                        inputs = [buffers[key] for key in plan.inputs[index]]
+                        running[pool.submit(profiling.propagate(run_step), index, inputs)] = (index, inputs)
+                    ready = ready[:1]
+                for index in ready:
+                    buffers[plan.outputs[index]] = run_step(index, [buffers[key] for key in plan.inputs[index]])
+                continue
+            for future, (index, inputs) in list(running.items()):
+                if future.cancel():
+                    del running[future]
+                    buffers[plan.outputs[index]] = run_step(index, inputs)
+                    break
+            else:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                collect(done)
+        result = buffers[plan.output]
+
+        if out is not None and result is not out:
+            np.copyto(out, result)
+            result = out
+        if report is not None:
+            report.update(plan.describe(), timings_ms=timings)
+        return result
+
+
+def _get_branch_pool():
+    global _branch_pool
+    with _branch_pool_lock:
+        if _branch_pool is None:
+            _branch_pool = ThreadPoolExecutor(max_workers=BRANCH_WORKERS, thread_name_prefix='pipeline')
+        return _branch_pool
+
+
+def load_pipelines(config):
+    """
+    Build the available pipelines: the built-ins plus those under 'pipelines' in config.json.
+
+    Invalid config pipelines are logged and left out, and built-in names cannot be redefined.
+    """
+    pipelines = {name: Pipeline(name, specs) for name, specs in BUILTIN_PIPELINES.items()}
+    configured = config.get('pipelines') or {}
+    if not isinstance(configured, dict):
+        logger.error("Invalid pipelines in config: expected a mapping of names to step lists")
+        configured = {}
+    for name, specs in configured.items():
+        if name in BUILTIN_PIPELINES:
+            logger.warning(f"Config pipeline {name} ignored, the name is built in")
+            continue
+        try:
+            pipelines[name] = Pipeline(name, specs)
+        except PipelineError as e:
+            logger.error(f"Invalid pipeline {name} in config: {str(e)}")
+    return pipelines
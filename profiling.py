@@ -0,0 +1,331 @@
+# CellShader - Request profiling and trace export
+# Span traces of processing requests in Chrome trace-event format, optional
+# cProfile capture on demand, and a rolling log of sampled traces.
+
+import contextvars
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Trace of the request being handled in the current thread or context, if any.
+_current_trace = contextvars.ContextVar('cellshader_trace', default=None)
+
+# Request ids are used as file names, so only allow a safe character set.
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+SAMPLED_LOG_NAME = 'sampled.jsonl'
+
+
+class CaptureBusy(Exception):
+    """Raised when a profile capture is requested while another one is running in this process."""
+
+
+class RequestTrace:
+    """Spans recorded while handling one request, plus an optional cProfile profile."""
+
+    def __init__(self, request_id, name, profile=False, client_request_id=None):
+        self.request_id = request_id
+        self.client_request_id = client_request_id
+        self.name = name
+        self.started = datetime.now().isoformat()
+        self.status = None
+        self.events = []
+        self.profiler = cProfile.Profile() if profile else None
+        self._origin = time.perf_counter()
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name, category, start, end, args=None):
+        """Record a completed span, with perf_counter start and end times."""
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round((start - self._origin) * 1e6, 1),
+            'dur': round((end - start) * 1e6, 1),
+            'pid': os.getpid(),
+            'tid': thread.ident
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self.events.append(event)
+            self._threads[thread.ident] = thread.name
+
+    def duration_ms(self):
+        return round((time.perf_counter() - self._origin) * 1000, 1)
+
+    def span_totals(self):
+        """Total milliseconds per span name."""
+        totals = {}
+        for event in self.events:
+            totals[event['name']] = round(totals.get(event['name'], 0) + event['dur'] / 1000, 1)
+        return totals
+
+    def summary(self):
+        return {
+            'request_id': self.request_id,
+            'client_request_id': self.client_request_id,
+            'name': self.name,
+            'started': self.started,
+            'status': self.status,
+            'duration_ms': self.duration_ms(),
+            'profiled': self.profiler is not None,
+            'spans': self.span_totals()
+        }
+
+    def to_chrome(self):
+        """Chrome trace-event JSON, loadable in chrome://tracing or Perfetto."""
+        with self._lock:
+            events = list(self.events)
+            threads = dict(self._threads)
+        metadata = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+            for tid, name in threads.items()
+        ]
+        return {
+            'traceEvents': metadata + events,
+            'displayTimeUnit': 'ms',
+            'otherData': self.summary()
+        }
+
+
+@contextmanager
+def span(name, category='pipeline', **args):
+    """Time the enclosed block as a span of the current trace. Does nothing when no trace is active."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, category, start, time.perf_counter(), args)
+
+
+def current_trace():
+    """Return the trace of the current request, or None."""
+    return _current_trace.get()
+
+
+def propagate(func):
+    """Wrap a function so it records into the caller's trace when run on a pool thread."""
+    trace = _current_trace.get()
+    if trace is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        token = _current_trace.set(trace)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_trace.reset(token)
+    return wrapper
+
+
+class Profiler:
+    """
+    Decides which requests are traced and stores the results.
+
+    A request is captured in full (spans and cProfile, saved under its request
+    id) when profiling is enabled, an admin token is configured and the request
+    asks for it with that token. Independently, a random fraction of requests get a span-only
+    trace appended to a size-capped rolling log.
+
+    cProfile can only run one profiler per process at a time (Python 3.12+
+    raises ValueError for a second one), so captures are serialized and one
+    requested while another is running raises CaptureBusy.
+    """
+
+    def __init__(self, trace_folder):
+        self.trace_folder = trace_folder
+        self.enabled = False
+        self.admin_token = ''
+        self.sample_rate = 0.0
+        self.max_traces = 50
+        self.log_max_bytes = 5 * 1024 * 1024
+        self._write_lock = threading.Lock()
+        self._capture_lock = threading.Lock()
+
+    def configure(self, config):
+        """Apply profiling settings from app_config."""
+        self.enabled = bool(config.get('profiling_enabled', False))
+        self.admin_token = os.environ.get('CELLSHADER_PROFILING_TOKEN') or config.get('profiling_admin_token', '')
+        self.sample_rate = max(0.0, min(1.0, float(config.get('profiling_sample_rate', 0.0))))
+        self.max_traces = max(1, int(config.get('profiling_max_traces', 50)))
+        self.log_max_bytes = max(1024, int(config.get('profiling_log_max_bytes', 5 * 1024 * 1024)))
+
+    def authorized(self, token):
+        """True when on-demand profiling and trace retrieval are allowed for this token."""
+        # Without a configured token nobody is allowed in.
+        if not self.enabled or not self.admin_token or not token:
+            return False
+        return hmac.compare_digest(str(token), str(self.admin_token))
+
+    @staticmethod
+    def new_request_id():
+        """Generate a request id. Ids name trace files, so they never come from the client."""
+        return uuid.uuid4().hex[:16]
+
+    @staticmethod
+    def client_request_id(requested):
+        """The client's own request id when it is well-formed, kept only to be echoed back."""
+        if requested and REQUEST_ID_PATTERN.match(requested):
+            return requested
+        return None
+
+    def begin(self, request_id, name, capture=False, client_request_id=None):
+        """
+        Start tracing a request when it is captured or sampled.
+
+        Returns:
+            tuple: (RequestTrace or None, context token to pass to finish())
+
+        Raises:
+            CaptureBusy: `capture` was asked for while another capture is running
+        """
+        if not capture and not (self.sample_rate and random.random() < self.sample_rate):
+            return None, None
+        if capture:
+            if not self._capture_lock.acquire(blocking=False):
+                raise CaptureBusy('Another profile capture is running.')
+            try:
+                trace = RequestTrace(request_id, name, profile=True, client_request_id=client_request_id)
+                trace.profiler.enable()
+            except ValueError as e:
+                # Some other profiling tool holds the interpreter's profiler.
+                self._capture_lock.release()
+                raise CaptureBusy(f"Profiler unavailable: {str(e)}")
+        else:
+            trace = RequestTrace(request_id, name, client_request_id=client_request_id)
+        return trace, _current_trace.set(trace)
+
+    def finish(self, trace, token):
+        """Stop tracing and save the trace - as files when captured, else to the rolling log."""
+        if trace is None:
+            return
+        try:
+            if trace.profiler:
+                trace.profiler.disable()
+            # Root span for the whole request.
+            trace.add_span(trace.name, 'request', trace._origin, time.perf_counter(), {'status': trace.status})
+            if trace.profiler:
+                self._save_capture(trace)
+            else:
+                self._append_sampled(trace)
+        except Exception as e:
+            logger.error(f"Error saving trace {trace.request_id}: {str(e)}")
+        finally:
+            _current_trace.reset(token)
+            if trace.profiler:
+                self._capture_lock.release()
+
+    def _save_capture(self, trace):
+        os.makedirs(self.trace_folder, exist_ok=True)
+        base = os.path.join(self.trace_folder, trace.request_id)
+        trace.profiler.dump_stats(f"{base}.prof")
+        with open(f"{base}.json", 'w', encoding='utf-8') as f:
+            json.dump(trace.to_chrome(), f)
+        logger.info(f"Saved profile and trace for request {trace.request_id} ({trace.duration_ms()} ms)")
+        self._trim_captures()
+
+    def _trim_captures(self):
+        """Keep only the newest max_traces captured traces."""
+        traces = sorted(
+            (entry for entry in os.scandir(self.trace_folder) if entry.name.endswith('.json')),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True
+        )
+        for entry in traces[self.max_traces:]:
+            base = entry.path[:-len('.json')]
+            for path in (entry.path, f"{base}.prof"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _append_sampled(self, trace):
+        """Append a sampled trace to the rolling log, rotating it to .1 when it gets too big."""
+        line = json.dumps(dict(trace.summary(), events=trace.to_chrome()['traceEvents'])) + '\n'
+        log_path = os.path.join(self.trace_folder, SAMPLED_LOG_NAME)
+        with self._write_lock:
+            os.makedirs(self.trace_folder, exist_ok=True)
+            if os.path.exists(log_path) and os.path.getsize(log_path) + len(line) > self.log_max_bytes:
+                os.replace(log_path, f"{log_path}.1")
+            with open(log_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+    def _sampled_lines(self):
+        """Yield parsed rolling log entries, newest file last."""
+        log_path = os.path.join(self.trace_folder, SAMPLED_LOG_NAME)
+        for path in (f"{log_path}.1", log_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+
+    def list_traces(self, limit=50):
+        """Summaries of captured traces and of the most recent sampled traces, newest first."""
+        captured = []
+        if os.path.isdir(self.trace_folder):
+            for entry in os.scandir(self.trace_folder):
+                if entry.name.endswith('.json'):
+                    try:
+                        with open(entry.path, 'r', encoding='utf-8') as f:
+                            captured.append(json.load(f).get('otherData', {}))
+                    except (OSError, ValueError):
+                        continue
+        sampled = [{key: value for key, value in line.items() if key != 'events'} for line in self._sampled_lines()]
+        by_start = lambda summary: summary.get('started') or ''
+        return {
+            'captured': sorted(captured, key=by_start, reverse=True)[:limit],
+            'sampled': sorted(sampled, key=by_start, reverse=True)[:limit]
+        }
+
+    def get_trace(self, request_id):
+        """Chrome trace-event JSON of a captured or sampled request, or None."""
+        if not REQUEST_ID_PATTERN.match(request_id):
+            return None
+        path = os.path.join(self.trace_folder, f"{request_id}.json")
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        for line in self._sampled_lines():
+            if line.get('request_id') == request_id:
+                events = line.pop('events', [])
+                return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': line}
+        return None
+
+    def profile_path(self, request_id):
+        """Path of the saved cProfile stats of a captured request, or None."""
+        if not REQUEST_ID_PATTERN.match(request_id):
+            return None
+        path = os.path.join(self.trace_folder, f"{request_id}.prof")
+        return path if os.path.exists(path) else None
+
+    def profile_report(self, request_id, sort='cumulative', limit=40):
+        """Text report of the top functions of a captured profile, or None."""
+        path = self.profile_path(request_id)
+        if not path:
+            return None
+        output = io.StringIO()
+        stats = pstats.Stats(path, stream=output)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return output.getvalue()
@@ -0,0 +1,454 @@
+# CellShader - Storage retention and garbage collection
+# Enforces disk quotas on uploads and renders and cleans up orphaned files in the background.
+
+import os
+import threading
+import time
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def _timestamp(iso_value, default=0.0):
+    """Convert an ISO timestamp from metadata to epoch seconds."""
+    try:
+        return datetime.fromisoformat(iso_value).timestamp()
+    except (TypeError, ValueError):
+        return default
+
+
+class _FreedBytes:
+    """Running total of bytes freed by planned removals, simulating blob reference counts."""
+
+    def __init__(self, blobs, upload_folder, render_folder):
+        self.refs = {digest: entry['refs'] for digest, entry in blobs.items()}
+        self.sizes = {digest: entry['size'] for digest, entry in blobs.items()}
+        self.upload_folder = upload_folder
+        self.render_folder = render_folder
+        self.total = 0
+        self._seen = set()
+
+    def add_render(self, render):
+        if id(render) in self._seen:
+            return
+        self._seen.add(id(render))
+        self._release(render.get('file_path') or os.path.join(self.render_folder, render['filename']), render.get('content_hash'))
+
+    def add_image(self, image):
+        """An image takes its renders with it."""
+        if id(image) in self._seen:
+            return
+        self._seen.add(id(image))
+        for render in image.get('renders', []):
+            self.add_render(render)
+        self._release(os.path.join(self.upload_folder, image['filename']), image.get('content_hash'))
+
+    def _release(self, path, digest):
+        if digest and digest in self.refs:
+            self.refs[digest] -= 1
+            if self.refs[digest] == 0:
+                self.total += self.sizes[digest]
+        elif os.path.exists(path) and os.stat(path).st_nlink == 1:
+            # Legacy file outside the blob store.
+            self.total += os.path.getsize(path)
+
+
+class RetentionManager:
+    """
+    Disk quota enforcement for uploaded originals and their processed renders.
+
+    A sweep applies, in order: the per-image render limit, the maximum age, and
+    the total byte quota. Under the byte quota, derived renders are evicted in
+    least-recently-used order before any original is touched, and evicting an
+    original also removes its renders. Each sweep also reconciles metadata with
+    the filesystem and garbage-collects unreferenced blobs.
+    """
+
+    def __init__(self, upload_folder, metadata_file, blob_store, load_metadata, save_metadata, metadata_lock):
+        self.upload_folder = upload_folder
+        self.metadata_file = metadata_file
+        self.blob_store = blob_store
+        self.load_metadata = load_metadata
+        self.save_metadata = save_metadata
+        self.metadata_lock = metadata_lock
+        self.render_subdirectory = 'cell-shaded'
+        self.max_total_bytes = 0
+        self.max_age_days = 0
+        self.max_renders_per_image = 0
+        self.sweep_interval = 3600
+        self.sweep_pause = 0.01
+        self.orphan_grace_seconds = 3600
+        self.delete_orphans = False
+        # Callable returning True while processing is running, so sweeps can yield to it.
+        self.is_busy = lambda: False
+        self._access_times = {}
+        self._access_lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_sweep = None
+
+    def configure(self, config):
+        """Apply retention settings from the application config dictionary."""
+        self.render_subdirectory = config.get('default_subdirectory', 'cell-shaded')
+        self.max_total_bytes = int(config.get('retention_max_total_bytes', 0))
+        self.max_age_days = float(config.get('retention_max_age_days', 0))
+        self.max_renders_per_image = int(config.get('retention_max_renders_per_image', 0))
+        self.sweep_interval = float(config.get('retention_sweep_interval', 3600))
+        self.sweep_pause = float(config.get('retention_sweep_pause', 0.01))
+        self.orphan_grace_seconds = float(config.get('retention_orphan_grace_seconds', 3600))
+        self.delete_orphans = bool(config.get('retention_delete_orphans', False))
+
+    @property
+    def render_folder(self):
+        return os.path.join(self.upload_folder, self.render_subdirectory)
+
+    def touch(self, filename):
+        """Record that a file was served, for least-recently-used eviction."""
+        with self._access_lock:
+            self._access_times[filename] = time.time()
+
+    def last_used(self, filename, created):
+        """Most recent of the last access and the creation time, in epoch seconds."""
+        with self._access_lock:
+            accessed = self._access_times.get(filename, 0.0)
+        return max(accessed, _timestamp(created))
+
+    def remove_render_files(self, render):
+        """Delete one render's file and release its blob reference."""
+        path = render.get('file_path') or os.path.join(self.render_folder, render['filename'])
+        if os.path.exists(path):
+            os.remove(path)
+        if render.get('content_hash'):
+            self.blob_store.release(render['content_hash'])
+        with self._access_lock:
+            self._access_times.pop(render['filename'], None)
+
+    def remove_image_files(self, image):
+        """Delete an original and all of its renders, releasing their blob references."""
+        for render in image.get('renders', []):
+            self.remove_render_files(render)
+        path = os.path.join(self.upload_folder, image['filename'])
+        if os.path.exists(path):
+            os.remove(path)
+        if image.get('content_hash'):
+            self.blob_store.release(image['content_hash'])
+        with self._access_lock:
+            self._access_times.pop(image['filename'], None)
+
+    def disk_usage(self):
+        """Bytes used under the upload folder, counting hardlinked files once."""
+        seen = set()
+        total = 0
+        for directory, _, files in os.walk(self.upload_folder):
+            for name in files:
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except OSError:
+                    continue
+                key = (stat.st_dev, stat.st_ino)
+                if key in seen:
+                    continue
+                seen.add(key)
+                total += stat.st_size
+        return total
+
+    def sweep(self, dry_run=False):
+        """
+        Run one retention pass.
+
+        Args:
+            dry_run (bool): Report what would be removed without deleting anything
+
+        Returns:
+            dict: Report of evictions, orphans and bytes before/after
+        """
+        if not self._sweep_lock.acquire(blocking=False):
+            return {'skipped': True, 'reason': 'Sweep already running'}
+        if not self._acquire_host_lock():
+            # Another worker process on this host is sweeping.
+            self._sweep_lock.release()
+            return {'skipped': True, 'reason': 'Sweep running in another process'}
+        try:
+            started = time.time()
+            report = {
+                'dry_run': dry_run,
+                'started': datetime.now().isoformat(),
+                'bytes_before': self.disk_usage(),
+                'evicted_renders': [],
+                'evicted_images': [],
+                'orphan_files': [],
+                'missing_files': [],
+                'garbage': {'blobs': 0, 'stray_files': 0, 'bytes': 0}
+            }
+
+            # Plan and apply metadata changes in one locked pass, delete files afterwards.
+            with self.metadata_lock:
+                images = self.load_metadata()
+                renders_to_remove, images_to_remove = self._plan_evictions(images, report)
+                orphan_paths = self._find_orphans(images, report)
+                if not dry_run:
+                    self._apply_to_metadata(images, renders_to_remove, images_to_remove, report)
+
+            if not dry_run:
+                for render in renders_to_remove:
+                    self.remove_render_files(render)
+                    self._pause()
+                for image in images_to_remove:
+                    self.remove_image_files(image)
+                    self._pause()
+                for path in orphan_paths:
+                    self._remove_orphan(path)
+                    self._pause()
+                report['garbage'] = self.blob_store.collect_garbage(self.orphan_grace_seconds)
+                report['bytes_after'] = self.disk_usage()
+            else:
+                report['bytes_after'] = report['bytes_before']
+
+            report['duration_ms'] = round((time.time() - started) * 1000, 1)
+            if not dry_run:
+                self._last_sweep = report
+            logger.info(f"Retention sweep: {len(report['evicted_renders'])} render(s), {len(report['evicted_images'])} image(s) evicted, "
+                        f"{len(report['orphan_files'])} orphan file(s), {report['bytes_before'] - report['bytes_after']} bytes freed")
+            return report
+        finally:
+            self._release_host_lock()
+            self._sweep_lock.release()
+
+    def stats(self):
+        """Storage usage, quotas and the last sweep report."""
+        images = self.load_metadata()
+        return {
+            'usage_bytes': self.disk_usage(),
+            'images': len(images),
+            'renders': sum(len(img.get('renders', [])) for img in images),
+            'blobs': self.blob_store.stats(),
+            'quotas': {
+                'max_total_bytes': self.max_total_bytes,
+                'max_age_days': self.max_age_days,
+                'max_renders_per_image': self.max_renders_per_image
+            },
+            'sweeper_running': bool(self._thread and self._thread.is_alive()),
+            'sweep_interval': self.sweep_interval,
+            'last_sweep': self._last_sweep
+        }
+
+    def start(self):
+        """Start the background sweeper thread if a sweep interval is configured."""
+        if self.sweep_interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='retention-sweeper', daemon=True)
+        self._thread.start()
+        logger.info(f"Retention sweeper started, interval {self.sweep_interval:.0f}s")
+
+    def stop(self):
+        """Stop the background sweeper thread."""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        """Sweeper loop - waits out busy periods so processing keeps priority."""
+        while not self._stop_event.wait(self.sweep_interval):
+            # Defer while renders are running, but not forever.
+            for _ in range(30):
+                if not self.is_busy() or self._stop_event.wait(10):
+                    break
+            if self._stop_event.is_set():
+                return
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Retention sweep failed: {str(e)}")
+
+    def _plan_evictions(self, images, report):
+        """Pick renders and images to evict according to the quotas."""
+        now = time.time()
+        renders_to_remove = []
+        images_to_remove = []
+        removed_render_ids = set()
+
+        def evict_render(image, render, reason):
+            key = (image.get('id'), render['filename'])
+            if key in removed_render_ids:
+                return
+            removed_render_ids.add(key)
+            renders_to_remove.append(render)
+            report['evicted_renders'].append({'image_id': image.get('id'), 'filename': render['filename'], 'reason': reason})
+
+        def evict_image(image, reason):
+            images_to_remove.append(image)
+            report['evicted_images'].append({'image_id': image.get('id'), 'filename': image['filename'], 'reason': reason})
+
+        # Per-image render limit - keep the most recently created renders.
+        if self.max_renders_per_image > 0:
+            for image in images:
+                renders = sorted(image.get('renders', []), key=lambda r: _timestamp(r.get('created')))
+                for render in renders[:-self.max_renders_per_image]:
+                    evict_render(image, render, 'max_renders_per_image')
+
+        # Maximum age - renders first, then originals with everything derived from them.
+        if self.max_age_days > 0:
+            cutoff = now - self.max_age_days * 86400
+            for image in images:
+                if _timestamp(image.get('upload_time'), now) < cutoff:
+                    evict_image(image, 'max_age')
+                    continue
+                for render in image.get('renders', []):
+                    if _timestamp(render.get('created'), now) < cutoff:
+                        evict_render(image, render, 'max_age')
+
+        # Total byte quota - least recently used renders, then least recently used originals.
+        if self.max_total_bytes > 0:
+            # Blob sizes are loaded once and the freed total kept up to date per eviction.
+            freed = _FreedBytes(self.blob_store.entries(), self.upload_folder, self.render_folder)
+            for render in renders_to_remove:
+                freed.add_render(render)
+            for image in images_to_remove:
+                freed.add_image(image)
+            usage = report['bytes_before'] - freed.total
+            if usage > self.max_total_bytes:
+                evicted_ids = {img.get('id') for img in images_to_remove}
+                candidates = []
+                for image in images:
+                    if image.get('id') in evicted_ids:
+                        continue
+                    for render in image.get('renders', []):
+                        if (image.get('id'), render['filename']) not in removed_render_ids:
+                            candidates.append((0, self.last_used(render['filename'], render.get('created')), image, render))
+                for image in images:
+                    if image.get('id') not in evicted_ids:
+                        candidates.append((1, self.last_used(image['filename'], image.get('upload_time')), image, None))
+                candidates.sort(key=lambda c: (c[0], c[1]))
+
+                for _, _, image, render in candidates:
+                    if usage <= self.max_total_bytes:
+                        break
+                    if render is not None:
+                        evict_render(image, render, 'max_total_bytes')
+                        freed.add_render(render)
+                    else:
+                        evict_image(image, 'max_total_bytes')
+                        freed.add_image(image)
+                    usage = report['bytes_before'] - freed.total
+
+        # Renders of evicted images go with the image.
+        evicted_ids = {img.get('id') for img in images_to_remove}
+        renders_to_remove = [r for r in renders_to_remove
+                             if not any(r is rr for img in images_to_remove for rr in img.get('renders', []))]
+        report['evicted_renders'] = [r for r in report['evicted_renders'] if r['image_id'] not in evicted_ids]
+        return renders_to_remove, images_to_remove
+
+    def _find_orphans(self, images, report):
+        """Compare metadata with the filesystem in both directions."""
+        referenced = set()
+        for image in images:
+            path = os.path.normpath(os.path.join(self.upload_folder, image['filename']))
+            referenced.add(path)
+            if not os.path.exists(path):
+                report['missing_files'].append({'image_id': image.get('id'), 'filename': image['filename']})
+            for render in image.get('renders', []):
+                render_path = os.path.normpath(render.get('file_path') or os.path.join(self.render_folder, render['filename']))
+                referenced.add(render_path)
+                if not os.path.exists(render_path):
+                    report['missing_files'].append({'image_id': image.get('id'), 'filename': render['filename'], 'render': True})
+
+        # Only user-facing folders are scanned - the blob store cleans up after itself.
+        skip = {os.path.normpath(self.metadata_file)}
+        cutoff = time.time() - self.orphan_grace_seconds
+        orphan_paths = []
+        for folder in (self.upload_folder, self.render_folder):
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                path = os.path.normpath(os.path.join(folder, name))
+                if name.startswith('.') or not os.path.isfile(path) or path in referenced or path in skip:
+                    continue
+                report['orphan_files'].append(path.replace('\\', '/'))
+                if self.delete_orphans and os.path.getmtime(path) < cutoff:
+                    orphan_paths.append(path)
+        return orphan_paths
+
+    def _apply_to_metadata(self, images, renders_to_remove, images_to_remove, report):
+        """Drop evicted entries and renders whose files are gone, then save. Caller holds the metadata lock."""
+        removed_images = {id(img) for img in images_to_remove}
+        removed_renders = {id(r) for r in renders_to_remove}
+        changed = bool(images_to_remove or renders_to_remove)
+        kept = []
+        for image in images:
+            if id(image) in removed_images:
+                continue
+            # Missing originals are only dropped when orphan cleanup is enabled.
+            if self.delete_orphans and not os.path.exists(os.path.join(self.upload_folder, image['filename'])):
+                images_to_remove.append(image)
+                report['evicted_images'].append({'image_id': image.get('id'), 'filename': image['filename'], 'reason': 'missing_file'})
+                changed = True
+                continue
+            renders = []
+            for render in image.get('renders', []):
+                if id(render) in removed_renders:
+                    continue
+                if not os.path.exists(render.get('file_path') or os.path.join(self.render_folder, render['filename'])):
+                    # The render file is gone, so its record and blob reference go too.
+                    if render.get('content_hash'):
+                        self.blob_store.release(render['content_hash'])
+                    changed = True
+                    continue
+                renders.append(render)
+            image['renders'] = renders
+            kept.append(image)
+        if changed:
+            self.save_metadata(kept)
+
+    def _remove_orphan(self, path):
+        """Delete an unreferenced file, releasing its blob if it is a link to one."""
+        try:
+            stat = os.stat(path)
+            os.remove(path)
+            if stat.st_nlink > 1:
+                # Find the blob sharing this inode so its reference count stays right.
+                for digest, entry in self.blob_store.entries().items():
+                    blob_path = self.blob_store.path_for(digest, entry['ext'])
+                    try:
+                        blob_stat = os.stat(blob_path)
+                    except OSError:
+                        continue
+                    if (blob_stat.st_dev, blob_stat.st_ino) == (stat.st_dev, stat.st_ino):
+                        self.blob_store.release(digest)
+                        break
+            logger.info(f"Removed orphan file: {path}")
+        except OSError as e:
+            logger.warning(f"Could not remove orphan file {path}: {str(e)}")
+
+    def _pause(self):
+        """Yield between deletions so the sweep stays a low-priority background task."""
+        if self.sweep_pause > 0:
+            time.sleep(self.sweep_pause)
+
+    def _host_lock_path(self):
+        return os.path.join(self.upload_folder, '.retention.lock')
+
+    def _acquire_host_lock(self):
+        """Make sure only one worker process sweeps at a time, taking over stale locks."""
+        path = self._host_lock_path()
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, str(os.getpid()).encode('ascii'))
+            os.close(fd)
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > max(600, 2 * self.sweep_interval):
+                    os.remove(path)
+                    return self._acquire_host_lock()
+            except OSError:
+                pass
+            return False
+
+    def _release_host_lock(self):
+        try:
+            os.remove(self._host_lock_path())
+        except OSError:
+            pass
@@ -0,0 +1,409 @@
+# CellShader - Cell-shading processing stages
+# Each stage of the effect as a standalone function on decoded BGR images, so
+# callers can run, reuse or cache stages individually.
+
+import cv2
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def compute_target_size(width, height, target_width=None, target_height=None, keep_ratio=True):
+    """
+    Compute final dimensions with keep_ratio logic.
+
+    Returns:
+        tuple: (new_width, new_height), or None when no resizing was requested
+    """
+    if target_width is None and target_height is None:
+        return None
+    if keep_ratio:
+        aspect_ratio = width / height
+        if target_width is not None:
+            # Prefer width when both provided.
+            new_width = target_width
+            new_height = int(target_width / aspect_ratio)
+        else:
+            new_height = target_height
+            new_width = int(target_height * aspect_ratio)
+    else:
+        new_width = target_width if target_width is not None else width
+        new_height = target_height if target_height is not None else height
+    return new_width, new_height
+
+
+def resize_image(img, target_width=None, target_height=None, keep_ratio=True):
+    """Resize to the target dimensions, returning the image unchanged when none are given."""
+    height, width = img.shape[:2]
+    size = compute_target_size(width, height, target_width, target_height, keep_ratio)
+    if size is None:
+        return img
+    new_width, new_height = size
+
+    # Choose interpolation method based on scaling direction.
+    if new_width * new_height < width * height:
+        # Downscaling - use INTER_AREA for better quality.
+        interpolation = cv2.INTER_AREA
+    else:
+        # Upscaling - use INTER_LANCZOS4 for better quality.
+        interpolation = cv2.INTER_LANCZOS4
+
+    img = cv2.resize(img, (new_width, new_height), interpolation=interpolation)
+    logger.info(f"Resized image to {new_width}x{new_height}")
+    return img
+
+
+def smooth_image(img, smoothing_amount):
+    """Apply bilateral filter for smoothing while preserving edges."""
+    return cv2.bilateralFilter(img, smoothing_amount, 80, 80)
+
+
+def adjust_saturation(img, saturation_amount):
+    """Scale saturation in HSV space, returning the image unchanged at 1.0."""
+    if saturation_amount == 1.0:
+        return img
+
+    # Convert to HSV color space for saturation adjustment.
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    hsv = hsv.astype(np.float32)
+
+    # Adjust saturation channel (index 1 in HSV).
+    hsv[:, :, 1] = hsv[:, :, 1] * saturation_amount
+
+    # Clamp values to valid range and convert back to uint8.
+    hsv[:, :, 1] = np.clip(hsv[:, :, 1], 0, 255)
+    hsv = hsv.astype(np.uint8)
+
+    # Convert back to BGR color space.
+    img = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+    logger.info(f"Applied saturation adjustment: {saturation_amount}")
+    return img
+
+
+# Subsampling factor and edge-keeping threshold (a variance in 0-255 units) of smooth_fast().
+FAST_SMOOTH_SCALE = 4
+FAST_SMOOTH_EPS = 600.0
+
+
+def smooth_fast(img, smoothing_amount):
+    """
+    Edge-preserving smoothing in roughly constant time - a subsampled guided filter.
+
+    Each channel guides itself. The filter coefficients are computed with box
+    filters on a copy downscaled by FAST_SMOOTH_SCALE and upsampled, so the
+    cost barely depends on smoothing_amount, unlike the bilateral filter.
+    """
+    height, width = img.shape[:2]
+    scale = FAST_SMOOTH_SCALE if min(height, width) >= FAST_SMOOTH_SCALE * 16 else 1
+    small = cv2.resize(img, (width // scale, height // scale), interpolation=cv2.INTER_AREA).astype(np.float32)
+    window = (2 * max(1, smoothing_amount // scale) + 1,) * 2
+
+    mean = cv2.boxFilter(small, -1, window)
+    variance = cv2.boxFilter(small * small, -1, window) - mean * mean
+    # Flat areas (variance below eps) are averaged, strong edges are kept.
+    gain = variance / (variance + FAST_SMOOTH_EPS)
+    offset = mean - gain * mean
+    gain = cv2.boxFilter(gain, -1, window)
+    offset = cv2.boxFilter(offset, -1, window)
+    # Finish in 8-bit fixed point, full-size float arrays would cost more than the filter itself.
+    gain = cv2.convertScaleAbs(gain, alpha=255)
+    offset = cv2.convertScaleAbs(offset)
+    if scale > 1:
+        gain = cv2.resize(gain, (width, height), interpolation=cv2.INTER_LINEAR)
+        offset = cv2.resize(offset, (width, height), interpolation=cv2.INTER_LINEAR)
+    return cv2.add(cv2.multiply(img, gain, scale=1 / 255), offset)
+
+
+def adjust_saturation_fast(img, saturation_amount):
+    """Scale saturation by blending with the grayscale image, with no color space round trip."""
+    if saturation_amount == 1.0:
+        return img
+    gray = cv2.cvtColor(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+    # Values above 1.0 extrapolate away from gray, the uint8 result saturates at 0 and 255.
+    return cv2.addWeighted(img, saturation_amount, gray, 1.0 - saturation_amount, 0)
+
+
+def edge_source(img):
+    """Grayscale, median-blurred copy of the image that edge detection works on."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.medianBlur(gray, 5)
+
+
+def edge_source_fast(img):
+    """Grayscale copy for edge detection on an image that smooth_fast() already denoised."""
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def detect_edges(gray_blur, edge_thickness, edge_method='adaptive'):
+    """
+    Create a single-channel edge mask (255 = no edge, 0 = line) with the chosen backend.
+
+    Args:
+        gray_blur (numpy.ndarray): Output of edge_source()
+        edge_thickness (int): Thickness of edges (1-10)
+        edge_method (str): One of EDGE_METHODS
+    """
+    if edge_method not in EDGE_METHODS:
+        raise ValueError(f"Unknown edge method: {edge_method}")
+    return EDGE_METHODS[edge_method](gray_blur, edge_thickness)
+
+
+def edges_adaptive(gray_blur, edge_thickness):
+    """Original backend - adaptive mean threshold with edge_thickness as block size and constant."""
+    # Ensure blockSize is odd and at least 3 for adaptiveThreshold (1 is rejected by OpenCV).
+    block_size = max(3, edge_thickness if edge_thickness % 2 == 1 else edge_thickness + 1)
+    return cv2.adaptiveThreshold(gray_blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size, edge_thickness)
+
+
+def edges_mean(gray_blur, edge_thickness):
+    """Local mean threshold (ADAPTIVE_THRESH_MEAN_C) with a fixed window, thinned and widened to edge_thickness pixels."""
+    # The mean comes from box filter running sums, so the cost per pixel does not grow with the window.
+    mask = cv2.adaptiveThreshold(gray_blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, MEAN_WINDOW, MEAN_OFFSET)
+    return _widen_lines(_thin_lines(mask), edge_thickness)
+
+
+def edges_canny(gray_blur, edge_thickness):
+    """Canny edges - one pixel wide - widened to edge_thickness pixels."""
+    return _widen_lines(cv2.bitwise_not(cv2.Canny(gray_blur, CANNY_LOW, CANNY_HIGH)), edge_thickness)
+
+
+def edges_sobel(gray_blur, edge_thickness):
+    """Thresholded Sobel gradient magnitude, cut to one pixel by non-maximum suppression and widened to edge_thickness pixels."""
+    grad_x = cv2.convertScaleAbs(cv2.Sobel(gray_blur, cv2.CV_16S, 1, 0, ksize=3))
+    grad_y = cv2.convertScaleAbs(cv2.Sobel(gray_blur, cv2.CV_16S, 0, 1, ksize=3))
+    magnitude = cv2.addWeighted(grad_x, 0.5, grad_y, 0.5, 0)
+    # Unlike _thin_lines() this is a handful of whole-image operations, cheap enough for the realtime pipeline.
+    ridges = _suppress_non_maxima(magnitude, grad_x, grad_y)
+    lines = cv2.bitwise_and(ridges, cv2.compare(magnitude, SOBEL_THRESHOLD, cv2.CMP_GT))
+    return _widen_lines(cv2.bitwise_not(lines), edge_thickness)
+
+
+def edges_dog(gray_blur, edge_thickness):
+    """Difference of Gaussians - dark side of intensity steps - thinned and widened to edge_thickness pixels."""
+    fine = cv2.GaussianBlur(gray_blur, (0, 0), DOG_SIGMA)
+    coarse = cv2.GaussianBlur(gray_blur, (0, 0), DOG_SIGMA * 1.6)
+    mask = cv2.compare(cv2.subtract(coarse, fine), DOG_THRESHOLD, cv2.CMP_LE)
+    return _widen_lines(_thin_lines(mask), edge_thickness)
+
+
+def _suppress_non_maxima(magnitude, grad_x, grad_y):
+    """
+    Mask (255) of the pixels whose gradient magnitude peaks across the edge.
+
+    Peaks are looked for along x where the horizontal gradient dominates and
+    along y elsewhere, which leaves one pixel per row or column on any slope.
+    A pixel must beat its neighbour on one side and at least equal the one on
+    the other, so two-pixel plateaus keep one pixel.
+    """
+    height, width = magnitude.shape
+    padded = cv2.copyMakeBorder(magnitude, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+
+    def peaks(dy, dx):
+        before = padded[1 - dy:1 - dy + height, 1 - dx:1 - dx + width]
+        after = padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+        return cv2.bitwise_and(cv2.compare(magnitude, before, cv2.CMP_GT), cv2.compare(magnitude, after, cv2.CMP_GE))
+
+    across_x = cv2.compare(grad_x, grad_y, cv2.CMP_GE)
+    ridges_x = cv2.bitwise_and(across_x, peaks(0, 1))
+    return cv2.bitwise_or(ridges_x, cv2.bitwise_and(cv2.bitwise_not(across_x), peaks(1, 0)))
+
+
+def _thinning_tables():
+    """
+    Zhang-Suen deletion lookup tables for its two sub-iterations.
+
+    A pixel's 8 neighbours are packed into one byte (bit 0 = north, then
+    clockwise), and each table marks the neighbourhoods where a line pixel
+    can be removed without breaking or shortening the line.
+    """
+    tables = []
+    for first in (True, False):
+        table = np.zeros(256, np.uint8)
+        for code in range(256):
+            p = [(code >> bit) & 1 for bit in range(8)]  # N, NE, E, SE, S, SW, W, NW
+            neighbours = sum(p)
+            transitions = sum(1 for i in range(8) if p[i] == 0 and p[(i + 1) % 8] == 1)
+            north, east, south, west = p[0], p[2], p[4], p[6]
+            if first:
+                keep_corner = north * east * south == 0 and east * south * west == 0
+            else:
+                keep_corner = north * east * west == 0 and north * south * west == 0
+            if 2 <= neighbours <= 6 and transitions == 1 and keep_corner:
+                table[code] = 1
+        tables.append(table)
+    return tables
+
+
+# Neighbour offsets (dy, dx) in the bit order of _thinning_tables().
+_NEIGHBOURS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+_THINNING_TABLES = [table.astype(bool) for table in _thinning_tables()]
+
+
+def _thin_lines(mask):
+    """
+    Thin the lines (0) of an edge mask to one pixel, keeping them connected (Zhang-Suen).
+
+    Only line pixels are visited, so the cost follows the amount of line
+    rather than the image size.
+    """
+    points = cv2.findNonZero(cv2.bitwise_not(mask))
+    if points is None:
+        return mask
+    # One pixel of background around the image, so every line pixel has 8 neighbours to read.
+    lines = cv2.copyMakeBorder(cv2.threshold(mask, 0, 1, cv2.THRESH_BINARY_INV)[1], 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0).view(bool)
+    xs, ys = points[:, 0, 0] + 1, points[:, 0, 1] + 1
+    deleted_ys, deleted_xs = [], []
+    while ys.size:
+        removed = 0
+        for table in _THINNING_TABLES:
+            codes = np.zeros(ys.size, np.uint8)
+            for bit, (dy, dx) in enumerate(_NEIGHBOURS):
+                codes |= lines[ys + dy, xs + dx].view(np.uint8) << bit
+            delete = table[codes]
+            lines[ys[delete], xs[delete]] = False
+            deleted_ys.append(ys[delete])
+            deleted_xs.append(xs[delete])
+            keep = ~delete
+            ys, xs = ys[keep], xs[keep]
+            removed += int(delete.size - ys.size)
+        if not removed:
+            break
+    thinned = mask.copy()
+    if deleted_ys:
+        thinned[np.concatenate(deleted_ys) - 1, np.concatenate(deleted_xs) - 1] = 255
+    return thinned
+
+
+def _widen_lines(mask, edge_thickness):
+    """Grow the lines (0) of an edge mask to edge_thickness pixels by eroding the background (255)."""
+    if edge_thickness > 1:
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (edge_thickness, edge_thickness))
+        mask = cv2.erode(mask, kernel)
+    return mask
+
+
+# Tuning of the thickness-correct backends, for edge_source() output.
+MEAN_WINDOW = 9
+MEAN_OFFSET = 4
+CANNY_LOW = 30
+CANNY_HIGH = 90
+SOBEL_THRESHOLD = 40
+DOG_SIGMA = 1.0
+DOG_THRESHOLD = 2
+
+# Edge backends by name. Only 'adaptive' ties line width to the threshold block size,
+# the others thin their lines to one pixel and widen them to exactly edge_thickness.
+EDGE_METHODS = {
+    'adaptive': edges_adaptive,
+    'mean': edges_mean,
+    'canny': edges_canny,
+    'sobel': edges_sobel,
+    'dog': edges_dog
+}
+
+
+# K-means restarts of quantize_colors() unless a cheaper setting is asked for.
+KMEANS_ATTEMPTS = 10
+
+
+def quantize_colors(img, color_levels, attempts=KMEANS_ATTEMPTS, sample_pixels=None):
+    """
+    Reduce colors using K-means clustering.
+
+    Args:
+        img (numpy.ndarray): BGR image
+        color_levels (int): Number of clusters
+        attempts (int): K-means restarts, the best clustering is kept
+        sample_pixels (int, optional): Fit the clusters on this many randomly
+            sampled pixels, then assign every pixel to its nearest center
+    """
+    data = img.reshape((-1, 3))
+    data = np.float32(data)
+
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1.0)
+    if sample_pixels and sample_pixels < len(data):
+        # Fixed seed so the same image and settings always give the same colors.
+        sample = data[np.random.default_rng(0).integers(0, len(data), sample_pixels)]
+        _, _, centers = cv2.kmeans(sample, color_levels, None, criteria, attempts, cv2.KMEANS_RANDOM_CENTERS)
+        labels = nearest_centers(img, centers)
+    else:
+        _, labels, centers = cv2.kmeans(data, color_levels, None, criteria, attempts, cv2.KMEANS_RANDOM_CENTERS)
+
+    # Convert back to uint8 and reshape.
+    centers = np.uint8(centers)
+    segmented_data = centers[labels.flatten()]
+    return segmented_data.reshape(img.shape)
+
+
+def nearest_centers(img, centers):
+    """
+    Index of the nearest cluster center for every pixel of a BGR image.
+
+    Nearest centers are computed once per cell of a 32x32x32 color grid and
+    looked up per pixel, which is much cheaper than a distance per pixel and
+    center and at most 4 levels per channel off.
+    """
+    grid = np.arange(4, 256, 8, dtype=np.float32)
+    cells = np.stack(np.meshgrid(grid, grid, grid, indexing='ij'), axis=-1).reshape(-1, 3)
+    distances = (centers * centers).sum(axis=1) - 2 * (cells @ centers.T)
+    lookup = distances.argmin(axis=1).astype(np.uint8)
+    cell = (img[..., 0] >> 3).astype(np.int32) << 10
+    cell |= (img[..., 1] >> 3).astype(np.int32) << 5
+    cell |= img[..., 2] >> 3
+    return lookup[cell]
+
+
+# Posterize tables by band count.
+_posterize_luts = {}
+
+
+def posterize_lut(levels):
+    """256-entry table mapping each 0-255 value to the center of its band, for `levels` bands."""
+    lut = _posterize_luts.get(levels)
+    if lut is None:
+        bands = np.minimum(np.arange(256) * levels // 256, levels - 1)
+        lut = _posterize_luts[levels] = np.uint8((bands + 0.5) * 256 / levels)
+    return lut
+
+
+def posterize(img, color_levels, color_space='bgr'):
+    """
+    Reduce colors with precomputed lookup tables - constant time per pixel, unlike K-means.
+
+    Args:
+        img (numpy.ndarray): BGR image
+        color_levels (int): Bands per channel, or lightness bands in 'ycrcb' and 'lab'
+        color_space (str): 'bgr' bands each channel. 'ycrcb' and 'lab' band
+            lightness and use half as many bands for the two color axes.
+            'lab' is perceptually even but its conversions cost ~25 ms at 1080p.
+    """
+    if color_space == 'bgr':
+        return cv2.LUT(img, posterize_lut(color_levels))
+    if color_space not in POSTERIZE_SPACES:
+        raise ValueError(f"Unknown posterize color space: {color_space}")
+    to_space, from_space, lightness = POSTERIZE_SPACES[color_space]
+    chroma_lut = posterize_lut(max(2, color_levels // 2))
+    tables = [chroma_lut, chroma_lut]
+    tables.insert(lightness, posterize_lut(color_levels))
+    converted = cv2.LUT(cv2.cvtColor(img, to_space), np.dstack(tables))
+    return cv2.cvtColor(converted, from_space)
+
+
+# Luma/chroma spaces for posterize(): conversion codes and the lightness channel index.
+POSTERIZE_SPACES = {
+    'ycrcb': (cv2.COLOR_BGR2YCrCb, cv2.COLOR_YCrCb2BGR, 0),
+    'lab': (cv2.COLOR_BGR2LAB, cv2.COLOR_LAB2BGR, 0)
+}
+
+
+def combine_edges(segmented_image, edges, out=None):
+    """Combine the segmented image with the edge mask, writing into `out` when given."""
+    # Use the single-channel mask directly instead of expanding it to 3 channels.
+    if out is None:
+        return cv2.bitwise_and(segmented_image, segmented_image, mask=edges)
+    # Masked operations leave pixels outside the mask untouched, so clear them first.
+    out.fill(0)
+    cv2.bitwise_and(segmented_image, segmented_image, dst=out, mask=edges)
+    return out
+
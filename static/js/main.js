@@ -227,33 +227,78 @@ function handleFileSelection(file) {
     showStatus(`Added: ${file.name} (${formatFileSize(file.size)})`, 'success');
 }
 
-// Load existing images from server on page load
+// Server gallery paging state
+const GALLERY_PAGE_SIZE = 20;
+const GALLERY_FIELDS = 'id,filename,original_name,file_size,original_width,original_height,target_width,target_height,keep_ratio,aspect_ratio';
+let galleryCursor = null;
+let galleryLoading = false;
+let galleryDone = false;
+let galleryObserver = null;
+
+// Load existing images from server on page load, one page at a time as the table scrolls
 async function loadExistingImages() {
+    galleryCursor = null;
+    galleryDone = false;
+    await loadNextImagePage();
+
+    // Load further pages when the bottom of the table comes into view
+    const sentinel = document.getElementById('imageTableSentinel');
+    if (sentinel && 'IntersectionObserver' in window) {
+        galleryObserver = new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) {
+                loadNextImagePage();
+            }
+        }, { rootMargin: '200px' });
+        galleryObserver.observe(sentinel);
+    }
+}
+
+// Fetch and render the next page of server images
+async function loadNextImagePage() {
+    if (galleryLoading || galleryDone) return;
+    galleryLoading = true;
+
     try {
-        const response = await fetch('/api/images');
+        const params = new URLSearchParams({ limit: GALLERY_PAGE_SIZE, fields: GALLERY_FIELDS });
+        if (galleryCursor) {
+            params.set('cursor', galleryCursor);
+        }
+        const response = await fetch(`/api/images?${params.toString()}`);
         const result = await response.json();
-        
-        if (result.success && result.images.length > 0) {
-            console.log(`Loading ${result.images.length} existing images`);
-            
-            for (const imageData of result.images) {
-                await loadServerImage(imageData);
-            }
-            
-            // Show images section if we loaded any images
-            if (selectedImages.length > 0) {
-                showImagesSection();
-                updateProcessButton();
-                selectedFile = selectedImages[0].file; // Set for backward compatibility
-            }
+
+        if (!result.success) {
+            console.error('Error loading existing images:', result.error);
+            return;
+        }
+
+        // Rows of a page are independent, so add them all at once
+        result.images.forEach(imageData => loadServerImage(imageData));
+        galleryCursor = result.next_cursor;
+        galleryDone = !galleryCursor;
+
+        if (result.images.length > 0) {
+            console.log(`Loaded ${result.images.length} existing images (${selectedImages.length} of ${result.total})`);
+        }
+
+        // Show images section if we loaded any images
+        if (selectedImages.length > 0) {
+            showImagesSection();
+            updateProcessButton();
+            selectedFile = selectedImages[0].file; // Set for backward compatibility
         }
     } catch (error) {
         console.error('Error loading existing images:', error);
+    } finally {
+        galleryLoading = false;
+        if (galleryDone && galleryObserver) {
+            galleryObserver.disconnect();
+            galleryObserver = null;
+        }
     }
 }
 
 // Load a single image from server data
-async function loadServerImage(serverImageData) {
+function loadServerImage(serverImageData) {
     try {
         // Create a simplified image data object for the table
         const imageData = {
@@ -340,7 +385,7 @@ function createImageTableRow(imageData) {
     
     row.innerHTML = `
         <td>
-            <img src="${imageData.preview}" alt="${imageData.name}" class="image-preview">
+            <img src="${imageData.preview}" alt="${imageData.name}" class="image-preview" loading="lazy">
         </td>
         <td>
             <div class="image-name" title="${imageData.name}">${imageData.name}</div>
@@ -692,10 +737,7 @@ async function processImage() {
             formData.append('keep_ratio', imageData.keepRatio ? '1' : '0');
 
             try {
-                const response = await fetch('/upload', {
-                    method: 'POST',
-                    body: formData
-                });
+                const response = await uploadWithRetry(formData, imageData.name);
 
                 const result = await response.json();
 
@@ -758,6 +800,22 @@ async function processImage() {
     }
 }
 
+// Post an upload, waiting and retrying while the server sheds load with 503
+async function uploadWithRetry(formData, imageName, maxAttempts = 5) {
+    for (let attempt = 1; ; attempt++) {
+        const response = await fetch('/upload', {
+            method: 'POST',
+            body: formData
+        });
+        if (response.status !== 503 || attempt >= maxAttempts) {
+            return response;
+        }
+        const retryAfter = parseInt(response.headers.get('Retry-After')) || 2;
+        showStatus(`Server busy, retrying ${imageName} in ${retryAfter}s...`, 'warning');
+        await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+    }
+}
+
 // Display processing results in table format
 function displayResults(results) {
     const resultsTableBody = document.getElementById('resultsTableBody');
@@ -0,0 +1,175 @@
+# CellShader - Parameter sweeps and contact sheets
+# Renders one image with many parameter combinations, computing each shared pipeline step once.
+
+import itertools
+import math
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import cv2
+import numpy as np
+
+import profiling
+from pipeline import SOURCE
+
+logger = logging.getLogger(__name__)
+
+# Contact sheet layout.
+CELL_WIDTH = 320
+LABEL_HEIGHT = 28
+PADDING = 8
+BACKGROUND = (235, 235, 235)
+
+
+def parse_values(spec, cast, lower, upper, default, max_count=None):
+    """
+    Parse a sweep range into sorted unique values clamped to [lower, upper].
+
+    Accepts a list, a single value, a comma list such as '3,5,7', or an
+    inclusive 'start:stop:step' range such as '3:9:2'. Ranges are clipped to
+    [lower, upper] before they are expanded, and more than `max_count` values
+    raise ValueError before anything is built.
+    """
+    if spec is None or spec == '':
+        values = [default]
+    elif isinstance(spec, (list, tuple)):
+        values = [cast(value) for value in spec]
+    elif isinstance(spec, str) and ':' in spec:
+        parts = [cast(part) for part in spec.split(':')]
+        if len(parts) not in (2, 3):
+            raise ValueError(f"Invalid range: {spec}")
+        start, stop = parts[0], parts[1]
+        step = parts[2] if len(parts) == 3 else cast(1)
+        if step <= 0:
+            raise ValueError(f"Range step must be positive: {spec}")
+        count = max(0, int(math.floor((stop - start) / step + 1e-9)) + 1)
+        # Only steps inside [lower, upper] are expanded, values outside clamp to the bounds.
+        first = min(count, max(0, math.ceil((lower - start) / step - 1e-9)))
+        last = min(count - 1, int(math.floor((upper - start) / step + 1e-9)))
+        inside = max(0, last - first + 1)
+        if max_count is not None and inside > max_count:
+            raise ValueError(f"Range {spec} has {inside} values, the maximum is {max_count}")
+        values = [start + step * i for i in range(first, first + inside)]
+        if first > 0 and count > 0:
+            values.append(lower)
+        if last < count - 1:
+            values.append(upper)
+        if cast is float:
+            values = [round(value, 4) for value in values]
+    elif isinstance(spec, str):
+        values = [cast(part) for part in spec.split(',') if part.strip()]
+    else:
+        values = [cast(spec)]
+    values = sorted({max(lower, min(upper, value)) for value in values})
+    if max_count is not None and len(values) > max_count:
+        raise ValueError(f"{len(values)} values given, the maximum is {max_count}")
+    return values
+
+
+def plan_sweep(edge_values, color_values, smoothing_values, saturation_values):
+    """List the parameter combinations of a sweep, grouped so variants sharing color stages are adjacent."""
+    return [
+        {'edge_thickness': e, 'color_levels': c, 'smoothing_amount': s, 'saturation_amount': sat}
+        for s, sat, e, c in itertools.product(smoothing_values, saturation_values, edge_values, color_values)
+    ]
+
+
+def run_sweep(img, shading_pipeline, edge_values, color_values, smoothing_values, saturation_values, params=None, max_workers=4):
+    """
+    Render every parameter combination of an already resized image with one pipeline.
+
+    Every variant is planned on `shading_pipeline`, and each step runs once per
+    distinct combination of its inputs and the parameters it takes, so for
+    example k-means runs once per (smoothing, saturation, color levels) no
+    matter how many edge thicknesses are swept. Steps run on a thread pool
+    (OpenCV releases the GIL) as soon as their inputs are ready.
+
+    Args:
+        shading_pipeline (Pipeline): Pipeline from the registry, as for a single render
+        params (dict, optional): Parameters shared by every variant, such as edge_method
+
+    Returns:
+        tuple: (list of (parameters, image) in plan order, runs per stage, time per stage in ms)
+    """
+    variants = plan_sweep(edge_values, color_values, smoothing_values, saturation_values)
+
+    # Distinct step runs by key - the step's output, its parameters and the keys of its
+    # inputs - in the order they are first needed, which is also a valid run order.
+    runs, results = {}, []
+    for variant in variants:
+        variant_params = dict(params or {}, **variant)
+        plan = shading_pipeline.plan(variant_params, img.shape)
+        keys = {SOURCE: SOURCE}
+        for step, inputs, output in zip(plan.steps, plan.inputs, plan.outputs):
+            kwargs = step.params_for(variant_params)
+            key = (output, tuple(sorted(kwargs.items())), tuple(keys[name] for name in inputs))
+            runs.setdefault(key, (step, kwargs, key[2]))
+            keys[output] = key
+        results.append(keys[plan.output])
+
+    # Run counts and times per stage, in pipeline order.
+    stages = {step.stage.name: 0 for step in shading_pipeline.steps}
+    for step, _, _ in runs.values():
+        stages[step.stage.name] += 1
+    stages = {name: count for name, count in stages.items() if count}
+    timings = dict.fromkeys(stages, 0.0)
+    buffers = {SOURCE: img}
+
+    def run(key):
+        step, kwargs, inputs = runs[key]
+        start = time.perf_counter()
+        with profiling.span(step.stage.name, 'sweep', **kwargs):
+            output = step.stage.func(*[buffers[input_key] for input_key in inputs], **kwargs)
+        return output, (time.perf_counter() - start) * 1000
+
+    pending, running = list(runs), {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        run_step = profiling.propagate(run)
+        while pending or running:
+            ready = [key for key in pending if all(input_key in buffers for input_key in runs[key][2])]
+            if ready:
+                pending = [key for key in pending if key not in set(ready)]
+                for key in ready:
+                    running[pool.submit(run_step, key)] = key
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                buffers[key], elapsed_ms = future.result()
+                timings[runs[key][0].stage.name] += elapsed_ms
+
+    logger.info(f"Sweep rendered {len(variants)} variant(s) with {shading_pipeline.name}, stage runs {stages}")
+    return ([(variant, buffers[key]) for variant, key in zip(variants, results)], stages,
+            {name: round(elapsed_ms, 1) for name, elapsed_ms in timings.items()})
+
+
+def variant_label(params):
+    """Short label for a variant, used on the contact sheet and in filenames."""
+    return (f"E{params['edge_thickness']} C{params['color_levels']} "
+            f"S{params['smoothing_amount']} Sat{params['saturation_amount']:.2f}")
+
+
+def build_contact_sheet(results, cell_width=CELL_WIDTH):
+    """Lay out labeled thumbnails of every variant in a grid."""
+    if not results:
+        raise ValueError("No renders to place on the contact sheet")
+    height, width = results[0][1].shape[:2]
+    cell_width = min(cell_width, width)
+    cell_height = max(1, int(round(height * cell_width / width)))
+    columns = int(math.ceil(math.sqrt(len(results))))
+    rows = int(math.ceil(len(results) / columns))
+
+    sheet_width = columns * cell_width + (columns + 1) * PADDING
+    sheet_height = rows * (cell_height + LABEL_HEIGHT) + (rows + 1) * PADDING
+    sheet = np.full((sheet_height, sheet_width, 3), BACKGROUND, dtype=np.uint8)
+
+    for index, (params, image) in enumerate(results):
+        row, column = divmod(index, columns)
+        x = PADDING + column * (cell_width + PADDING)
+        y = PADDING + row * (cell_height + LABEL_HEIGHT + PADDING)
+        sheet[y:y + cell_height, x:x + cell_width] = cv2.resize(image, (cell_width, cell_height), interpolation=cv2.INTER_AREA)
+        # White label band under each thumbnail.
+        sheet[y + cell_height:y + cell_height + LABEL_HEIGHT, x:x + cell_width] = 255
+        cv2.putText(sheet, variant_label(params), (x + 4, y + cell_height + LABEL_HEIGHT - 9),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 0), 1, cv2.LINE_AA)
+    return sheet
@@ -0,0 +1,25 @@
+# CellShader - Synthetic test images
+# Photo-like JPEG images generated from a seed, shared by the load test and the benchmarks.
+
+import cv2
+import numpy as np
+
+
+def make_images(sizes, seed):
+    """Create synthetic JPEG test images: smooth gradients with blobs and noise, like photos."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for size in sizes.split(','):
+        width, height = (int(v) for v in size.lower().split('x'))
+        x = np.linspace(0, 255, width, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+        img = np.dstack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)),
+                         np.broadcast_to((x + y) / 2, (height, width))]).astype(np.uint8).copy()
+        for _ in range(12):
+            center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            radius = int(rng.integers(10, max(11, min(width, height) // 4)))
+            cv2.circle(img, center, radius, tuple(int(c) for c in rng.integers(0, 256, 3)), -1)
+        img = cv2.add(img, rng.integers(0, 20, img.shape, dtype=np.uint8))
+        ok, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        images.append({'name': f"load_{width}x{height}.jpg", 'size': f"{width}x{height}", 'data': buffer.tobytes()})
+    return images
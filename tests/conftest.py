@@ -0,0 +1,7 @@
+# CellShader - Test configuration
+# Makes the application modules importable from the tests folder.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,117 @@
+# CellShader - Admission control tests
+# Lane priority, per-client round-robin dispatch, head-of-line order and load shedding.
+
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, LANE_FULL, LANE_PREVIEW
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'condition not reached in time'
+        time.sleep(0.005)
+
+
+def run_queued(controller, requests):
+    """
+    Queue requests behind a held slot, in order, then free the slot.
+
+    Args:
+        requests: (name, client_id, pixel_count, lane) tuples
+
+    Returns:
+        list: Request names in the order they were granted
+    """
+    order = []
+    held = controller.acquire('holder', 1)
+    threads = []
+    for name, client_id, pixel_count, lane in requests:
+        def request(name=name, client_id=client_id, pixel_count=pixel_count, lane=lane):
+            with controller.slot(client_id, pixel_count, lane):
+                order.append(name)
+        queued = controller.stats()['queued']
+        thread = threading.Thread(target=request)
+        thread.start()
+        threads.append(thread)
+        # Enqueue one at a time so the queue order is known.
+        wait_until(lambda: controller.stats()['queued'] == queued + 1)
+    controller.release(held)
+    for thread in threads:
+        thread.join(5)
+    return order
+
+
+def test_clients_are_served_round_robin():
+    controller = AdmissionController(max_concurrent=1, max_queue=10, max_queue_per_client=5)
+    order = run_queued(controller, [
+        ('a1', 'a', 1, LANE_FULL), ('a2', 'a', 1, LANE_FULL), ('a3', 'a', 1, LANE_FULL),
+        ('b1', 'b', 1, LANE_FULL), ('b2', 'b', 1, LANE_FULL)
+    ])
+    assert order == ['a1', 'b1', 'a2', 'b2', 'a3']
+
+
+def test_preview_lane_goes_first():
+    controller = AdmissionController(max_concurrent=1, max_queue=10)
+    order = run_queued(controller, [
+        ('full', 'a', 1, LANE_FULL), ('preview', 'b', 1, LANE_PREVIEW), ('full2', 'b', 1, LANE_FULL)
+    ])
+    assert order == ['preview', 'full', 'full2']
+
+
+def test_large_render_is_not_starved_by_small_ones():
+    controller = AdmissionController(max_concurrent=2, max_queue=10, pixels_per_unit=100)
+    held = controller.acquire('holder', 100)
+    big_granted = threading.Event()
+
+    def big():
+        with controller.slot('big', 200, LANE_FULL):
+            big_granted.set()
+
+    thread = threading.Thread(target=big)
+    thread.start()
+    wait_until(lambda: controller.stats()['queued'] == 1)
+    # A cost-1 request would fit next to the holder, but must queue behind the big one.
+    controller.queue_timeout = 0.1
+    with pytest.raises(AdmissionRejected, match='Timed out'):
+        controller.acquire('small', 100, LANE_FULL)
+    controller.release(held)
+    thread.join(5)
+    assert big_granted.is_set()
+
+
+def test_cost_and_lane_follow_pixel_count():
+    controller = AdmissionController(max_concurrent=4, pixels_per_unit=1000, preview_max_pixels=500)
+    assert [controller.estimate_cost(pixels) for pixels in (0, 1000, 1001, 10 ** 9)] == [1, 1, 2, 4]
+    assert controller.classify(500) == LANE_PREVIEW
+    assert controller.classify(501) == LANE_FULL
+    assert controller.classify(100, LANE_FULL) == LANE_FULL
+    # A large render cannot jump into the preview lane by asking for it.
+    assert controller.classify(501, LANE_PREVIEW) == LANE_FULL
+
+
+def test_full_queue_and_busy_client_are_shed():
+    controller = AdmissionController(max_concurrent=1, max_queue=2, max_queue_per_client=1, queue_timeout=5)
+    held = controller.acquire('holder', 1)
+    threads = [threading.Thread(target=lambda c=client: controller.release(controller.acquire(c, 1))) for client in 'ab']
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: controller.stats()['queued'] == 2)
+
+    with pytest.raises(AdmissionRejected, match='queue is full') as rejected:
+        controller.acquire('c', 1)
+    assert rejected.value.retry_after >= 1
+    with pytest.raises(AdmissionRejected):
+        controller.check_capacity()
+
+    controller.max_queue = 3
+    with pytest.raises(AdmissionRejected, match='Too many queued requests'):
+        controller.acquire('a', 1)
+    controller.release(held)
+    for thread in threads:
+        thread.join(5)
+    stats = controller.stats()
+    assert (stats['queued'], stats['in_use'], stats['rejected']) == (0, 0, 3)
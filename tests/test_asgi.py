@@ -0,0 +1,47 @@
+# CellShader - ASGI front end tests
+# Drive the ASGI application directly, without a server.
+
+import asyncio
+import json
+
+import app as cellshader
+from asgi import AsyncFrontEnd
+
+
+def _call(front_end, method, path, body=b''):
+    messages = []
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': [], 'http_version': '1.1'}
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(front_end(scope, receive, send))
+    start = messages[0]
+    payload = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], dict(start['headers']), json.loads(payload) if payload else None
+
+
+def _front_end(monkeypatch, render_threads):
+    monkeypatch.setitem(cellshader.app_config, 'async_render_threads', render_threads)
+    return AsyncFrontEnd(factory=lambda: cellshader.app)
+
+
+def test_health_is_answered_on_the_event_loop(monkeypatch):
+    front_end = _front_end(monkeypatch, 1)
+    status, _, payload = _call(front_end, 'GET', '/health')
+    assert status == 200
+    assert payload['front_end']['render_threads'] == 1
+
+
+def test_renders_are_shed_when_every_render_thread_is_busy(monkeypatch):
+    front_end = _front_end(monkeypatch, 1)
+    _call(front_end, 'GET', '/health')
+    front_end.renders_in_flight = 1
+    status, headers, payload = _call(front_end, 'POST', '/upload')
+    assert status == 503
+    assert payload['success'] is False
+    assert int(headers[b'retry-after']) >= 1
+    assert front_end.renders_in_flight == 1
@@ -0,0 +1,135 @@
+# CellShader - Blob store tests
+# Reference counting, aliases, exclusive links, index corruption and concurrent writers.
+
+import json
+import multiprocessing
+import os
+
+import pytest
+
+from blob_store import BlobStore, BlobIndexError
+
+
+def test_identical_content_is_stored_once(tmp_path):
+    store = BlobStore(str(tmp_path / 'blobs'))
+    digest, size, is_new = store.store_bytes(b'image bytes', '.jpg')
+    again, _, is_new_again = store.store_bytes(b'image bytes', '.jpg')
+    assert (again, size, is_new, is_new_again) == (digest, 11, True, False)
+    assert store.stats()['blobs'] == 1
+
+
+def test_blob_is_removed_with_its_last_reference(tmp_path):
+    store = BlobStore(str(tmp_path / 'blobs'))
+    digest, _, _ = store.store_bytes(b'render', '.png')
+    store.add_alias('render-key', digest)
+    store.link(digest, str(tmp_path / 'a.png'))
+    store.link(digest, str(tmp_path / 'b.png'))
+    assert store.get(digest)['refs'] == 2
+    assert (tmp_path / 'a.png').read_bytes() == b'render'
+
+    assert store.release(digest) is False
+    assert store.get(digest)['refs'] == 1
+    assert store.release(digest) is True
+    assert store.get(digest) is None
+    assert store.blob_path(digest) is None
+    assert store.find_alias('render-key') is None
+
+
+def test_link_never_overwrites_an_existing_file(tmp_path):
+    store = BlobStore(str(tmp_path / 'blobs'))
+    first, _, _ = store.store_bytes(b'first', '.jpg')
+    second, _, _ = store.store_bytes(b'second', '.jpg')
+    dest = str(tmp_path / 'upload.jpg')
+    store.link(first, dest)
+    with pytest.raises(FileExistsError):
+        store.link(second, dest)
+    assert open(dest, 'rb').read() == b'first'
+    assert store.get(second)['refs'] == 0
+
+    store.link(second, dest, replace=True)
+    assert open(dest, 'rb').read() == b'second'
+    # The replaced link gave up its reference, which was the last one on `first`.
+    assert store.get(first) is None
+    assert store.get(second)['refs'] == 1
+
+
+def test_replacing_with_the_same_blob_keeps_one_reference(tmp_path):
+    # A retried render job links the same output again over its earlier attempt.
+    store = BlobStore(str(tmp_path / 'blobs'))
+    digest, _, _ = store.store_bytes(b'render', '.png')
+    dest = str(tmp_path / 'render.png')
+    for _ in range(3):
+        store.link(digest, dest, replace=True)
+    assert store.get(digest)['refs'] == 1
+
+
+def test_restoring_a_missing_blob_file_keeps_its_references(tmp_path):
+    store = BlobStore(str(tmp_path / 'blobs'))
+    digest, _, _ = store.store_bytes(b'original', '.jpg')
+    store.link(digest, str(tmp_path / 'a.jpg'))
+    store.link(digest, str(tmp_path / 'b.jpg'))
+    os.remove(store.blob_path(digest))
+
+    _, _, is_new = store.store_bytes(b'original', '.jpg')
+    assert is_new is True
+    assert store.get(digest)['refs'] == 2
+    assert store.release(digest) is False
+
+
+def test_index_is_only_read_again_after_another_store_changes_it(tmp_path, monkeypatch):
+    store, other = BlobStore(str(tmp_path / 'blobs')), BlobStore(str(tmp_path / 'blobs'))
+    digest, _, _ = store.store_bytes(b'shared', '.jpg')
+    loads = []
+    real_load = json.load
+    monkeypatch.setattr(json, 'load', lambda f: loads.append(f.name) or real_load(f))
+
+    for _ in range(3):
+        store.get(digest)
+    assert loads == []
+    # Another process (here another store) replaced the index file.
+    other.link(digest, str(tmp_path / 'a.jpg'))
+    assert store.get(digest)['refs'] == 1
+    assert len(loads) == 2
+
+
+def test_link_of_unknown_blob_raises(tmp_path):
+    store = BlobStore(str(tmp_path / 'blobs'))
+    with pytest.raises(KeyError):
+        store.link('0' * 64, str(tmp_path / 'missing.jpg'))
+
+
+def test_corrupt_index_is_not_reset(tmp_path):
+    store = BlobStore(str(tmp_path / 'blobs'))
+    digest, _, _ = store.store_bytes(b'kept', '.jpg')
+    with open(store.index_file, 'a', encoding='utf-8') as f:
+        f.write('garbage')
+    with pytest.raises(BlobIndexError):
+        store.store_bytes(b'other', '.jpg')
+    with open(store.index_file, 'r', encoding='utf-8') as f:
+        assert digest in f.read()
+
+
+def _store_and_link(root, dest_folder, worker, count):
+    store = BlobStore(root)
+    for index in range(count):
+        digest, _, _ = store.store_bytes(f"{worker}-{index}".encode(), '.bin')
+        store.link(digest, os.path.join(dest_folder, f"{worker}-{index}.bin"))
+
+
+def test_concurrent_processes_keep_every_blob_indexed(tmp_path):
+    root = str(tmp_path / 'blobs')
+    dest_folder = str(tmp_path / 'links')
+    processes, count = 3, 60
+    workers = [multiprocessing.get_context('spawn').Process(target=_store_and_link, args=(root, dest_folder, worker, count))
+               for worker in range(processes)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join(60)
+        assert process.exitcode == 0
+
+    with open(os.path.join(root, 'index.json'), 'r', encoding='utf-8') as f:
+        blobs = json.load(f)['blobs']
+    assert len(blobs) == processes * count
+    assert all(entry['refs'] == 1 for entry in blobs.values())
+    assert len(os.listdir(dest_folder)) == processes * count
@@ -0,0 +1,111 @@
+# CellShader - Job broker tests
+# Leases, retries, cancellation, waiting and queue depth on the SQLite broker,
+# and the pipeline check worker nodes run on render jobs.
+
+import time
+
+import pytest
+
+import app as cellshader
+from broker import JOB_DONE, JOB_FAILED, JOB_QUEUED, JobFailed, SQLiteBroker, create_broker
+from pipeline import PipelineError
+
+
+def make_broker(tmp_path, **config):
+    broker = SQLiteBroker(str(tmp_path / 'broker.sqlite'))
+    broker.configure({'broker_lease_seconds': 30, 'broker_max_attempts': 2, 'broker_poll_interval': 0.01, **config})
+    return broker
+
+
+def test_job_is_claimed_once_and_completed(tmp_path):
+    broker = make_broker(tmp_path)
+    job_id = broker.publish('render', {'file': 'a.png'})
+    job = broker.claim('worker-a')
+    assert (job['id'], job['payload'], job['attempts']) == (job_id, {'file': 'a.png'}, 1)
+    assert broker.claim('worker-b') is None
+
+    assert broker.complete(job_id, 'worker-b', {'url': 'x'}) is False
+    assert broker.complete(job_id, 'worker-a', {'url': 'x'}) is True
+    assert broker.get(job_id)['status'] == JOB_DONE
+    assert broker.wait(job_id, 1) == {'url': 'x'}
+
+
+def test_claim_filters_by_kind(tmp_path):
+    broker = make_broker(tmp_path)
+    broker.publish('other', {})
+    assert broker.claim('worker-a', ['render']) is None
+    assert broker.claim('worker-a', ['other'])['kind'] == 'other'
+
+
+def test_expired_lease_is_reclaimed_and_finally_fails(tmp_path):
+    broker = make_broker(tmp_path, broker_lease_seconds=1)
+    job_id = broker.publish('render', {})
+    assert broker.claim('worker-a')['attempts'] == 1
+    assert broker.heartbeat(job_id, 'worker-a') is True
+    time.sleep(1.1)
+
+    job = broker.claim('worker-b')
+    assert (job['id'], job['attempts']) == (job_id, 2)
+    assert broker.heartbeat(job_id, 'worker-a') is False
+    assert broker.complete(job_id, 'worker-a', {}) is False
+    time.sleep(1.1)
+
+    # The second lease ran out on the last allowed attempt.
+    assert broker.claim('worker-c') is None
+    assert broker.get(job_id)['status'] == JOB_FAILED
+
+
+def test_failed_job_is_retried_up_to_max_attempts(tmp_path):
+    broker = make_broker(tmp_path)
+    job_id = broker.publish('render', {})
+    broker.fail(job_id, broker.claim('worker-a')['worker'], 'boom')
+    assert broker.get(job_id)['status'] == JOB_QUEUED
+
+    broker.fail(job_id, broker.claim('worker-a')['worker'], 'boom again')
+    job = broker.get(job_id)
+    assert (job['status'], job['error'], job['attempts']) == (JOB_FAILED, 'boom again', 2)
+    with pytest.raises(JobFailed, match='boom again'):
+        broker.wait(job_id, 1)
+
+
+def test_cancelled_job_is_not_claimed(tmp_path):
+    broker = make_broker(tmp_path)
+    job_id = broker.publish('render', {})
+    broker.cancel(job_id)
+    assert broker.claim('worker-a') is None
+    with pytest.raises(JobFailed):
+        broker.wait(job_id, 1)
+
+
+def test_wait_times_out_and_depth_counts_unfinished_jobs(tmp_path):
+    broker = make_broker(tmp_path)
+    first = broker.publish('render', {})
+    broker.publish('render', {})
+    broker.claim('worker-a')
+    assert broker.depth() == 2
+    with pytest.raises(TimeoutError):
+        broker.wait(first, 0.05)
+
+    broker.complete(first, 'worker-a', {})
+    assert broker.depth() == 1
+    assert broker.stats()['jobs'][JOB_QUEUED] == 1
+
+
+def test_unknown_backend_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        create_broker({'broker_backend': 'os:system'}, str(tmp_path / 'broker.sqlite'))
+
+
+def test_worker_refuses_a_job_for_a_different_pipeline(monkeypatch):
+    reloads = []
+    monkeypatch.setattr(cellshader, 'load_app_config', lambda: reloads.append(True))
+    job = cellshader.render_job('uploads/a.png', 'a_cell.png', 'uploads/cell-shaded', pipeline_name='realtime')
+    assert job['pipeline_digest'] == cellshader.pipelines['realtime'].digest
+    cellshader.check_job_pipeline(job)
+    assert reloads == []
+
+    # The web node's definition of the pipeline differs, even after this node reloads its config.
+    job['pipeline_digest'] = '0' * 64
+    with pytest.raises(PipelineError):
+        cellshader.check_job_pipeline(job)
+    assert reloads == [True]
@@ -0,0 +1,51 @@
+# CellShader - Inter-process file lock tests
+# Reentrancy and read-modify-write cycles from several processes.
+
+import json
+import multiprocessing
+import threading
+
+from file_lock import FileLock
+
+
+def _append_entries(lock_path, data_path, worker, count):
+    lock = FileLock(lock_path)
+    for index in range(count):
+        with lock:
+            with open(data_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            entries.append(f"{worker}-{index}")
+            with open(data_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+
+
+def test_processes_do_not_lose_each_others_writes(tmp_path):
+    lock_path, data_path = str(tmp_path / '.lock'), str(tmp_path / 'data.json')
+    with open(data_path, 'w', encoding='utf-8') as f:
+        json.dump([], f)
+    workers = [multiprocessing.get_context('spawn').Process(target=_append_entries, args=(lock_path, data_path, worker, 40))
+               for worker in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+    with open(data_path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    assert len(entries) == len(set(entries)) == 160
+
+
+def test_lock_is_reentrant_and_excludes_other_threads(tmp_path):
+    lock = FileLock(str(tmp_path / 'sub' / '.lock'))
+    entered = threading.Event()
+
+    def other():
+        with lock:
+            entered.set()
+
+    with lock:
+        with lock:
+            thread = threading.Thread(target=other)
+            thread.start()
+            assert not entered.wait(0.2)
+    thread.join(5)
+    assert entered.is_set()
@@ -0,0 +1,53 @@
+# CellShader - Shared-memory frame pool tests
+# Renders through worker processes and recovery from a worker that dies.
+
+import os
+
+import numpy as np
+import pytest
+
+from frame_pool import PoolUnavailable, SharedFramePool
+from pipeline import BUILTIN_PIPELINES, Pipeline, REALTIME_PIPELINE
+
+pytestmark = pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='needs POSIX shared memory')
+
+PARAMS = {'edge_thickness': 3, 'edge_method': 'sobel', 'color_levels': 4, 'smoothing_amount': 5, 'saturation_amount': 1.0,
+          'target_width': None, 'target_height': None, 'keep_ratio': True}
+
+
+@pytest.fixture
+def pool():
+    frame_pool = SharedFramePool()
+    frame_pool.configure({'processing_workers': 1, 'processing_slots': 2, 'processing_slot_pixels': 64 * 64})
+    frame_pool.start()
+    yield frame_pool
+    frame_pool.stop()
+
+
+def kill_workers(frame_pool):
+    for process in list(frame_pool._ring.executor._processes.values()):
+        process.kill()
+        process.join(10)
+
+
+def test_broken_pool_frees_slots_after_holders_drain_and_is_rebuilt(pool):
+    shading_pipeline = Pipeline(REALTIME_PIPELINE, BUILTIN_PIPELINES[REALTIME_PIPELINE])
+    img = np.random.default_rng(1).integers(0, 256, (48, 64, 3), dtype=np.uint8)
+    expected = shading_pipeline.run(img, PARAMS)
+    names = [segment.name for segment in pool._ring.segments]
+
+    with pool.render(img, shading_pipeline, PARAMS) as held:
+        assert np.array_equal(held, expected)
+        kill_workers(pool)
+        with pytest.raises(PoolUnavailable):
+            with pool.render(img, shading_pipeline, PARAMS):
+                pass
+        # The first render still reads its slot, so nothing is unlinked yet.
+        assert all(os.path.exists(f"/dev/shm/{name}") for name in names)
+        assert np.array_equal(held, expected)
+    del held
+    assert not any(os.path.exists(f"/dev/shm/{name}") for name in names)
+
+    with pool.render(img, shading_pipeline, PARAMS) as rendered:
+        assert np.array_equal(rendered, expected)
+    assert pool.stats()['rebuilds'] == 1
@@ -0,0 +1,99 @@
+# CellShader - Image index tests
+# Cursor pagination in both orders, range filters and rebuilds on metadata changes.
+
+import json
+
+import pytest
+
+from image_index import ImageIndex, InvalidQuery
+
+
+def write_metadata(path, images):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(images, f)
+
+
+def make_index(tmp_path, images):
+    path = tmp_path / 'metadata.json'
+    write_metadata(path, images)
+    return ImageIndex(str(path), lambda: json.loads(path.read_text(encoding='utf-8'))), path
+
+
+def sample_images(count=25):
+    # Repeated sizes and times, so pages have to break ties on the id.
+    return [{
+        'id': image_id,
+        'original_name': f"Photo {image_id:02d}.jpg",
+        'file_size': 1000 * (image_id % 7),
+        'upload_time': f"2026-01-{1 + image_id % 5:02d}T10:00:00"
+    } for image_id in range(1, count + 1)]
+
+
+def all_pages(index, **query):
+    ids, cursor, pages = [], None, 0
+    while True:
+        page = index.query(cursor=cursor, **query)
+        ids.extend(img['id'] for img in page['images'])
+        pages += 1
+        cursor = page['next_cursor']
+        if cursor is None:
+            return ids, pages
+
+
+@pytest.mark.parametrize('sort', ['upload_time', 'name', 'size'])
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+def test_pages_cover_every_image_once_in_order(tmp_path, sort, order):
+    images = sample_images()
+    index, _ = make_index(tmp_path, images)
+    ids, pages = all_pages(index, sort=sort, order=order, limit=4)
+
+    key = {'upload_time': lambda img: img['upload_time'], 'name': lambda img: img['original_name'].lower(),
+           'size': lambda img: img['file_size']}[sort]
+    expected = [img['id'] for img in sorted(images, key=lambda img: (key(img), img['id']), reverse=order == 'desc')]
+    assert ids == expected
+    assert pages == 7
+
+
+def test_last_full_page_has_no_cursor(tmp_path):
+    index, _ = make_index(tmp_path, sample_images(8))
+    first = index.query(limit=4)
+    second = index.query(limit=4, cursor=first['next_cursor'])
+    assert len(second['images']) == 4
+    assert second['next_cursor'] is None
+
+
+def test_range_filters_on_the_sort_field_and_others(tmp_path):
+    images = sample_images()
+    index, _ = make_index(tmp_path, images)
+    ids, _ = all_pages(index, sort='size', order='desc', limit=3, min_size=2000, max_size=4000, name='photo 1')
+    expected = sorted((img for img in images if 2000 <= img['file_size'] <= 4000 and 'photo 1' in img['original_name'].lower()),
+                      key=lambda img: (img['file_size'], img['id']), reverse=True)
+    assert ids == [img['id'] for img in expected]
+
+    page = index.query(sort='upload_time', uploaded_after='2026-01-05', limit=100)
+    assert {img['upload_time'][:10] for img in page['images']} == {'2026-01-05'}
+
+
+def test_metadata_change_rebuilds_and_changes_version(tmp_path):
+    images = sample_images(3)
+    index, path = make_index(tmp_path, images)
+    version = index.version()
+    write_metadata(path, images + [{'id': 4, 'original_name': 'New.jpg', 'file_size': 1, 'upload_time': '2026-02-01T00:00:00'}])
+    index.invalidate()
+    page = index.query(order='desc', limit=1)
+    assert page['images'][0]['id'] == 4
+    assert page['total'] == 4
+    assert page['version'] != version
+
+
+def test_bad_queries_are_rejected(tmp_path):
+    index, _ = make_index(tmp_path, sample_images(5))
+    cursor = index.query(sort='name', limit=2)['next_cursor']
+    with pytest.raises(InvalidQuery):
+        index.query(sort='size', cursor=cursor)
+    with pytest.raises(InvalidQuery):
+        index.query(sort='name', order='desc', cursor=cursor)
+    with pytest.raises(InvalidQuery):
+        index.query(cursor='not a cursor')
+    with pytest.raises(InvalidQuery):
+        index.query(sort='colour')
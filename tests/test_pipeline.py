@@ -0,0 +1,92 @@
+# CellShader - Pipeline planning and execution tests
+
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import pipeline
+from pipeline import Pipeline, PipelineError, Stage, STAGES, SOURCE
+
+STEP_SECONDS = 0.1
+
+
+def _sleep_stage(name, inputs, output):
+    def func(*buffers):
+        time.sleep(STEP_SECONDS)
+        return buffers[0] + 1
+    return Stage(name, func, inputs, output)
+
+
+@pytest.fixture
+def sleep_stages(monkeypatch):
+    monkeypatch.setitem(STAGES, 'test_head', _sleep_stage('test_head', (SOURCE,), 'head'))
+    monkeypatch.setitem(STAGES, 'test_left', _sleep_stage('test_left', ('head',), 'left'))
+    monkeypatch.setitem(STAGES, 'test_right', _sleep_stage('test_right', ('head',), 'right'))
+    monkeypatch.setitem(STAGES, 'test_join', _sleep_stage('test_join', ('left', 'right'), 'result'))
+    monkeypatch.setitem(STAGES, 'test_chain', _sleep_stage('test_chain', (SOURCE,), SOURCE))
+
+
+def _run_concurrently(shading_pipeline, renders):
+    img = np.zeros((4, 4, 3), np.uint8)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(shading_pipeline.run(img, {})))
+               for _ in range(renders)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, results
+
+
+def test_branches_run_side_by_side(sleep_stages):
+    branchy = Pipeline('branchy', ['test_head', 'test_left', 'test_right', 'test_join'])
+    report = {}
+    start = time.perf_counter()
+    result = branchy.run(np.zeros((4, 4, 3), np.uint8), {}, report=report)
+    # Critical path is head, one branch, join.
+    assert time.perf_counter() - start < 4 * STEP_SECONDS
+    assert int(result[0, 0, 0]) == 3
+    assert set(report['timings_ms']) == {'test_head', 'test_left', 'test_right', 'test_join'}
+
+
+def test_concurrent_renders_do_not_serialize_on_the_branch_pool(sleep_stages):
+    branchy = Pipeline('branchy', ['test_head', 'test_left', 'test_right', 'test_join'])
+    renders = pipeline.BRANCH_WORKERS * 2
+    elapsed, results = _run_concurrently(branchy, renders)
+    assert len(results) == renders
+    assert elapsed < 5 * STEP_SECONDS
+
+
+def test_linear_chains_run_on_the_calling_thread(sleep_stages):
+    chain = Pipeline('chain', ['test_chain'] * 5)
+    elapsed, results = _run_concurrently(chain, pipeline.BRANCH_WORKERS * 2)
+    assert all(int(result[0, 0, 0]) == 5 for result in results)
+    assert elapsed < 7 * STEP_SECONDS
+
+
+def test_cell_shade_output_matches_requested_size():
+    img = np.random.default_rng(0).integers(0, 256, (60, 80, 3), dtype=np.uint8)
+    params = {'edge_thickness': 5, 'color_levels': 4, 'smoothing_amount': 5, 'saturation_amount': 1.2,
+              'target_width': 40, 'target_height': None, 'keep_ratio': True, 'edge_method': 'adaptive'}
+    report = {}
+    result = pipeline.load_pipelines({})['cell_shade'].run(img, params, report=report)
+    assert result.shape == (30, 40, 3)
+    assert report['stages'][0] == 'resize'
+
+
+def test_reading_a_buffer_before_it_is_produced_is_rejected():
+    with pytest.raises(PipelineError):
+        Pipeline('broken', ['edges', 'combine'])
+
+
+@pytest.mark.parametrize('spec', [{'stage': 'smooth', 'params': [1]}, {'stage': ['smooth']}, {'stage': 'smooth', 'inputs': 5}])
+def test_malformed_config_pipeline_is_left_out(spec):
+    # Only the bad pipeline is dropped, the rest of the config still loads.
+    loaded = pipeline.load_pipelines({'pipelines': {'broken': [spec], 'plain': ['resize', 'smooth']}})
+    assert 'broken' not in loaded
+    assert 'plain' in loaded
+    with pytest.raises(PipelineError):
+        Pipeline('broken', [spec])
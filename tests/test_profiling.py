@@ -0,0 +1,28 @@
+# CellShader - Profiler tests
+# Captures are serialized, sampled traces are not.
+
+import pytest
+
+from profiling import CaptureBusy, Profiler
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    profiler = Profiler(str(tmp_path / 'traces'))
+    profiler.configure({'profiling_enabled': True, 'profiling_admin_token': 'secret', 'profiling_sample_rate': 1.0})
+    return profiler
+
+
+def test_overlapping_captures_are_refused_until_the_first_finishes(profiler):
+    trace, token = profiler.begin('first', 'upload_file', capture=True)
+    with pytest.raises(CaptureBusy):
+        profiler.begin('second', 'upload_file', capture=True)
+    # Span-only sampling does not need cProfile and still runs alongside.
+    sampled, sampled_token = profiler.begin('sampled', 'upload_file')
+    assert sampled is not None and sampled.profiler is None
+    profiler.finish(sampled, sampled_token)
+    profiler.finish(trace, token)
+
+    trace, token = profiler.begin('third', 'upload_file', capture=True)
+    profiler.finish(trace, token)
+    assert profiler.get_trace('third') is not None
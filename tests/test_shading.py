@@ -0,0 +1,64 @@
+# CellShader - Edge backend tests
+# Line widths of the thickness-correct backends and the one-pixel thinning they share.
+
+import cv2
+import numpy as np
+import pytest
+
+import shading
+
+
+def dark_runs(line):
+    """Lengths of the runs of line pixels (0) along one row or column of a mask."""
+    runs, length = [], 0
+    for value in line:
+        if value == 0:
+            length += 1
+        elif length:
+            runs.append(length)
+            length = 0
+    if length:
+        runs.append(length)
+    return runs
+
+
+@pytest.fixture(scope='module')
+def square_source():
+    img = np.full((200, 200, 3), 60, np.uint8)
+    cv2.rectangle(img, (50, 50), (150, 150), (200, 200, 200), -1)
+    return shading.edge_source(shading.smooth_image(img, 7))
+
+
+@pytest.mark.parametrize('method', ['mean', 'canny', 'sobel', 'dog'])
+@pytest.mark.parametrize('thickness', [1, 3, 5, 9])
+def test_lines_are_edge_thickness_wide(square_source, method, thickness):
+    mask = shading.detect_edges(square_source, thickness, method)
+    # Row and column 75 each cross two sides of the square.
+    assert dark_runs(mask[75]) == [thickness, thickness]
+    assert dark_runs(mask[:, 75]) == [thickness, thickness]
+
+
+def test_thinning_keeps_lines_connected():
+    mask = np.full((60, 60), 255, np.uint8)
+    cv2.line(mask, (5, 5), (55, 40), 0, 7)
+    cv2.rectangle(mask, (10, 45), (50, 52), 0, -1)
+    thinned = shading._thin_lines(mask)
+    lines = (thinned == 0).astype(np.uint8)
+    assert cv2.connectedComponents(lines, connectivity=8)[0] - 1 == 2
+    # Nothing is left that a one-pixel line would not need.
+    assert lines.sum() < 0.25 * (mask == 0).sum()
+    assert not np.any(cv2.erode(lines, np.ones((2, 2), np.uint8)))
+
+
+def test_thinning_an_empty_mask_is_a_no_op():
+    mask = np.full((10, 10), 255, np.uint8)
+    assert np.array_equal(shading._thin_lines(mask), mask)
+
+
+def test_sobel_does_not_use_the_thinning_loop(square_source, monkeypatch):
+    # Sobel edges run in the realtime pipeline, so they rely on non-maximum suppression instead.
+    def fail(mask):
+        raise AssertionError('Zhang-Suen thinning called on the realtime path')
+    monkeypatch.setattr(shading, '_thin_lines', fail)
+    mask = shading.detect_edges(square_source, 3, 'sobel')
+    assert dark_runs(mask[75]) == [3, 3]
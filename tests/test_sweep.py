@@ -0,0 +1,52 @@
+# CellShader - Sweep range parsing and shared-step rendering tests
+
+import numpy as np
+import pytest
+
+import sweep
+from pipeline import BUILTIN_PIPELINES, Pipeline, REALTIME_PIPELINE
+
+
+def test_ranges_lists_and_single_values():
+    assert sweep.parse_values('3:9:2', int, 1, 10, 7) == [3, 5, 7, 9]
+    assert sweep.parse_values('3,5,3', int, 1, 10, 7) == [3, 5]
+    assert sweep.parse_values([0.5, 1.5], float, 0.0, 2.0, 1.0) == [0.5, 1.5]
+    assert sweep.parse_values(None, int, 1, 10, 7) == [7]
+    assert sweep.parse_values('0.5:1.5:0.5', float, 0.0, 2.0, 1.0) == [0.5, 1.0, 1.5]
+
+
+def test_values_outside_the_bounds_are_clamped():
+    assert sweep.parse_values('0:10:3', int, 1, 10, 7) == [1, 3, 6, 9]
+    assert sweep.parse_values('8:30:4', int, 1, 10, 7) == [8, 10]
+    assert sweep.parse_values('3,5,99', int, 1, 10, 7) == [3, 5, 10]
+
+
+def test_huge_ranges_are_clipped_before_expanding():
+    assert sweep.parse_values('1:20000000', int, 1, 10, 7, max_count=36) == list(range(1, 11))
+
+
+def test_too_many_values_are_rejected():
+    with pytest.raises(ValueError):
+        sweep.parse_values('0:2:0.0000001', float, 0.0, 2.0, 1.0, max_count=36)
+    with pytest.raises(ValueError):
+        sweep.parse_values('1:10', int, 1, 10, 7, max_count=4)
+
+
+def test_invalid_ranges_are_rejected():
+    with pytest.raises(ValueError):
+        sweep.parse_values('1:5:0', int, 1, 10, 7)
+    with pytest.raises(ValueError):
+        sweep.parse_values('1:2:3:4', int, 1, 10, 7)
+
+
+def test_sweep_runs_the_given_pipeline_and_shares_its_steps():
+    shading_pipeline = Pipeline(REALTIME_PIPELINE, BUILTIN_PIPELINES[REALTIME_PIPELINE])
+    img = np.random.default_rng(1).integers(0, 256, (60, 80, 3), dtype=np.uint8)
+    base = {'edge_method': 'adaptive', 'target_width': None, 'target_height': None, 'keep_ratio': True}
+    results, stages, _ = sweep.run_sweep(img, shading_pipeline, [1, 3], [4, 8], [5], [1.0, 1.5], params=base)
+
+    assert len(results) == 8
+    for params, rendered in results:
+        assert np.array_equal(rendered, shading_pipeline.run(img, dict(base, **params)))
+    # Saturation 1.0 is a no-op, and edges and posterization only run per distinct input and value.
+    assert stages == {'smooth_fast': 1, 'saturation_fast': 1, 'edge_source_fast': 2, 'edges': 4, 'posterize': 4, 'combine': 8}
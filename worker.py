@@ -0,0 +1,124 @@
+# CellShader - Headless render worker
+# Claims render jobs from the broker, runs apply_cell_shading() and writes the results back.
+# Run it from the shared application folder, so uploads/ and config.json are the web nodes' ones.
+#
+# Examples:
+#   python worker.py
+#   python worker.py --jobs 2 --config /srv/cellshader/config.json
+#   python worker.py --drain
+
+import argparse
+import logging
+import signal
+import threading
+import time
+
+import app as cellshader
+from broker import create_broker, new_worker_id
+
+logger = logging.getLogger(__name__)
+
+# Seconds between prunes of finished jobs, done while the queue is empty.
+PRUNE_INTERVAL = 60
+
+# Job kinds this worker can run.
+HANDLERS = {
+    cellshader.RENDER_JOB: cellshader.process_render_job
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run CellShader render jobs from the broker.')
+    parser.add_argument('--config', help='Path to an alternate config.json')
+    parser.add_argument('--jobs', type=int, default=1, help='Jobs rendered at the same time')
+    parser.add_argument('--idle-sleep', type=float, default=0.5, help='Seconds to wait when no job is queued')
+    parser.add_argument('--drain', action='store_true', help='Exit once the queue is empty')
+    return parser.parse_args()
+
+
+def run_job(broker, worker_id, job):
+    """Run one claimed job, renewing its lease until it completes or fails."""
+    done = threading.Event()
+
+    def keep_lease():
+        while not done.wait(broker.lease_seconds / 3):
+            if not broker.heartbeat(job['id'], worker_id):
+                logger.warning(f"Lost the lease on job {job['id']}")
+                return
+
+    heartbeat = threading.Thread(target=keep_lease, name=f"heartbeat-{job['id'][:8]}", daemon=True)
+    heartbeat.start()
+    started = time.perf_counter()
+    try:
+        result = HANDLERS[job['kind']](job['payload'])
+    except Exception as e:
+        logger.error(f"Job {job['id']} failed on attempt {job['attempts']}: {str(e)}")
+        broker.fail(job['id'], worker_id, str(e))
+        return
+    finally:
+        done.set()
+        heartbeat.join()
+    if broker.complete(job['id'], worker_id, result):
+        logger.info(f"Job {job['id']} done in {(time.perf_counter() - started) * 1000:.0f} ms")
+    else:
+        # Another worker took the job over (or it was cancelled), its result wins.
+        logger.warning(f"Job {job['id']} finished after its lease was lost, result discarded")
+
+
+def work(broker, worker_id, stopping, drain, idle_sleep):
+    """Claim and run jobs until asked to stop (or, when draining, until the queue is empty)."""
+    last_prune = 0.0
+    while not stopping.is_set():
+        try:
+            job = broker.claim(worker_id, list(HANDLERS))
+        except Exception as e:
+            # The shared broker file can be briefly unavailable, keep trying.
+            logger.error(f"Error claiming job: {str(e)}")
+            job = None
+        if job is not None:
+            run_job(broker, worker_id, job)
+            continue
+        if drain:
+            return
+        if time.monotonic() - last_prune >= PRUNE_INTERVAL:
+            last_prune = time.monotonic()
+            try:
+                broker.prune()
+            except Exception as e:
+                logger.warning(f"Could not prune finished jobs: {str(e)}")
+        stopping.wait(idle_sleep)
+
+
+def main():
+    args = parse_args()
+    if args.config:
+        cellshader.app.config['CONFIG_FILE'] = args.config
+    cellshader.load_app_config()
+    cellshader.create_upload_folder()
+    jobs = max(1, args.jobs)
+
+    # Split this node's cores between the concurrent jobs, as for server workers.
+    cellshader.configure_thread_budget(jobs)
+    if cellshader.app_config.get('warm_up_on_start', True):
+        cellshader.warm_up_processing()
+
+    broker = create_broker(cellshader.app_config, cellshader.app.config['BROKER_FILE'])
+    stopping = threading.Event()
+    # Finish the jobs in hand on Ctrl+C or SIGTERM instead of leaving them to lease expiry.
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+
+    worker_id = new_worker_id()
+    logger.info(f"Worker {worker_id} running {jobs} job(s) at a time from {broker.path}")
+    threads = [threading.Thread(target=work, args=(broker, f"{worker_id}/{index}", stopping, args.drain, args.idle_sleep))
+               for index in range(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.5)
+    logger.info(f"Worker {worker_id} stopped")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,8 @@
+# CellShader - WSGI entry point for production servers
+# gunicorn: gunicorn -c gunicorn.conf.py wsgi:app
+# waitress: waitress-serve --listen=0.0.0.0:8000 --threads=4 wsgi:app
+
+from app import create_app
+
+# Each worker process imports this module and runs the application factory once.
+app = create_app()